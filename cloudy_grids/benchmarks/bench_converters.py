@@ -0,0 +1,208 @@
+"""
+Time and memory profile the converters on synthetic CIAOLoop grids
+of several sizes and write the results to a JSON file.
+
+Each measurement runs in a fresh process, so the peak resident memory
+reported is that of a single call.  The baseline is the resident
+memory of that process after importing cloudy_grids.
+
+Usage: python bench_converters.py [--sizes 8x8 32x32] [--temperatures 161]
+                                  [--jobs 1] [--repeat 1]
+                                  [--output bench_converters.json]
+"""
+
+import argparse
+import h5py
+import json
+import multiprocessing
+import numpy as np
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+import cloudy_grids
+from cloudy_grids.profiling import \
+    get_peak_rss
+from cloudy_grids.synthetic import \
+    get_default_parameters, \
+    write_synthetic_grid
+
+def _measure(queue, function, args, kwargs):
+    "Call a cloudy_grids function and report its time and memory."
+    baseline = get_peak_rss()
+    t_start = time.perf_counter()
+    try:
+        getattr(cloudy_grids, function)(*args, **kwargs)
+    except Exception as error:
+        queue.put(error)
+        raise
+    queue.put((time.perf_counter() - t_start, baseline, get_peak_rss()))
+
+def measure(function, args, kwargs):
+    "Return the time, baseline memory, and peak memory of one call."
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure,
+                              args=(queue, function, args, kwargs))
+    process.start()
+    result = queue.get()
+    process.join()
+    if isinstance(result, Exception):
+        raise RuntimeError("%s failed: %s" % (function, result))
+    return result
+
+def get_input_bytes(run_file):
+    "Return the total size of the map files of a run."
+    input_dir = os.path.dirname(run_file)
+    return sum([os.path.getsize(os.path.join(input_dir, name))
+                for name in os.listdir(input_dir)])
+
+def make_benchmarks(input_dir, dimensions, n_temperatures, elements, jobs):
+    """
+    Write the synthetic grids for one grid size and return a list of
+    (name, function, args, kwargs, maps, input bytes, setup) for each
+    benchmark.  setup, if not None, is called before every run.  All
+    benchmarks write to output.h5 in input_dir.
+    """
+
+    n_maps = int(np.prod(dimensions))
+    output_file = os.path.join(input_dir, "output.h5")
+    convert_kwargs = {"jobs": jobs}
+    benchmarks = []
+
+    for mode, function in [("cooling", "convert_cooling_tables"),
+                           ("emissivity", "convert_emissivity_tables"),
+                           ("ion_balance", "convert_ion_balance_tables"),
+                           ("line", "convert_line_tables")]:
+        # Line grids only loop over hden.
+        my_dimensions = (n_maps,) if mode == "line" else dimensions
+        run_file = write_synthetic_grid(
+            os.path.join(input_dir, mode), mode=mode,
+            dimensions=my_dimensions, temperatures=n_temperatures,
+            elements=elements)
+        args = [run_file, output_file]
+        if mode == "ion_balance":
+            args.append(list(elements))
+        benchmarks.append((function, function, args, convert_kwargs,
+                           n_maps, get_input_bytes(run_file), None))
+
+    # Low temperature grids loop over the electron fraction in addition
+    # to the parameters of the high temperature grid.
+    parameters = get_default_parameters("cooling", dimensions)
+    lt_parameters = parameters[:1] + \
+      [("metal free electron fraction", ["%g" % x for x in np.logspace(-4, 0, 5)])] + \
+      parameters[1:]
+    lt_file = os.path.join(input_dir, "lt.h5")
+    ht_file = os.path.join(input_dir, "ht.h5")
+    cloudy_grids.convert_cooling_tables(
+        write_synthetic_grid(os.path.join(input_dir, "lt"),
+                             parameters=lt_parameters,
+                             temperatures=np.logspace(1, 4, n_temperatures // 4 + 1)),
+        lt_file)
+    cloudy_grids.convert_cooling_tables(
+        write_synthetic_grid(os.path.join(input_dir, "ht"),
+                             parameters=parameters,
+                             temperatures=np.logspace(4, 9, n_temperatures)),
+        ht_file)
+    benchmarks.append(("graft_cooling_tables", "graft_cooling_tables",
+                       [lt_file, ht_file, output_file], {},
+                       5 * n_maps, os.path.getsize(lt_file) + os.path.getsize(ht_file),
+                       None))
+
+    cooling_file = os.path.join(input_dir, "cooling.h5")
+    cloudy_grids.convert_cooling_tables(
+        os.path.join(input_dir, "cooling", "cooling.run"), cooling_file)
+    benchmarks.append(("zero_dataset", "zero_dataset",
+                       [cooling_file], {"output_file": output_file},
+                       n_maps, os.path.getsize(cooling_file), None))
+
+    zero_file = os.path.join(input_dir, "zero.h5")
+    benchmarks.append(("zero_dataset (in place)", "zero_dataset",
+                       [zero_file], {},
+                       n_maps, os.path.getsize(cooling_file),
+                       lambda: shutil.copy(cooling_file, zero_file)))
+
+    return benchmarks
+
+def parse_size(value):
+    "Convert a size like 8x8 to a tuple of grid dimensions."
+    try:
+        return tuple([int(q) for q in value.split("x")])
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "sizes must be integers separated by x, e.g., 8x8.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-s", "--sizes", type=parse_size, nargs="+",
+                        default=[(8, 8), (32, 32)],
+                        help="Grid dimensions, e.g., 8x8 or 16x16x4.")
+    parser.add_argument("-t", "--temperatures", type=int, default=161,
+                        help="Number of temperatures in each map.")
+    parser.add_argument("-e", "--elements", nargs="+", default=["C", "O"],
+                        help="Elements of the ion balance grids.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes used to read the map files.")
+    parser.add_argument("-r", "--repeat", type=int, default=1,
+                        help="Number of times to run each benchmark.  The "
+                        "fastest time and largest memory are kept.")
+    parser.add_argument("-o", "--output", default="bench_converters.json",
+                        help="JSON file for the results.")
+    args = parser.parse_args()
+
+    results = []
+    print("%-28s %12s %8s %10s %12s %14s" %
+          ("benchmark", "grid", "maps", "time (s)", "maps/s", "peak RSS (MB)"))
+    for dimensions in args.sizes:
+        input_dir = tempfile.mkdtemp()
+        try:
+            for name, function, f_args, f_kwargs, n_maps, input_bytes, setup in \
+              make_benchmarks(input_dir, dimensions, args.temperatures,
+                              args.elements, args.jobs):
+                times = []
+                baseline = 0
+                peak = 0
+                output_file = os.path.join(input_dir, "output.h5")
+                for i in range(args.repeat):
+                    if os.path.exists(output_file):
+                        os.remove(output_file)
+                    if setup is not None:
+                        setup()
+                    t_run, my_baseline, my_peak = \
+                      measure(function, f_args, f_kwargs)
+                    times.append(t_run)
+                    baseline = max(baseline, my_baseline)
+                    peak = max(peak, my_peak)
+
+                results.append({
+                    "benchmark": name,
+                    "function": function,
+                    "grid": list(dimensions),
+                    "temperatures": args.temperatures,
+                    "maps": n_maps,
+                    "input_bytes": input_bytes,
+                    "time": min(times),
+                    "times": times,
+                    "maps_per_second": n_maps / min(times),
+                    "baseline_rss": baseline,
+                    "peak_rss": peak})
+                print("%-28s %12s %8d %10.3f %12.1f %14.1f" %
+                      (name, "x".join([str(q) for q in dimensions]), n_maps,
+                       min(times), n_maps / min(times), peak / 2**20))
+        finally:
+            shutil.rmtree(input_dir)
+
+    report = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "cloudy_grids": cloudy_grids.__version__,
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "h5py": h5py.__version__,
+              "platform": platform.platform(),
+              "cpus": multiprocessing.cpu_count(),
+              "jobs": args.jobs,
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s." % args.output)
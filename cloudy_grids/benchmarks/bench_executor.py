@@ -0,0 +1,97 @@
+"""
+Measure the slot utilization of run_cloudy_grid on a grid of stub
+Cloudy runs and compare it to dispatching by polling, as CIAOLoop does.
+
+The stub sleeps for a time that grows with the density, so runs have
+different lengths.  The polling estimate replays the measured run
+times with new runs only started every --poll seconds, like the
+sleep in CIAOLoop's WAIT loop.
+
+Usage: python bench_executor.py [--dimensions 8 4] [--jobs 4]
+                                [--run-time "0.02 * (hden + 3)"]
+                                [--poll 0.5] [--output bench_executor.json]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+from cloudy_grids.executor import \
+    run_cloudy_grid
+from cloudy_grids.scheduler import \
+    replay_schedule
+from cloudy_grids.synthetic import \
+    write_stub_cloudy
+
+def write_parameter_file(filename, dimensions):
+    "Write a bare mode parameter file looping over hden and metals."
+    lines = ["cloudyExe = cloudy.exe",
+             "outputFilePrefix = grid",
+             "outputDir = grid",
+             "cloudyRunMode = 0",
+             "command stop zone 1",
+             "command iterate to convergence"]
+    for name, n_values in zip(["hden", "metals * log"], dimensions):
+        lines.append("loop [%s] %s" %
+                     (name, " ".join(["%g" % (i - 2) for i in range(n_values)])))
+    with open(filename, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-d", "--dimensions", type=int, nargs=2, default=[8, 4],
+                        help="Number of hden and metals values.")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="Number of Cloudy runs at once.")
+    parser.add_argument("--run-time", default="0.02 * (hden + 3)",
+                        help="Run time of the stub in seconds, as a Python "
+                        "expression of hden and metals.")
+    parser.add_argument("--poll", type=float, default=0.5,
+                        help="Polling interval of the replayed CIAOLoop "
+                        "dispatch in seconds.")
+    parser.add_argument("-o", "--output", default="bench_executor.json",
+                        help="JSON file for the results.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    try:
+        os.chdir(work_dir)
+        write_stub_cloudy("cloudy.exe", run_time=args.run_time)
+        write_parameter_file("grid.par", args.dimensions)
+        report = run_cloudy_grid("grid.par", jobs=args.jobs,
+                                 cloudy_exe="./cloudy.exe")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir)
+
+    run_times = dict([(run, end - start)
+                      for run, (slot, start, end) in report.runs.items()])
+    lower_bound = max(report.busy_time / args.jobs, max(run_times.values()))
+    polled = replay_schedule(run_times, args.jobs, poll=args.poll)
+    print ("%-24s %10s %12s" % ("dispatch", "time (s)", "utilization"))
+    print ("%-24s %10.3f %12.3f" % ("asyncio", report.wall_time,
+                                    report.utilization))
+    print ("%-24s %10.3f %12.3f" % ("polling every %gs" % args.poll, polled,
+                                    report.busy_time / (args.jobs * polled)))
+    print ("%-24s %10.3f %12.3f" % ("lower bound", lower_bound,
+                                    report.busy_time / (args.jobs * lower_bound)))
+    print ("Total dispatch latency: %.4f s." % report.dispatch_latency)
+
+    results = report.to_dict()
+    results.update({"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "cpus": multiprocessing.cpu_count(),
+                    "run_time": args.run_time,
+                    "poll": args.poll,
+                    "poll_makespan": polled,
+                    "lower_bound": lower_bound})
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print ("Results written to %s." % args.output)
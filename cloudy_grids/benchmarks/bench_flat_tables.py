@@ -0,0 +1,179 @@
+"""
+Compare the time to load cooling tables with h5py and from the flat
+binary export mapped with np.memmap, with the file in the page cache
+(warm) and not (cold), and the memory each of several ranks loading
+the tables at once holds on its own.
+
+h5py reads each table into a native double array, as simulation codes
+do, so the byteswap from the big-endian storage is included.  The
+flat tables are timed both just mapped and after reading every value
+once.  Cold loads drop the pages of the file from the page cache with
+posix_fadvise first, which only works on file systems backed by a
+disk, not tmpfs.
+
+Usage: python bench_flat_tables.py [--dimensions 64 32 16]
+                                   [--temperatures 161] [--repeat 5]
+                                   [--ranks 4] [--directory .]
+                                   [--output bench_flat_tables.json]
+"""
+
+import argparse
+import h5py
+import json
+import multiprocessing
+import numpy as np
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+from cloudy_grids.flat_tables import \
+    export_flat_tables, \
+    load_flat_tables
+
+fields = ["Heating", "Cooling", "MMW"]
+
+def write_cooling_file(filename, dimensions, n_temperatures):
+    "Write random tables in the layout of convert_cooling_tables."
+    random = np.random.RandomState(0)
+    shape = tuple(dimensions) + (n_temperatures,)
+    with h5py.File(filename, "w") as f:
+        f.create_dataset("Temperature", data=np.logspace(1, 9, n_temperatures),
+                         dtype=">f8")
+        for q, size in enumerate(dimensions):
+            dataset = f.create_dataset("Parameter%d" % (q+1),
+                                       data=np.arange(size, dtype=float),
+                                       dtype=">f8")
+            dataset.attrs["Name"] = "parameter%d" % (q+1)
+        for field in fields:
+            dataset = f.create_dataset(field, shape=shape, dtype=">f8")
+            for i in range(shape[0]):
+                dataset[i] = random.random_sample(shape[1:])
+
+def drop_cache(filename):
+    "Drop the pages of a file from the page cache."
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def load_hdf5(filename):
+    "Read the tables into native double arrays."
+    tables = {}
+    with h5py.File(filename, "r") as f:
+        for field in fields:
+            dataset = f[field]
+            tables[field] = np.empty(dataset.shape, dtype=np.float64)
+            dataset.read_direct(tables[field])
+    return tables
+
+def load_flat(filename, touch=True):
+    "Map the tables, and optionally read every value once."
+    header, tables = load_flat_tables(filename, fields=fields)
+    if touch:
+        for table in tables.values():
+            table.sum()
+    return tables
+
+methods = {"h5py": (load_hdf5, "cooling.h5"),
+           "memmap": (lambda filename: load_flat(filename, touch=False), "cooling.bin"),
+           "memmap + read": (load_flat, "cooling.bin")}
+
+def get_private_memory():
+    "Return the memory in MB not shared with other processes, or None."
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return None
+    return sum([int(line.split()[1]) for line in lines
+                if line.startswith(("Private_Clean", "Private_Dirty"))]) / 1024.
+
+def time_load(method, directory, cold):
+    "Return the time to load the tables and the private memory used."
+    load, name = methods[method]
+    filename = os.path.join(directory, name)
+    if cold:
+        drop_cache(filename)
+    private = get_private_memory()
+    t_start = time.perf_counter()
+    tables = load(filename)
+    t_load = time.perf_counter() - t_start
+    if private is not None:
+        # Count the pages of mapped tables as used by this rank.
+        for table in tables.values():
+            table.sum()
+        private = get_private_memory() - private
+    del tables
+    return t_load, private
+
+def time_rank(task):
+    return time_load(*task)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-d", "--dimensions", type=int, nargs="+",
+                        default=[64, 32, 16],
+                        help="Number of values of each loop parameter.")
+    parser.add_argument("-t", "--temperatures", type=int, default=161,
+                        help="Number of temperatures.")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="Number of loads of each kind, of which the "
+                        "median is reported.")
+    parser.add_argument("-n", "--ranks", type=int, default=4,
+                        help="Number of processes loading the tables at once.")
+    parser.add_argument("--directory", default=".",
+                        help="Directory for the files, which should not be "
+                        "on tmpfs for the cold loads.")
+    parser.add_argument("-o", "--output", default="bench_flat_tables.json",
+                        help="JSON file for the results.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(dir=args.directory)
+    results = {}
+    try:
+        write_cooling_file(os.path.join(work_dir, "cooling.h5"),
+                           args.dimensions, args.temperatures)
+        export_flat_tables(os.path.join(work_dir, "cooling.h5"),
+                           os.path.join(work_dir, "cooling.bin"))
+        size = os.path.getsize(os.path.join(work_dir, "cooling.bin")) / 2**20
+        print ("Tables: %s x %d, %.1f MB." %
+               (" x ".join(["%d" % n for n in args.dimensions]),
+                args.temperatures, size))
+
+        print ("%-16s %10s %10s %12s %14s" %
+               ("load", "cold (s)", "warm (s)", "%d ranks (s)" % args.ranks,
+                "private (MB)"))
+        pool = multiprocessing.Pool(args.ranks)
+        for method in methods:
+            cold = np.median([time_load(method, work_dir, True)[0]
+                              for i in range(args.repeat)])
+            warm = np.median([time_load(method, work_dir, False)[0]
+                              for i in range(args.repeat)])
+            ranks = pool.map(time_rank, [(method, work_dir, False)] * args.ranks)
+            rank_time = max([rank[0] for rank in ranks])
+            private = ranks[0][1]
+            print ("%-16s %10.4f %10.4f %12.4f %14s" %
+                   (method, cold, warm, rank_time,
+                    "n/a" if private is None else "%.1f" % private))
+            results[method] = {"cold": cold, "warm": warm,
+                               "ranks": rank_time, "private": private}
+        pool.close()
+    finally:
+        shutil.rmtree(work_dir)
+
+    results.update({"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "python": platform.python_version(),
+                    "h5py": h5py.__version__,
+                    "platform": platform.platform(),
+                    "cpus": multiprocessing.cpu_count(),
+                    "dimensions": args.dimensions,
+                    "temperatures": args.temperatures,
+                    "size": size,
+                    "ranks_count": args.ranks})
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print ("Results written to %s." % args.output)
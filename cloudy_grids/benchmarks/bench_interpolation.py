@@ -0,0 +1,83 @@
+"""
+Benchmark batched cooling table lookups with CoolingTable.
+
+Usage: python bench_interpolation.py [--points 1e6 1e7]
+                                     [--output bench_interpolation.json]
+"""
+
+import argparse
+import h5py
+import json
+import numpy as np
+import os
+import platform
+import tempfile
+import time
+
+from cloudy_grids import CoolingTable
+
+def write_cooling_table(filename, n_density=29, n_redshift=21,
+                        n_temperatures=161):
+    "Write a cooling table with the layout of convert_cooling_tables."
+
+    log_nH = np.linspace(-10, 4, n_density)
+    redshift = np.linspace(0, 10, n_redshift)
+    temperature = np.logspace(1, 9, n_temperatures)
+    shape = (n_density, n_redshift, n_temperatures)
+
+    with h5py.File(filename, "w") as f:
+        f.create_dataset("Temperature", data=temperature, dtype=">f8")
+        for field in ["Heating", "Cooling", "MMW"]:
+            f.create_dataset(field, data=np.random.random(shape), dtype=">f8")
+        for q, (name, values) in enumerate([("hden", log_nH),
+                                            ("redshift", redshift)]):
+            dataset = f.create_dataset("Parameter%d" % (q+1), data=values,
+                                       dtype=">f8")
+            dataset.attrs["Name"] = name
+
+def time_lookups(table, n_points, fields):
+    "Return the time in seconds to interpolate fields at random points."
+
+    points = [np.random.uniform(axis[0], axis[-1], n_points)
+              for axis in table.axes]
+    t_start = time.perf_counter()
+    table.interpolate(points, fields=fields)
+    return time.perf_counter() - t_start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--points", type=lambda size: int(float(size)),
+                        nargs="+", default=[10**6, 10**7],
+                        help="Numbers of points interpolated in one call, "
+                        "e.g., 1e6.")
+    parser.add_argument("-o", "--output", default="bench_interpolation.json",
+                        help="JSON file for the results.")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        filename = os.path.join(output_dir, "cooling.h5")
+        write_cooling_table(filename)
+        table = CoolingTable(filename)
+
+    results = []
+    print("%12s %10s %16s %16s" %
+          ("points", "fields", "time (s)", "lookups/s"))
+    for n_points in args.points:
+        for fields in [["Cooling"], ["Heating", "Cooling", "MMW"]]:
+            t_lookup = time_lookups(table, n_points, fields)
+            print("%12d %10d %16.3f %16.3e" %
+                  (n_points, len(fields), t_lookup, n_points / t_lookup))
+            results.append({"points": n_points,
+                            "fields": fields,
+                            "time": t_lookup,
+                            "lookups_per_second": n_points / t_lookup})
+
+    report = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "h5py": h5py.__version__,
+              "platform": platform.platform(),
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s." % args.output)
@@ -0,0 +1,105 @@
+"""
+Compare hdf5 table layouts by file size, write time, and the time to
+read random temperature rows.
+
+Usage: python bench_layouts.py [--grid 100] [--temperatures 161]
+                               [--reads 2000] [--output bench_layouts.json]
+"""
+
+import argparse
+import h5py
+import json
+import numpy as np
+import os
+import platform
+import tempfile
+import time
+
+from cloudy_grids.utilities import get_dataset_options
+
+layouts = [
+    ("big-endian, contiguous", {}),
+    ("native, contiguous", {"native_endian": True}),
+    ("native, chunked", {"native_endian": True, "chunks": True}),
+    ("native, gzip", {"native_endian": True, "compression": "gzip"}),
+    ("native, shuffle+gzip", {"native_endian": True, "compression": "gzip",
+                              "shuffle": True}),
+    ("native, lzf", {"native_endian": True, "compression": "lzf"}),
+    ("native, shuffle+lzf", {"native_endian": True, "compression": "lzf",
+                             "shuffle": True}),
+]
+
+def make_table(n_grid, n_temperatures):
+    "Return a smooth cooling-like table printed to 7 significant digits."
+
+    log_t = np.linspace(1, 9, n_temperatures)
+    log_n = np.linspace(-10, 4, n_grid)[:, None, None]
+    z = np.linspace(0, 10, n_grid)[None, :, None]
+    table = 10**(-23 + 0.5 * np.sin(log_t) - 0.1 * log_n + 0.01 * z)
+    return np.array(["%.6e" % v for v in table.ravel()],
+                     dtype=float).reshape(table.shape)
+
+def time_layout(filename, table, options, n_reads=2000):
+    "Return the file size, write time, and random row read time."
+
+    t_start = time.perf_counter()
+    with h5py.File(filename, "w") as f:
+        f.create_dataset("Cooling", data=table,
+                         **get_dataset_options(table.shape, ">f8", **options))
+    t_write = time.perf_counter() - t_start
+    size = os.path.getsize(filename)
+
+    rows = np.random.RandomState(0).randint(
+        0, table.shape[0], size=(n_reads, 2))
+    t_start = time.perf_counter()
+    with h5py.File(filename, "r") as f:
+        dataset = f["Cooling"]
+        for i, j in rows:
+            dataset[i, j]
+    t_read = time.perf_counter() - t_start
+
+    return size, t_write, t_read / n_reads
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-g", "--grid", type=int, default=100,
+                        help="Number of grid points along each of the two "
+                        "loop parameters.")
+    parser.add_argument("-t", "--temperatures", type=int, default=161,
+                        help="Number of temperatures.")
+    parser.add_argument("-r", "--reads", type=int, default=2000,
+                        help="Number of random temperature rows read.")
+    parser.add_argument("-o", "--output", default="bench_layouts.json",
+                        help="JSON file for the results.")
+    args = parser.parse_args()
+
+    table = make_table(args.grid, args.temperatures)
+    print("Table shape: %s, %.1f MB." % (table.shape, table.nbytes / 2**20))
+    print("%-24s %10s %10s %14s" %
+          ("layout", "size (MB)", "write (s)", "row read (us)"))
+
+    results = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for name, options in layouts:
+            filename = os.path.join(output_dir, "layout.h5")
+            size, t_write, t_read = time_layout(filename, table, options,
+                                                n_reads=args.reads)
+            print("%-24s %10.2f %10.3f %14.1f" %
+                  (name, size / 2**20, t_write, 1e6 * t_read))
+            results.append({"layout": name,
+                            "options": options,
+                            "size": size,
+                            "write": t_write,
+                            "row_read": t_read})
+
+    report = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "numpy": np.__version__,
+              "h5py": h5py.__version__,
+              "platform": platform.platform(),
+              "shape": list(table.shape),
+              "reads": args.reads,
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s." % args.output)
@@ -0,0 +1,114 @@
+"""
+Benchmark the vectorized map reader against the old per-token loop
+and against reading maps back from the binary map cache.
+
+Usage: python bench_map_reader.py [--maps 2000] [--temperatures 161]
+                                  [--output bench_map_reader.json]
+"""
+
+import argparse
+import json
+import numpy as np
+import os
+import platform
+import tempfile
+import time
+
+from cloudy_grids.utilities import load_map, set_map_cache
+
+def legacy_load_map(mapFile):
+    "The per-token cooling map parser used before load_map."
+
+    f = open(mapFile,'r')
+    lines = f.readlines()
+    f.close()
+
+    t = []
+    h = []
+    c = []
+    m = []
+
+    for line in lines:
+        line.strip()
+        if line[0] != '#':
+            onLine = line.split()
+            t.append(float(onLine[0]))
+            h.append(float(onLine[1]))
+            c.append(float(onLine[2]))
+            m.append(float(onLine[3]))
+
+    return t, h, c, m
+
+def write_cooling_maps(output_dir, n_maps, n_temperatures):
+    "Write a set of synthetic cooling map files."
+
+    temperature = np.logspace(1, 9, n_temperatures)
+    map_files = []
+    for q in range(n_maps):
+        map_file = os.path.join(output_dir, "bench_run%d.dat" % (q+1))
+        with open(map_file, 'w') as f:
+            f.write("# Cooling Map File\n#\n")
+            f.write("#Te\t\tHeating\t\tCooling\t\tMMW\n")
+            for t in temperature:
+                f.write("%.6e\t%.6e\t%.6e\t%.6f\n" %
+                        (t, 1e-23 * np.random.random(),
+                         1e-22 * np.random.random(), 0.6))
+        map_files.append(map_file)
+    return map_files
+
+def time_reader(reader, map_files):
+    "Return the time in seconds to read all map files."
+
+    t_start = time.perf_counter()
+    for map_file in map_files:
+        reader(map_file)
+    return time.perf_counter() - t_start
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--maps", type=int, default=2000,
+                        help="Number of map files.")
+    parser.add_argument("-t", "--temperatures", type=int, default=161,
+                        help="Number of temperatures in each map.")
+    parser.add_argument("-o", "--output", default="bench_map_reader.json",
+                        help="JSON file for the results.")
+    args = parser.parse_args()
+    n_maps = args.maps
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        print("Writing %d maps with %d temperatures." %
+              (n_maps, args.temperatures))
+        map_files = write_cooling_maps(output_dir, n_maps, args.temperatures)
+
+        # Read everything once so both readers see a warm page cache.
+        time_reader(load_map, map_files)
+
+        t_legacy = time_reader(legacy_load_map, map_files)
+        t_new = time_reader(load_map, map_files)
+
+        set_map_cache(os.path.join(output_dir, "cache"))
+        t_fill = time_reader(load_map, map_files)
+        t_cached = time_reader(load_map, map_files)
+        set_map_cache(None)
+
+    print("legacy loop: %.3f s (%.1f maps/s)" % (t_legacy, n_maps / t_legacy))
+    print("load_map:    %.3f s (%.1f maps/s)" % (t_new, n_maps / t_new))
+    print("speedup:     %.2fx" % (t_legacy / t_new))
+    print("cache fill:  %.3f s (%.1f maps/s)" % (t_fill, n_maps / t_fill))
+    print("cache hit:   %.3f s (%.1f maps/s)" % (t_cached, n_maps / t_cached))
+    print("speedup:     %.2fx" % (t_new / t_cached))
+
+    results = {"date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               "python": platform.python_version(),
+               "numpy": np.__version__,
+               "platform": platform.platform(),
+               "maps": n_maps,
+               "temperatures": args.temperatures,
+               "results": {name: {"time": t_read, "maps_per_second": n_maps / t_read}
+                           for name, t_read in [("legacy", t_legacy),
+                                                ("load_map", t_new),
+                                                ("cache_fill", t_fill),
+                                                ("cache_hit", t_cached)]}}
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Results written to %s." % args.output)
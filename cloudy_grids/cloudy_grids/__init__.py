@@ -1,15 +1,39 @@
 __version__ = "1.0"
 
+from .assembly import \
+    assemble_grid, \
+    materialize_grid
+
 from .cooling_tables import \
+    CoolingTable, \
     convert_cooling_tables, \
     graft_cooling_tables, \
+    subtract_cooling_tables, \
     zero_dataset
 
 from .emissivity_tables import \
+    EmissivityTable, \
+    add_cumulative_emissivity, \
     convert_emissivity_tables
 
+from .flat_tables import \
+    export_flat_tables, \
+    load_flat_tables
+
+from .gaps import \
+    GridGaps, \
+    find_grid_gaps
+
 from .ion_balance_tables import \
     convert_ion_balance_tables
 
 from .line_tables import \
+    LineTable, \
     convert_line_tables
+
+from .profiling import \
+    ConversionProfile
+
+from .utilities import \
+    set_map_cache, \
+    trim_map_cache
@@ -0,0 +1,412 @@
+"""
+Assemble the converted tables of a grid computed in pieces into one
+file of virtual datasets, and copy it to a regular file.
+"""
+
+import h5py
+import itertools
+import numpy as np
+import os
+
+from cloudy_grids.utilities import \
+    get_tables, \
+    get_dataset_options, \
+    get_slabs
+
+# Datasets that depend on the grid but are not tables of runs.  They
+# are left out of an assembled file and can be made again from it.
+derived_datasets = ["Cumulative_Emissivity"]
+
+def _get_range_slabs(shape, start, end):
+    """
+    Return the hyperslabs, as tuples of slices, covering the runs
+    start to end - 1 of a grid of this shape in run number order.
+    """
+
+    if start >= end:
+        return []
+    if len(shape) == 1:
+        return [(slice(start, end),)]
+
+    inner = int(np.prod(shape[1:]))
+    first, firstRest = divmod(start, inner)
+    last, lastRest = divmod(end, inner)
+    if first == last:
+        return [(slice(first, first+1),) + slab
+                for slab in _get_range_slabs(shape[1:], firstRest, lastRest)]
+
+    slabs = []
+    if firstRest:
+        slabs.extend([(slice(first, first+1),) + slab
+                      for slab in _get_range_slabs(shape[1:], firstRest, inner)])
+        first += 1
+    if last > first:
+        slabs.append((slice(first, last),) +
+                     tuple(slice(0, size) for size in shape[1:]))
+    if lastRest:
+        slabs.extend([(slice(last, last+1),) + slab
+                      for slab in _get_range_slabs(shape[1:], 0, lastRest)])
+    return slabs
+
+def _get_mask_slabs(mask):
+    "Return hyperslabs covering the True runs of a grid."
+    runs = np.flatnonzero(mask.ravel())
+    if not runs.size:
+        return []
+    breaks = np.flatnonzero(np.diff(runs) != 1)
+    starts = runs[np.concatenate([[0], breaks + 1])]
+    ends = runs[np.concatenate([breaks, [-1]])] + 1
+    slabs = []
+    for start, end in zip(starts, ends):
+        slabs.extend(_get_range_slabs(mask.shape, start, end))
+    return slabs
+
+def _split_axis(indices, axisSlice):
+    """
+    Split a slice of a piece along one axis into the parts that map
+    to consecutive indices of the grid, as pairs of slices.
+    """
+
+    gridIndices = indices[axisSlice]
+    breaks = np.flatnonzero(np.diff(gridIndices) != 1) + 1
+    bounds = np.concatenate([[0], breaks, [gridIndices.size]])
+    return [(slice(axisSlice.start + lower, axisSlice.start + upper),
+             slice(gridIndices[lower], gridIndices[lower] + upper - lower))
+            for lower, upper in zip(bounds[:-1], bounds[1:])]
+
+def _get_mappings(inputs, manifestPath, indices, gridShape):
+    """
+    Return the piece holding each part of the grid, as a list of the
+    piece number and the hyperslabs of the runs in the piece and in
+    the grid, and the number of runs taken from each piece.  The piece
+    given last holds each run.
+    """
+
+    owner = np.full(gridShape, -1, dtype=int)
+    for p, f in enumerate(inputs):
+        held = np.ones([len(q) for q in indices[p]], dtype=bool)
+        if manifestPath in f and "ingested" in f[manifestPath]:
+            held = f[manifestPath]["ingested"][()].astype(bool).reshape(held.shape)
+        region = np.ix_(*indices[p])
+        myOwner = owner[region]
+        myOwner[held] = p
+        owner[region] = myOwner
+
+    mappings = []
+    counts = []
+    for p in range(len(inputs)):
+        mine = owner[np.ix_(*indices[p])] == p
+        counts.append(int(mine.sum()))
+        for slab in _get_mask_slabs(mine):
+            splits = [_split_axis(indices[p][axis], slab[axis])
+                      for axis in range(len(gridShape))]
+            for parts in itertools.product(*splits):
+                mappings.append((p, tuple([part[0] for part in parts]),
+                                 tuple([part[1] for part in parts])))
+    return mappings, counts
+
+def _create_virtual_dataset(group, name, shape, dtype, sources, fillvalue=0):
+    """
+    Create a virtual dataset from a list of the file name, dataset
+    shape, and source and target hyperslabs of each mapping.  This
+    uses the low level interface, as VirtualLayout copies its source
+    for every mapping, which is slow for grids of many pieces.
+    """
+
+    dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+    dcpl.set_fill_value(np.array(fillvalue, dtype=dtype))
+    virtualSpace = h5py.h5s.create_simple(shape)
+    path = name.encode()
+    sourceSpaces = {}
+    for filename, sourceShape, sourceSlab, targetSlab in sources:
+        if sourceShape not in sourceSpaces:
+            sourceSpaces[sourceShape] = h5py.h5s.create_simple(sourceShape)
+        sourceSpace = sourceSpaces[sourceShape]
+        for space, slab in [(virtualSpace, targetSlab), (sourceSpace, sourceSlab)]:
+            space.select_hyperslab(tuple([q.start for q in slab]),
+                                   tuple([q.stop - q.start for q in slab]))
+        dcpl.set_virtual(virtualSpace, filename.encode(), path, sourceSpace)
+    virtualSpace.select_all()
+    h5py.h5d.create(group.id, path, h5py.h5t.py_create(np.dtype(dtype), logical=1),
+                    virtualSpace, dcpl=dcpl)
+    return group[name]
+
+def _same_values(values, other):
+    "Return True if two lists of loop values are the same."
+    return len(values) == len(other) and \
+      all([len(a) == len(b) and np.allclose(a, b, rtol=1e-8, atol=1e-8)
+           for a, b in zip(values, other)])
+
+def _get_grid_values(pieceValues):
+    """
+    Return the loop values of the assembled grid, those of the pieces
+    if they are all the same, or else the sorted values of all pieces.
+    """
+
+    first = pieceValues[0]
+    if all([_same_values(first, values) for values in pieceValues[1:]]):
+        return [np.asarray(values) for values in first]
+
+    gridValues = []
+    for axis in range(len(first)):
+        values = np.sort(np.concatenate([np.asarray(piece[axis], dtype=float)
+                                         for piece in pieceValues]))
+        keep = np.concatenate(
+            [[True], ~np.isclose(values[1:], values[:-1], rtol=1e-8, atol=1e-8)])
+        gridValues.append(values[keep])
+    return gridValues
+
+def _get_indices(values, gridValues, filename, name):
+    "Return the index in the grid of each loop value of a piece."
+    indices = np.empty(len(values), dtype=int)
+    for i, value in enumerate(values):
+        match = np.flatnonzero(np.isclose(gridValues, value, rtol=1e-8, atol=1e-8))
+        if not match.size:
+            raise RuntimeError("Value %g of %s in %s is not in the grid." %
+                               (value, name, filename))
+        indices[i] = match[0]
+    return indices
+
+def _set_values(parent, name, values):
+    "Replace a loop parameter dataset or attribute, keeping its type."
+    if isinstance(parent, h5py.Dataset) or name in parent.attrs:
+        dtype = parent.attrs[name].dtype
+        parent.attrs[name] = np.array(values, dtype=dtype)
+        return
+    dataset = parent[name]
+    attributes = dict(dataset.attrs)
+    dtype = dataset.dtype
+    del parent[name]
+    dataset = parent.create_dataset(name, data=np.array(values, dtype=dtype))
+    for attribute, value in attributes.items():
+        dataset.attrs[attribute] = value
+    if "Dimension" in attributes:
+        dataset.attrs["Dimension"] = \
+          np.array(dataset.shape, dtype=attributes["Dimension"].dtype)
+
+def _write_grid_values(output, mode, tables, names, values):
+    "Write the loop values of the assembled grid where each mode keeps them."
+    if mode == "cooling":
+        for q, myValues in enumerate(values):
+            _set_values(output, "Parameter%d" % (q+1), myValues)
+    elif mode == "emissivity":
+        dataset = output["Emissivity"]
+        for name, myValues in zip(names, values):
+            if name == "energy":
+                _set_values(dataset, "log_E", np.log10(myValues))
+            else:
+                _set_values(dataset, name, myValues)
+    elif mode == "line":
+        for path, nLead, manifestPath in tables:
+            group = output[os.path.dirname(path)]
+            for name, myValues in zip(names, values):
+                _set_values(group, name, myValues)
+    else:
+        for path, nLead, manifestPath in tables:
+            for name, myValues in zip(names, values):
+                _set_values(output[path], name, myValues)
+
+def _copy_attributes(source, target):
+    "Copy all attributes of one object to another."
+    for attribute, value in source.attrs.items():
+        target.attrs[attribute] = value
+
+def assemble_grid(input_files, output_file):
+    """
+    Assemble the converted tables of a grid computed in pieces into
+    one file without copying them.
+
+    Each table of the output, e.g., Heating, Cooling and MMW, is an
+    HDF5 virtual dataset that maps every run onto a hyperslab of the
+    same table in the file of the piece holding it, so the assembled
+    file takes no space beyond the mapping and is written in seconds
+    for any size of grid.  The piece files must stay where they are,
+    and are found by their paths relative to the output file.  The
+    output can be read like any converted file and copied to a
+    regular file for distribution with materialize_grid.
+
+    Pieces are files written by separate conversions with the same
+    converter, either of the whole grid, e.g., of a grid and of the
+    runs of its .fix list done again in another directory, converted
+    with incremental=True so that the manifest lists the runs each
+    holds, or of grids whose loop values are a subset of those of the
+    whole grid, e.g., a range of redshifts run later.  The parts of a
+    run made with CIAOLoop -mp are not pieces, as converting any one
+    of them reads the runs of every part found.  Runs are matched by
+    their loop values.  Where pieces hold the same run, the one given
+    last is used, so reruns should come after the grid they fix.  Runs
+    in no piece are zero.  The other datasets and attributes are taken
+    from the first piece.
+
+    Parameters
+    ----------
+    input_files : list of strings
+        HDF5 files of the pieces, in order of precedence.
+    output_file : string
+        HDF5 output file name.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import assemble_grid, materialize_grid
+    >>> assemble_grid(["grid/cooling.h5", "high_z/cooling.h5",
+    ...                "fix/cooling.h5"], "cooling.h5")
+    >>> materialize_grid("cooling.h5", "cooling_release.h5")
+
+    """
+
+    print ("Assembling %s from %d pieces." % (output_file, len(input_files)))
+    # Pieces are found relative to the assembled file.
+    outputDir = os.path.dirname(os.path.abspath(output_file))
+    relPaths = [os.path.relpath(os.path.abspath(filename), outputDir)
+                for filename in input_files]
+
+    inputs = [h5py.File(filename, 'r') for filename in input_files]
+    try:
+        first = inputs[0]
+        tables, names, values, temperatures, mode = get_tables(first)
+        pieceValues = []
+        for f, filename in zip(inputs, input_files):
+            myTables, myNames, myValues, myTemperatures, myMode = get_tables(f)
+            if myMode != mode or myNames != names:
+                raise RuntimeError("%s is not a piece of the same kind of grid as %s." %
+                                   (filename, input_files[0]))
+            if not _same_values([temperatures], [myTemperatures]):
+                raise RuntimeError("Temperatures of %s do not match %s." %
+                                   (filename, input_files[0]))
+            pieceValues.append(myValues)
+
+        gridValues = _get_grid_values(pieceValues)
+        gridShape = tuple([len(q) for q in gridValues])
+        indices = [[_get_indices(myValues, gridValues[axis], filename, names[axis])
+                    for axis, myValues in enumerate(pieceValue)]
+                   for pieceValue, filename in zip(pieceValues, input_files)]
+        rank = len(gridShape)
+
+        output = h5py.File(output_file, 'w')
+        _copy_attributes(first, output)
+        tablePaths = [path for path, nLead, manifestPath in tables]
+        for name in first:
+            if name.startswith("_manifest") or name in derived_datasets:
+                continue
+            if isinstance(first[name], h5py.Group):
+                group = output.create_group(name)
+                _copy_attributes(first[name], group)
+                for member in first[name]:
+                    if "%s/%s" % (name, member) not in tablePaths:
+                        first.copy(first[name][member], group, name=member)
+            elif name not in tablePaths:
+                first.copy(first[name], output, name=name)
+
+        # Tables with the same manifest hold the same runs.
+        mappings = {}
+        for path, nLead, manifestPath in tables:
+            source = first[path]
+            lead = source.shape[:nLead]
+            tail = source.shape[nLead+rank:]
+            for p, f in enumerate(inputs):
+                if path not in f:
+                    raise RuntimeError("%s has no %s table." % (input_files[p], path))
+                pieceShape = f[path].shape
+                if pieceShape[:nLead] != lead or pieceShape[nLead+rank:] != tail:
+                    raise RuntimeError("Shape of %s in %s does not match %s." %
+                                       (path, input_files[p], input_files[0]))
+            if manifestPath not in mappings:
+                mappings[manifestPath] = _get_mappings(inputs, manifestPath,
+                                                       indices, gridShape)
+
+            leadSlab = tuple([slice(0, size) for size in lead])
+            tailSlab = tuple([slice(0, size) for size in tail])
+            pieceShapes = [f[path].shape for f in inputs]
+            sources = [(relPaths[p], pieceShapes[p], leadSlab + pieceSlab + tailSlab,
+                        leadSlab + gridSlab + tailSlab)
+                       for p, pieceSlab, gridSlab in mappings[manifestPath][0]]
+            dataset = _create_virtual_dataset(output, path, lead + gridShape + tail,
+                                              source.dtype, sources)
+            _copy_attributes(source, dataset)
+            if "Dimension" in source.attrs:
+                dataset.attrs["Dimension"] = \
+                  np.array(dataset.shape, dtype=source.attrs["Dimension"].dtype)
+
+        _write_grid_values(output, mode, tables, names, gridValues)
+        output.close()
+    finally:
+        for f in inputs:
+            f.close()
+
+    # Runs of the first table, the same for all but ion balance tables.
+    myMappings, counts = mappings[tables[0][2]]
+    for p, filename in enumerate(input_files):
+        print ("%s: %d runs in %d hyperslabs." %
+               (filename, counts[p],
+                len([mapping for mapping in myMappings if mapping[0] == p])))
+    nMissing = int(np.prod(gridShape)) - sum(counts)
+    if nMissing:
+        print ("%d of %d runs are in none of the pieces and are zero." %
+               (nMissing, int(np.prod(gridShape))))
+
+def materialize_grid(input_file, output_file, native_endian=False, chunks=None,
+                     compression=None, shuffle=False, max_size=64):
+    """
+    Copy a file with virtual datasets, such as one written by
+    assemble_grid, to a file holding all of the data, e.g., for
+    distribution.  Virtual datasets are copied a slab of at most
+    max_size MB at a time and can be given a new layout.  Other
+    datasets are copied as they are.
+
+    Parameters
+    ----------
+    input_file : string
+        HDF5 file with virtual datasets.
+    output_file : string
+        HDF5 output file name.
+    native_endian : optional, bool
+        If True, store the tables in the byte order of this machine.
+        Default: False.
+    chunks : optional, bool or tuple
+        Chunk shape of the tables.  If True, use a shape that keeps
+        each temperature row contiguous.
+        Default: None.
+    compression : optional, string or int
+        Compression filter for the tables, either 'gzip', 'lzf', or
+        a gzip level.
+        Default: None.
+    shuffle : optional, bool
+        If True, apply the shuffle filter before compression.
+        Default: False.
+    max_size : optional, float
+        Largest slab copied at once in MB.
+        Default: 64.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import materialize_grid
+    >>> materialize_grid("cooling.h5", "cooling_release.h5",
+    ...                  compression="gzip", shuffle=True)
+
+    """
+
+    print ("Materializing %s to %s." % (input_file, output_file))
+    with h5py.File(input_file, 'r') as input, h5py.File(output_file, 'w') as output:
+        _copy_attributes(input, output)
+
+        def copy(name, source):
+            if isinstance(source, h5py.Group):
+                _copy_attributes(source, output.require_group(name))
+            elif not source.is_virtual:
+                input.copy(source, output, name=name)
+            else:
+                options = get_dataset_options(source.shape, source.dtype,
+                                              native_endian=native_endian,
+                                              chunks=chunks,
+                                              compression=compression,
+                                              shuffle=shuffle)
+                dataset = output.create_dataset(name, shape=source.shape, **options)
+                for slab in get_slabs(source.shape, dataset.dtype.itemsize,
+                                      chunks=options.get("chunks"),
+                                      max_size=max_size):
+                    dataset[slab] = source[slab]
+                _copy_attributes(source, dataset)
+
+        input.visititems(copy)
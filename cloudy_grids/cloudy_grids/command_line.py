@@ -0,0 +1,412 @@
+"""
+Command line interface for converting CIAOLoop grids to hdf5.
+"""
+
+import argparse
+import numpy as np
+import os
+
+from cloudy_grids.assembly import \
+    assemble_grid, \
+    materialize_grid
+from cloudy_grids.cooling_tables import \
+    convert_cooling_tables, \
+    subtract_cooling_tables
+from cloudy_grids.emissivity_tables import \
+    convert_emissivity_tables
+from cloudy_grids.executor import \
+    run_cloudy_grid
+from cloudy_grids.flat_tables import \
+    export_flat_tables
+from cloudy_grids.gaps import \
+    find_grid_gaps
+from cloudy_grids.ion_balance_tables import \
+    convert_ion_balance_tables
+from cloudy_grids.line_tables import \
+    convert_line_tables
+from cloudy_grids.profiling import \
+    ConversionProfile
+from cloudy_grids.refinement import \
+    refine_cooling_grid
+from cloudy_grids.scheduler import \
+    compare_orders
+from cloudy_grids.synthetic import \
+    write_synthetic_grid
+from cloudy_grids.utilities import \
+    run_modes, \
+    set_map_cache
+
+def add_conversion_arguments(parser):
+    "Add the arguments common to all conversions."
+    parser.add_argument("run_file",
+                        help="Path to the input file ending in .run, or any "
+                        "one of its .run.partK_N files for a run made with "
+                        "CIAOLoop -mp.")
+    parser.add_argument("output_file",
+                        help="HDF5 output file name.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of processes used to read the map files.")
+    parser.add_argument("-b", "--buffer-size", type=float, default=None,
+                        help="Stream maps to the output file through a buffer "
+                        "of at most this many MB.")
+    parser.add_argument("-i", "--incremental", action="store_true",
+                        help="Only read maps that are new or changed since "
+                        "the last conversion to the output file.")
+    parser.add_argument("--native-endian", action="store_true",
+                        help="Store tables in the byte order of this machine.")
+    parser.add_argument("--chunks", type=parse_chunks, default=None,
+                        help="Chunk shape of the tables as comma separated "
+                        "integers, or 'auto' to keep temperature rows "
+                        "contiguous.")
+    parser.add_argument("--compression", default=None,
+                        help="Compression filter: gzip, lzf, or a gzip level.")
+    parser.add_argument("--shuffle", action="store_true",
+                        help="Apply the shuffle filter before compression.")
+    parser.add_argument("--cache-dir", default=None,
+                        help="Cache parsed map files as .npy files in this "
+                        "directory.")
+    parser.add_argument("--cache-size", type=float, default=None,
+                        help="Maximum size of the map cache in MB.")
+    parser.add_argument("--profile", default=None,
+                        help="Write the time and memory of each stage of the "
+                        "conversion to this JSON file.")
+    parser.add_argument("--progress", type=float, default=None,
+                        help="Print progress with an estimated time remaining "
+                        "at most once per this many seconds.")
+
+def parse_chunks(value):
+    "Convert a --chunks value to the chunks keyword argument."
+    if value == "auto":
+        return True
+    try:
+        return tuple(int(q) for q in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "chunks must be 'auto' or comma separated integers.")
+
+def parse_compression(value):
+    "Convert a --compression value to the compression keyword argument."
+    if value is not None and value.isdigit():
+        return int(value)
+    return value
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog="cloudy_grids",
+        description="Convert grids of Cloudy ascii data to hdf5.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    for name, help in [("cooling", "Convert cooling tables."),
+                       ("line", "Convert line emissivity tables.")]:
+        subparser = subparsers.add_parser(name, help=help)
+        add_conversion_arguments(subparser)
+
+    subparser = subparsers.add_parser(
+        "emissivity", help="Convert emissivity tables.")
+    add_conversion_arguments(subparser)
+    subparser.add_argument("--cumulative", action="store_true",
+                           help="Also store the cumulative integral over "
+                           "energy used for band queries.")
+
+    subparser = subparsers.add_parser(
+        "ion_balance", help="Convert ion balance tables.")
+    add_conversion_arguments(subparser)
+    subparser.add_argument("-e", "--elements", nargs="+", required=True,
+                           help="List of elements to be converted.")
+
+    subparser = subparsers.add_parser(
+        "synthetic", help="Write a synthetic CIAOLoop run directory.")
+    subparser.add_argument("mode", choices=sorted(run_modes),
+                           help="Type of map files.")
+    subparser.add_argument("output_dir",
+                           help="Directory for the run file and map files.")
+    subparser.add_argument("-d", "--dimensions", type=int, nargs="+",
+                           default=[8, 8],
+                           help="Number of values of each loop parameter.")
+    subparser.add_argument("-t", "--temperatures", type=int, default=161,
+                           help="Number of temperatures in each map.")
+    subparser.add_argument("-e", "--elements", nargs="+", default=["C", "O"],
+                           help="Elements with ion balance maps.")
+    subparser.add_argument("--seed", type=int, default=0,
+                           help="Seed of the random values.")
+
+    subparser = subparsers.add_parser(
+        "subtract", help="Approximately subtract converted cooling tables "
+        "made without metals from those with all elements.")
+    subparser.add_argument("input_full",
+                           help="HDF5 cooling tables with all elements.")
+    subparser.add_argument("input_small",
+                           help="HDF5 cooling tables without metals.")
+    subparser.add_argument("output_file",
+                           help="HDF5 output file name.")
+    subparser.add_argument("-j", "--jobs", type=int, default=1,
+                           help="Number of processes used to subtract slabs.")
+    subparser.add_argument("-b", "--buffer-size", type=float, default=64,
+                           help="Subtract slabs of at most this many MB.")
+
+    subparser = subparsers.add_parser(
+        "assemble", help="Assemble converted pieces of a grid into one file "
+        "of virtual datasets without copying the tables.")
+    subparser.add_argument("output_file",
+                           help="HDF5 output file name.")
+    subparser.add_argument("input_files", nargs="+",
+                           help="Converted files of the pieces.  Where pieces "
+                           "hold the same run, the last one is used.")
+
+    subparser = subparsers.add_parser(
+        "materialize", help="Copy a file of virtual datasets to a regular "
+        "file.")
+    subparser.add_argument("input_file",
+                           help="HDF5 file with virtual datasets.")
+    subparser.add_argument("output_file",
+                           help="HDF5 output file name.")
+    subparser.add_argument("-b", "--buffer-size", type=float, default=64,
+                           help="Copy slabs of at most this many MB.")
+    subparser.add_argument("--native-endian", action="store_true",
+                           help="Store tables in the byte order of this machine.")
+    subparser.add_argument("--chunks", type=parse_chunks, default=None,
+                           help="Chunk shape of the tables as comma separated "
+                           "integers, or 'auto' to keep temperature rows "
+                           "contiguous.")
+    subparser.add_argument("--compression", default=None,
+                           help="Compression filter: gzip, lzf, or a gzip level.")
+    subparser.add_argument("--shuffle", action="store_true",
+                           help="Apply the shuffle filter before compression.")
+
+    subparser = subparsers.add_parser(
+        "export", help="Write converted tables to a flat native-endian "
+        "binary file for loading with mmap.")
+    subparser.add_argument("input_file",
+                           help="Converted hdf5 file.")
+    subparser.add_argument("output_file",
+                           help="Binary output file name.")
+    subparser.add_argument("-f", "--fields", nargs="+", default=None,
+                           help="Tables to export.  Default: all of them.")
+    subparser.add_argument("--alignment", type=int, default=4096,
+                           help="Alignment of each table in bytes.")
+
+    subparser = subparsers.add_parser(
+        "gaps", help="Find missing, short, zero and non-finite maps.")
+    subparser.add_argument("filename",
+                           help="Path to the run file ending in .run, or a "
+                           "converted hdf5 file.")
+    subparser.add_argument("-e", "--elements", nargs="+", default=None,
+                           help="Elements of the ion balance maps to check.")
+    subparser.add_argument("-f", "--fields", nargs="+", default=None,
+                           help="Map columns or hdf5 tables to check.")
+    subparser.add_argument("-t", "--temperatures", type=float, nargs=3,
+                           default=None, metavar=("T_LOWER", "T_UPPER", "STEPS"),
+                           help="Temperature range and number of log steps "
+                           "every map should have.")
+    subparser.add_argument("--zeros", dest="zeros", action="store_true",
+                           default=None,
+                           help="Count zero values as gaps (default for "
+                           "cooling maps).")
+    subparser.add_argument("--no-zeros", dest="zeros", action="store_false",
+                           help="Do not count zero values as gaps.")
+    subparser.add_argument("-j", "--jobs", type=int, default=1,
+                           help="Number of processes used to read the map files.")
+    subparser.add_argument("-o", "--fix-file", default=None,
+                           help="File for the list of runs with gaps.  "
+                           "Default: <prefix>.fix in the current directory.")
+
+    subparser = subparsers.add_parser(
+        "run", help="Run the Cloudy models of a grid on this machine.")
+    subparser.add_argument("input_file",
+                           help="CIAOLoop parameter file, or a run file "
+                           "ending in .run to restart.")
+    subparser.add_argument("-j", "--jobs", type=int, default=None,
+                           help="Number of Cloudy runs at once.  Default: "
+                           "the number of cpus.")
+    subparser.add_argument("--cloudy-exe", default=None,
+                           help="Cloudy command, overriding cloudyExe of the "
+                           "parameter file.")
+    subparser.add_argument("-r", "--restart", action="store_true",
+                           help="Only do the runs not yet in the run file.")
+    subparser.add_argument("--report", default=None,
+                           help="JSON file for the time of each run and the "
+                           "utilization.")
+    subparser.add_argument("--order", choices=["nested", "cost"],
+                           default="nested",
+                           help="Start runs in run number order, or the "
+                           "longest expected first.")
+    subparser.add_argument("--timings", nargs="+", default=None,
+                           help="Run files or reports of earlier grids used "
+                           "to estimate run times with --order cost.  "
+                           "Default: the runs already in the run file.")
+    subparser.add_argument("--cache-dir", default=None,
+                           help="Directory for a cache of Cloudy output "
+                           "keyed by the input, shared between grids.")
+    subparser.add_argument("--cache-size", type=float, default=None,
+                           help="Size limit in MB of the Cloudy output cache.")
+
+    subparser = subparsers.add_parser(
+        "refine", help="Run a cooling map grid with Cloudy only where "
+        "interpolation is not accurate enough.")
+    subparser.add_argument("parameter_file",
+                           help="CIAOLoop cooling map parameter file.")
+    subparser.add_argument("--tolerance", type=float, default=0.05,
+                           help="Largest interpolation error in dex of a "
+                           "cell left unrefined.")
+    subparser.add_argument("--coarse-step", type=int, nargs="+", default=[8],
+                           help="Spacing in grid points of the first points "
+                           "run, for all dimensions or for each loop and "
+                           "the temperature.")
+    subparser.add_argument("-f", "--fields", nargs="+",
+                           default=["Heating", "Cooling"],
+                           help="Fields checked for refinement.")
+    subparser.add_argument("-j", "--jobs", type=int, default=None,
+                           help="Number of Cloudy runs at once.  Default: "
+                           "the number of cpus.")
+    subparser.add_argument("--cloudy-exe", default=None,
+                           help="Cloudy command, overriding cloudyExe of the "
+                           "parameter file.")
+    subparser.add_argument("--cache-dir", default=None,
+                           help="Directory for a cache of Cloudy output "
+                           "keyed by the input, shared between grids.")
+    subparser.add_argument("--cache-size", type=float, default=None,
+                           help="Size limit in MB of the Cloudy output cache.")
+    subparser.add_argument("--report", default=None,
+                           help="JSON file for the time of each Cloudy run.")
+
+    subparser = subparsers.add_parser(
+        "schedule", help="Replay the run times of a finished grid in nested "
+        "and cost model order.")
+    subparser.add_argument("run_file",
+                           help="Path to the run file ending in .run.")
+    subparser.add_argument("-j", "--jobs", type=int, required=True,
+                           help="Number of runs at once.")
+    subparser.add_argument("--report", default=None,
+                           help="JSON report of cloudy_grids run with the "
+                           "run times.")
+    subparser.add_argument("--timings", nargs="+", default=None,
+                           help="Run files or reports used to fit the cost "
+                           "model.  Default: the grid itself.")
+
+    args = parser.parse_args(args)
+    if args.command == "run":
+        run_cloudy_grid(args.input_file, jobs=args.jobs,
+                        cloudy_exe=args.cloudy_exe, restart=args.restart,
+                        order=None if args.order == "nested" else args.order,
+                        timings=args.timings, cache_dir=args.cache_dir,
+                        cache_size=args.cache_size, report_file=args.report)
+        return
+
+    if args.command == "refine":
+        coarse_step = args.coarse_step
+        if len(coarse_step) == 1:
+            coarse_step = coarse_step[0]
+        refine_cooling_grid(args.parameter_file, tolerance=args.tolerance,
+                            coarse_step=coarse_step, fields=args.fields,
+                            jobs=args.jobs, cloudy_exe=args.cloudy_exe,
+                            cache_dir=args.cache_dir,
+                            cache_size=args.cache_size,
+                            report_file=args.report)
+        return
+
+    if args.command == "schedule":
+        makespans = compare_orders(args.run_file, args.jobs,
+                                   report_file=args.report,
+                                   timings=args.timings)
+        print ("%-16s %12s %10s" % ("order", "time (s)", "speedup"))
+        for name, makespan in makespans.items():
+            print ("%-16s %12.2f %10.3f" %
+                   (name, makespan, makespans["nested"] / makespan))
+        return
+
+    if args.command == "subtract":
+        subtract_cooling_tables(args.input_full, args.input_small,
+                                args.output_file, jobs=args.jobs,
+                                max_size=args.buffer_size)
+        return
+
+    if args.command == "assemble":
+        assemble_grid(args.input_files, args.output_file)
+        return
+
+    if args.command == "materialize":
+        materialize_grid(args.input_file, args.output_file,
+                         native_endian=args.native_endian, chunks=args.chunks,
+                         compression=parse_compression(args.compression),
+                         shuffle=args.shuffle, max_size=args.buffer_size)
+        return
+
+    if args.command == "export":
+        export_flat_tables(args.input_file, args.output_file,
+                           fields=args.fields, alignment=args.alignment)
+        return
+
+    if args.command == "gaps":
+        fix_file = args.fix_file
+        if fix_file is None:
+            fix_file = os.path.basename(args.filename)
+            if ".run" in fix_file:
+                fix_file = fix_file[:fix_file.rfind(".run")]
+            else:
+                fix_file = os.path.splitext(fix_file)[0]
+            fix_file += ".fix"
+        temperatures = None
+        if args.temperatures is not None:
+            T_lower, T_upper, steps = args.temperatures
+            temperatures = np.logspace(np.log10(T_lower), np.log10(T_upper),
+                                       int(steps))
+        gaps = find_grid_gaps(args.filename, elements=args.elements,
+                              fields=args.fields, zeros=args.zeros,
+                              temperatures=temperatures, jobs=args.jobs,
+                              fix_file=fix_file)
+        print (gaps.summary())
+        return
+
+    if args.command == "synthetic":
+        run_file = write_synthetic_grid(args.output_dir, mode=args.mode,
+                                        dimensions=args.dimensions,
+                                        temperatures=args.temperatures,
+                                        elements=args.elements,
+                                        seed=args.seed)
+        print ("Wrote %s." % run_file)
+        return
+
+    if args.cache_dir is not None:
+        set_map_cache(args.cache_dir, max_size=args.cache_size)
+    layout = {"native_endian": args.native_endian,
+              "chunks": args.chunks,
+              "compression": parse_compression(args.compression),
+              "shuffle": args.shuffle}
+    profile = None
+    if args.profile is not None or args.progress is not None:
+        profile = ConversionProfile(progress_interval=args.progress)
+
+    if args.command == "cooling":
+        convert_cooling_tables(args.run_file, args.output_file,
+                               jobs=args.jobs,
+                               buffer_size=args.buffer_size,
+                               incremental=args.incremental,
+                               profile=profile, **layout)
+    elif args.command == "emissivity":
+        convert_emissivity_tables(args.run_file, args.output_file,
+                                  jobs=args.jobs,
+                                  buffer_size=args.buffer_size,
+                                  incremental=args.incremental,
+                                  cumulative=args.cumulative,
+                                  profile=profile, **layout)
+    elif args.command == "ion_balance":
+        convert_ion_balance_tables(args.run_file, args.output_file,
+                                   args.elements, jobs=args.jobs,
+                                   buffer_size=args.buffer_size,
+                                   incremental=args.incremental,
+                                   profile=profile, **layout)
+    elif args.command == "line":
+        convert_line_tables(args.run_file, args.output_file,
+                            jobs=args.jobs,
+                            buffer_size=args.buffer_size,
+                            incremental=args.incremental,
+                            profile=profile, **layout)
+
+    if profile is not None:
+        print (profile.summary())
+        if args.profile is not None:
+            profile.write(args.profile)
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,30 @@
+from collections import deque
 import h5py
+import multiprocessing
 import numpy as np
-import re
-import copy
 
 from cloudy_grids.utilities import \
-     get_grid_indices, \
+     read_run_file, \
+     load_map, \
+     load_map_grid, \
+     read_manifest, \
+     get_incremental_runs, \
+     write_manifest, \
+     get_dataset_options, \
+     get_slabs, \
      get_attributes, \
      write_attributes
+from cloudy_grids.profiling import \
+     get_profile
+from cloudy_grids.interpolation import \
+     GridInterpolator
 
 floatType = '>f8'
 intType = '>i8'
 
-def convert_cooling_tables(runFile,outputFile):
+def convert_cooling_tables(runFile,outputFile,jobs=1,buffer_size=None,
+                           incremental=False,native_endian=False,chunks=None,
+                           compression=None,shuffle=False,profile=None):
     """
     Convert ascii cooling tables to hdf5.
 
@@ -21,6 +34,38 @@ def convert_cooling_tables(runFile,outputFile):
         Path to the input file ending in .run.
     output_file : string
         HDF5 output file name.
+    jobs : optional, int
+        Number of processes used to read the map files.
+        Default: 1.
+    buffer_size : optional, float
+        If set, stream the maps to the output file through a buffer
+        of at most this many MB instead of holding the whole grid
+        in memory.
+        Default: None.
+    incremental : optional, bool
+        If True, keep a manifest of ingested maps in the output file
+        and, if the file already has one, only read maps that are
+        new or have changed since.  The run file may be incomplete.
+        Default: False.
+    native_endian : optional, bool
+        If True, store the tables in the byte order of this machine
+        instead of big-endian.
+        Default: False.
+    chunks : optional, bool or tuple
+        Chunk shape of the tables.  If True, use a shape that keeps
+        each temperature row contiguous.
+        Default: None.
+    compression : optional, string or int
+        Compression filter for the tables, either 'gzip', 'lzf', or
+        a gzip level.
+        Default: None.
+    shuffle : optional, bool
+        If True, apply the shuffle filter before compression.
+        Default: False.
+    profile : optional, ConversionProfile
+        If given, record the time and memory of each stage of the
+        conversion.  See ConversionProfile.
+        Default: None.
 
     Examples
     --------
@@ -31,200 +76,174 @@ def convert_cooling_tables(runFile,outputFile):
     """
 
     print ("Converting %s to %s." % (runFile,outputFile))
+    profile = get_profile(profile)
 
-    if runFile[-4:] == '.run':
-        prefix = runFile[0:-4]
-    else:
-        raise RuntimeError("Run file needs to end in .run.")
-
-    f = open(runFile,'r')
-    lines = f.readlines()
-    f.close()
-
-    # Values of loop parameters.
-    parameterValues = []
-    parameterNames = []
-
-    getParameterValues = False
-    getRunValues = False
-
-    re_parValue = re.compile('^\# Loop commands and values:')
-    re_runValue = re.compile('^\#run')
-
-    totalRuns = 0
-
-    for q,line in enumerate(lines):
-        line = line.strip()
-        if getParameterValues:
-            if line == '#':
-                getParameterValues = False
-            else:
-                (par,values) = line.split(': ')
-                floatValues = [float(val) for val in values.split()]
-                parameterValues.append(floatValues)
-                parameterNames.append(par[2:])
-        elif getRunValues:
-            totalRuns = len(lines) - q
-            break
-        else:
-            if (re_parValue.match(line) is not None):
-                getParameterValues = True
-            elif (re_runValue.match(line) is not None):
-                getRunValues = True
-
-    # Check file line number against product of parameter numbers.
+    with profile.stage("read_run_file"):
+        prefix, parameterNames, parameterValues, listedRuns = \
+          read_run_file(runFile, complete=not incremental)
     gridDimension = [len(q) for q in parameterValues]
-    if totalRuns != np.prod(gridDimension):
-        raise RuntimeError(
-            "Error: total runs (%d) in run file not equal to product of parameters(%d)." %
-            (totalRuns, np.prog(gridDimension)))
-
-    # Read in data files.
-    gridData = []
-    for q in range(totalRuns):
-        mapFile = "%s_run%d.dat" % (prefix,(q+1))
-        indices = get_grid_indices(gridDimension,q)
-        loadMap(mapFile,gridDimension,indices,gridData)
-
-    # Write out hdf5 file.
-    output = h5py.File(outputFile,'w')
+    gridRuns = int(np.prod(gridDimension))
 
-    # Write data.
+    mapFiles = [["%s_run%d.dat" % (prefix,(q+1))] for q in range(gridRuns)]
     names = ["Temperature","Heating","Cooling","MMW"]
-    for q in range(len(gridData)):
-        dataset = output.create_dataset(names[q],data=gridData[q],dtype=floatType)
-        dataset.attrs["Dimension"] = np.array(gridData[q].shape,dtype=intType)
-        dataset.attrs["Rank"] = np.array(len(gridData[q].shape),dtype=intType)
-
-    # Write loop parameter values.
-    for q,values in enumerate(parameterValues):
-        values = np.array(values,dtype=float)
-        name = "Parameter%d" % (q+1)
-        dataset = output.create_dataset(name,data=values,dtype=floatType)
-        dataset.attrs["Dimension"] = np.array(values.shape,dtype=intType)
-        dataset.attrs["Name"] = parameterNames[q]
 
-    output.close()
+    # Find the maps to read and create the output datasets.
+    with profile.stage("setup"):
+        runs = None
+        manifest = None
+        if incremental:
+            manifest = read_manifest(outputFile)
+            runs, sizes, mtimes = get_incremental_runs(mapFiles, listedRuns, manifest)
 
-def loadMap(mapFile,gridDimension,indices,gridData):
-    "Read individual cooling map ascii file and fill data arrays."
-
-    f = open(mapFile,'r')
-    lines = f.readlines()
-    f.close()
-
-    t = []
-    h = []
-    c = []
-    m = []
-
-    for line in lines:
-        line.strip()
-        if line[0] != '#':
-            onLine = line.split()
-            t.append(float(onLine[0]))
-            h.append(float(onLine[1]))
-            c.append(float(onLine[2]))
-            m.append(float(onLine[3]))
-
-    if len(gridData) == 0:
-        myDims = copy.deepcopy(gridDimension)
-        myDims.append(len(t))
-        gridData.append(np.array(t))
-        gridData.append(np.zeros(shape=myDims))
-        gridData.append(np.zeros(shape=myDims))
-        gridData.append(np.zeros(shape=myDims))
-
-    gridData[1][tuple(indices)][:] = h
-    gridData[2][tuple(indices)][:] = c
-    gridData[3][tuple(indices)][:] = m
+        # Add new and changed maps to an existing file.
+        if manifest is not None:
+            output = h5py.File(outputFile,'r+')
+            mapShapes = manifest["map_shape"]
+
+        else:
+            if runs is not None and not runs.any():
+                raise RuntimeError("No map files found for %s." % runFile)
+            firstRun = 0 if runs is None else int(np.argmax(runs))
+            firstMap = load_map(mapFiles[firstRun][0])[0]
+            temperature = firstMap[:, 0]
+            mapShapes = [firstMap.shape]
+
+            shape = gridDimension+[temperature.size]
+            options = get_dataset_options(shape,floatType,native_endian=native_endian,
+                                          chunks=chunks,compression=compression,
+                                          shuffle=shuffle)
+
+            # Write out hdf5 file.
+            output = h5py.File(outputFile,'w')
+
+            # Create datasets with their final shape.
+            for q, name in enumerate(names):
+                if q == 0:
+                    dataset = output.create_dataset(name,data=temperature,
+                                                    dtype=options["dtype"])
+                else:
+                    dataset = output.create_dataset(name,shape=shape,**options)
+                dataset.attrs["Dimension"] = np.array(dataset.shape,dtype=intType)
+                dataset.attrs["Rank"] = np.array(len(dataset.shape),dtype=intType)
+
+            # Write loop parameter values.
+            for q,values in enumerate(parameterValues):
+                values = np.array(values,dtype=float)
+                name = "Parameter%d" % (q+1)
+                dataset = output.create_dataset(name,data=values,dtype=options["dtype"])
+                dataset.attrs["Dimension"] = np.array(values.shape,dtype=intType)
+                dataset.attrs["Name"] = parameterNames[q]
+
+    # Read in data files and write each block of maps.
+    def write_block(slab, blocks):
+        for q, name in enumerate(names[1:]):
+            output[name][slab] = blocks[0][..., q+1]
+
+    failed = load_map_grid(mapFiles, gridDimension, write_block,
+                           jobs=jobs, buffer_size=buffer_size,
+                           strict=not incremental, runs=runs,
+                           map_shapes=mapShapes, profile=profile)
+    with profile.stage("write"):
+        if incremental:
+            write_manifest(output, runs, failed, sizes, mtimes, mapShapes,
+                           manifest=manifest)
+
+        output.close()
 
 def graft_cooling_tables(input_lt,input_ht,outputFile,
                          data_fields=['Heating','Cooling','MMW'],
-                         extra_field="metal free electron fraction"):
+                         extra_field="metal free electron fraction",
+                         native_endian=False,chunks=None,compression=None,
+                         shuffle=False):
     """
     Attach low temperature and high temperature cooling grids.  The high 
     temperature grid will have one less dimension than the low temperature 
     grid, so duplicate data will be made in one dimension.  Fixed electron 
     fractions are used to make the low temperature data, but not the high 
-    temperature data, as this causes errors in Cloudy.
+    temperature data, as this causes errors in Cloudy.  The native_endian, 
+    chunks, compression, and shuffle options set the layout of the grafted 
+    tables as in convert_cooling_tables.
     """
 
     # Open low temperature data and find dimension of the field not in the 
     # high temperature data.
 
-    extra_dim = -1
-    data_lt = {}
-
-    input = h5py.File(input_lt,'r')
     print ("Reading file: %s." % input_lt)
-    for dataset in input.listnames():
-        data_lt[dataset] = input[dataset].value
-    attributes_lt = get_attributes(input)
-    input.close()
+    input = h5py.File(input_lt,'r')
+    datasets = [name for name in input if isinstance(input[name],h5py.Dataset)]
+    attributes_lt = get_attributes(input,datasets=datasets)
 
-    for dim in range(len(data_lt[data_fields[0]].shape)-1):
+    extra_dim = -1
+    for dim in range(len(input[data_fields[0]].shape)-1):
         name = "Parameter%d" % (dim+1)
         if attributes_lt[name]["Name"]['value'] == extra_field:
             extra_dim = dim
     if extra_dim < 0:
         print ("Field, %s, not found in %s." % (extra_field,input_lt))
+        input.close()
         return None
 
-    # Open high temperature data and create duplicate data in 
-    # electron fraction dimension.
-
-    data_ht = {}
-    input = h5py.File(input_ht,'r')
     print ("Reading file: %s." % input_ht)
-    for dataset in input.listnames():
-        data_ht[dataset] = input[dataset].value
-    attributes_ht = get_attributes(input)
-    input.close()
-
-    print ("Combining datasets.")
-
-    data_ht_new = {}
-    for dataset in data_fields:
-        data_ht_new[dataset] = add_grid_dimension(data_ht[dataset],extra_dim,
-                                                  (data_lt[dataset].shape)[extra_dim])
+    input_high = h5py.File(input_ht,'r')
 
     # Remove redundant temperature point.
-    redundant_point = False
-    if data_lt['Temperature'][-1] == data_ht['Temperature'][0]:
-        redundant_point = True
-
-    if redundant_point:
-        data_lt['Temperature'] = np.concatenate((data_lt['Temperature'],data_ht['Temperature'][1:]))
+    temperature_lt = input['Temperature'][()]
+    temperature_ht = input_high['Temperature'][()]
+    if temperature_lt[-1] == temperature_ht[0]:
+        first_ht = 1
     else:
-        data_lt['Temperature'] = np.concatenate((data_lt['Temperature'],data_ht['Temperature']))
-
-    attributes_lt['Temperature']["Dimension"]['value'][0] = data_lt['Temperature'].size
-    del data_ht
+        first_ht = 0
+    temperature = np.concatenate((temperature_lt,temperature_ht[first_ht:]))
 
     # Change dimension attribute.
+    attributes_lt['Temperature']["Dimension"]['value'][0] = temperature.size
     for dataset in data_fields:
-        attributes_lt[dataset]["Dimension"]['value'][-1] = data_lt['Temperature'].size
+        attributes_lt[dataset]["Dimension"]['value'][-1] = temperature.size
 
-    # Concatenate datasets.
-    for dataset in data_fields:
-        if redundant_point:
-            data_ht_copy = data_ht_new[dataset]
-            data_ht_copy = np.rollaxis(data_ht_copy,(len(data_ht_copy.shape)-1),0)
-            data_ht_copy = data_ht_copy[1:]
-            data_ht_copy = np.rollaxis(data_ht_copy,0,len(data_ht_copy.shape))
-        else:
-            data_ht_copy = data_ht_new[dataset]
-
-        data_lt[dataset] = np.concatenate((data_lt[dataset],data_ht_copy),axis=-1)
-
-    # Write new dataset.
     print ("Writing file: %s." % outputFile)
     output = h5py.File(outputFile,'w')
-    for dataset in data_lt.keys():
-        output.create_dataset(dataset,data=data_lt[dataset])
+
+    for dataset in datasets:
+        if dataset == 'Temperature':
+            data = temperature
+        elif dataset in data_fields:
+            continue
+        else:
+            data = input[dataset][()]
+        options = get_dataset_options(data.shape,data.dtype,native_endian=native_endian,
+                                      chunks=chunks,compression=compression,
+                                      shuffle=shuffle)
+        if len(data.shape) < 2:
+            options = {"dtype": options["dtype"]}
+        output.create_dataset(dataset,data=data,**options)
+
+    # Write each data field one slab of the extra dimension at a time.  The 
+    # high temperature data is the same for every slab, so it is read once 
+    # and reused rather than duplicated along the extra dimension.
+    print ("Combining datasets.")
+    for dataset in data_fields:
+        grid_lt = input[dataset]
+        grid_ht = input_high[dataset][..., first_ht:]
+        expected = grid_lt.shape[:extra_dim] + grid_lt.shape[extra_dim+1:-1]
+        if grid_ht.shape[:-1] != expected:
+            output.close()
+            raise RuntimeError("Grid of %s in %s has shape %s, expected %s." %
+                               (dataset,input_ht,grid_ht.shape[:-1],expected))
+
+        shape = grid_lt.shape[:-1] + (temperature.size,)
+        options = get_dataset_options(shape,grid_lt.dtype,native_endian=native_endian,
+                                      chunks=chunks,compression=compression,
+                                      shuffle=shuffle)
+        output.create_dataset(dataset,shape=shape,**options)
+
+        for i in range(shape[extra_dim]):
+            slab = (slice(None),) * extra_dim + (i,)
+            output[dataset][slab] = np.concatenate((grid_lt[slab],grid_ht),axis=-1)
+
     write_attributes(output,attributes_lt)
     output.close()
+    input.close()
+    input_high.close()
 
 def add_grid_dimension(grid,dimension,size):
     "Add a dimension to the grid with duplicate data."
@@ -244,29 +263,324 @@ def add_grid_dimension(grid,dimension,size):
 
     return newGrid
 
-def zero_dataset(input_file,data_fields=['Heating','MMW'],output_file=None):
-    "Set all values in a dataset to zero."
-
-    if output_file is None:
-        output_file = input_file
+def zero_dataset(input_file,data_fields=['Heating','MMW'],output_file=None,
+                 native_endian=False,chunks=None,compression=None,shuffle=False):
+    """
+    Set all values in a dataset to zero.  If output_file is None, the 
+    datasets are overwritten in place one slab at a time and the rest of 
+    the file is left untouched.  Otherwise, the zeroed datasets are created 
+    in output_file and everything else is copied there.  The native_endian, 
+    chunks, compression, and shuffle options set the layout of the grid 
+    datasets in output_file as in convert_cooling_tables.
+    """
 
-    data = {}
+    changeLayout = native_endian or chunks is not None or \
+      compression is not None or shuffle
+
+    if output_file is None or output_file == input_file:
+        if changeLayout:
+            raise RuntimeError("Changing the layout of %s requires an output_file." %
+                               input_file)
+
+        print ("Writing file: %s." % input_file)
+        output = h5py.File(input_file,'r+')
+        for dataset in data_fields:
+            print ("Setting %s to zero." % dataset)
+            grid = output[dataset]
+            slabs = get_slabs(grid.shape,grid.dtype.itemsize,chunks=grid.chunks)
+            zeros = np.zeros((slabs[0].stop,)+grid.shape[1:],dtype=grid.dtype)
+            for slab in slabs:
+                grid[slab] = zeros[:slab.stop-slab.start]
+        output.close()
+        return
 
     print ("Reading file: %s." % input_file)
     input = h5py.File(input_file,'r')
-    for dataset in input.keys():
-        data[dataset] = input[dataset].value
-    attributes = get_attributes(input)
+
+    print ("Writing file: %s." % output_file)
+    output = h5py.File(output_file,'w')
+    for dataset in input:
+        source = input[dataset]
+        if dataset not in data_fields and \
+          (not changeLayout or not isinstance(source,h5py.Dataset) or
+           len(source.shape) == 0):
+            input.copy(source,output,name=dataset)
+            continue
+
+        options = get_dataset_options(source.shape,source.dtype,native_endian=native_endian,
+                                      chunks=chunks,compression=compression,
+                                      shuffle=shuffle)
+        if len(source.shape) < 2:
+            options = {"dtype": options["dtype"]}
+
+        # Unwritten data takes the fill value, so zeroed datasets are 
+        # only created.
+        if dataset in data_fields:
+            print ("Setting %s to zero." % dataset)
+            output.create_dataset(dataset,shape=source.shape,fillvalue=0,**options)
+        else:
+            output.create_dataset(dataset,shape=source.shape,**options)
+            for slab in get_slabs(source.shape,source.dtype.itemsize,
+                                  chunks=output[dataset].chunks):
+                output[dataset][slab] = source[slab]
+        write_attributes(output,get_attributes(input,datasets=[dataset]))
+
+    output.close()
     input.close()
 
+# Input files opened by each subtraction worker process.
+_subtract_inputs = None
+
+def _init_subtract_worker(input_files):
+    "Open the subtraction inputs once in a worker process."
+    global _subtract_inputs
+    _subtract_inputs = [h5py.File(input_file,'r') for input_file in input_files]
+
+def _subtract_slab(inputs,slab,data_fields,small_axes,t_index):
+    """
+    Subtract one slab of the grid.  Return the slab and the
+    subtracted data of each field.
+    """
+
+    full, small = inputs
+    fullData = np.array([full[dataset][slab] for dataset in data_fields])
+
+    # Read the matching part of the small grid and broadcast it over
+    # the loop parameters it does not have.
+    selection = tuple([slab if axis == 0 else slice(None) for axis in small_axes])
+    order = list(np.argsort(small_axes))
+    shape = [fullData.shape[axis+1] if axis in small_axes else 1
+             for axis in range(fullData.ndim-2)]
+    smallData = []
     for dataset in data_fields:
-        print ("Setting %s to zero." % dataset)
-        data[dataset][:] = 0.0
+        data = small[dataset][selection][..., np.clip(t_index,0,None)]
+        data = data.transpose(order+[len(order)])
+        smallData.append(data.reshape(shape+[t_index.size]))
+    smallData = np.broadcast_to(np.array(smallData),fullData.shape)
+
+    # Rows that are zero in every field are gaps, as in the maps read
+    # by subtract_cooling_lite.pl, and so are temperatures missing from
+    # the small grid.
+    gaps = (fullData == 0).all(axis=0) | (smallData == 0).all(axis=0) | \
+      (t_index < 0)
+
+    results = []
+    for i, dataset in enumerate(data_fields):
+        data = fullData[i] - smallData[i]
+        # Without the components, negative totals are set to zero.
+        if dataset in ['Heating','Cooling']:
+            data = np.clip(data,0,None)
+        data[gaps] = 0
+        results.append(data)
+    return slab, results
+
+def _subtract_slab_worker(task):
+    "Subtract one slab of the grid in a worker process."
+    return _subtract_slab(_subtract_inputs,*task)
+
+def subtract_cooling_tables(input_full,input_small,outputFile,
+                            data_fields=['Heating','Cooling','MMW'],
+                            jobs=1,max_size=64,native_endian=False,chunks=None,
+                            compression=None,shuffle=False):
+    """
+    Make approximate metal-only cooling tables by subtracting a
+    converted grid made without metals (input_small) from one with all
+    elements (input_full).  The small grid may have fewer loop
+    parameters than the full grid, e.g., no metallicity, in which case
+    it is used for every value of the missing parameters.  Parameters
+    are matched by name and must have the same values.
+
+    This is an approximation of subtract_cooling_lite.pl.  That script
+    reads the cooling and heating components of each map (the
+    .cooling and .heating files) and sums only the positive components
+    that are not in the small grid, leaving out CT C and hvFB.  The
+    converted tables only hold the totals, so here the small grid is
+    subtracted from the full one and negative heating and cooling
+    differences are set to zero.  Changes in the hydrogen and helium
+    cooling between the two grids therefore end up in the metal
+    cooling and can cancel some of it.  Use subtract_cooling_lite.pl
+    on the maps where the component files are available.  Rows that
+    are zero in every field of either grid, e.g., those filled by
+    find_map_zeroes.pl, and temperatures missing from the small grid
+    are set to zero.
+
+    The grid is read and written max_size MB at a time and slabs are
+    subtracted by jobs processes.  The native_endian, chunks,
+    compression, and shuffle options set the layout of the subtracted
+    tables as in convert_cooling_tables.
+    """
 
+    print ("Reading file: %s." % input_full)
+    full = h5py.File(input_full,'r')
+    print ("Reading file: %s." % input_small)
+    small = h5py.File(input_small,'r')
+
+    def get_parameters(input):
+        rank = len(input[data_fields[0]].shape)-1
+        return [(input["Parameter%d" % (q+1)].attrs["Name"],
+                 input["Parameter%d" % (q+1)][()]) for q in range(rank)]
+
+    fullParameters = get_parameters(full)
+    fullNames = [name for name, values in fullParameters]
+    smallAxes = []
+    for name, values in get_parameters(small):
+        if name not in fullNames:
+            full.close()
+            small.close()
+            raise RuntimeError("%s has loop parameter %s and %s does not." %
+                               (input_small,name,input_full))
+        axis = fullNames.index(name)
+        fullValues = fullParameters[axis][1]
+        if values.shape != fullValues.shape or not np.allclose(values,fullValues):
+            full.close()
+            small.close()
+            raise RuntimeError("Values of %s differ between %s and %s." %
+                               (name,input_full,input_small))
+        smallAxes.append(axis)
+
+    # Index of each temperature of the full grid in the small grid.
+    temperature = full['Temperature'][()]
+    temperatureSmall = small['Temperature'][()]
+    match = np.isclose(temperature[:,None],temperatureSmall[None,:],rtol=1e-6,atol=0)
+    tIndex = np.where(match.any(axis=1),match.argmax(axis=1),-1)
+    if (tIndex < 0).any():
+        print ("%d temperatures of %s are not in %s and will be zero." %
+               ((tIndex < 0).sum(),input_full,input_small))
+
+    print ("Writing file: %s." % outputFile)
+    output = h5py.File(outputFile,'w')
+    shape = full[data_fields[0]].shape
+    for dataset in full:
+        if dataset not in data_fields:
+            full.copy(full[dataset],output,name=dataset)
+            continue
+        options = get_dataset_options(shape,full[dataset].dtype,native_endian=native_endian,
+                                      chunks=chunks,compression=compression,
+                                      shuffle=shuffle)
+        output.create_dataset(dataset,shape=shape,**options)
+        write_attributes(output,get_attributes(full,datasets=[dataset]))
+
+    slabs = get_slabs(shape,full[data_fields[0]].dtype.itemsize*len(data_fields),
+                      chunks=output[data_fields[0]].chunks,max_size=max_size)
+    tasks = [(slab,data_fields,smallAxes,tIndex) for slab in slabs]
+
+    def write_slab(slab, results):
+        for dataset, data in zip(data_fields,results):
+            output[dataset][slab] = data
+
+    print ("Subtracting %s in %d slabs." % (", ".join(data_fields),len(slabs)))
+    if jobs > 1:
+        full.close()
+        small.close()
+        # Keep at most two slabs per process in flight so that memory
+        # does not grow with the size of the grid.
+        pool = multiprocessing.Pool(jobs,initializer=_init_subtract_worker,
+                                    initargs=([input_full,input_small],))
+        pending = deque()
+        try:
+            for task in tasks:
+                if len(pending) >= 2*jobs:
+                    write_slab(*pending.popleft().get())
+                pending.append(pool.apply_async(_subtract_slab_worker,(task,)))
+            while pending:
+                write_slab(*pending.popleft().get())
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            write_slab(*_subtract_slab([full,small],*task))
+        full.close()
+        small.close()
 
-    print ("Writing file: %s." % output_file)
-    output = h5py.File(output_file,'w')
-    for dataset in data.keys():
-        output.create_dataset(dataset,data=data[dataset])
-    write_attributes(output,attributes)
     output.close()
+
+class CoolingTable(object):
+    """
+    Interpolate the tables written by convert_cooling_tables.
+
+    The tables and their axes are read once.  Points are given by the
+    values of each loop parameter, in the units of the Parameter%d
+    datasets, followed by log10 of the temperature.  Table values are
+    interpolated linearly between grid points.
+
+    Parameters
+    ----------
+    filename : string
+        HDF5 file written by convert_cooling_tables.
+    fields : optional, list
+        Tables to read.
+        Default: ["Heating", "Cooling", "MMW"].
+    batch_size : optional, int
+        Number of points interpolated at once, which bounds the
+        memory used for temporary arrays.
+        Default: 2**20.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import CoolingTable
+    >>> table = CoolingTable("cooling.h5")
+    >>> table.parameter_names
+    ['hden', 'redshift']
+    >>> cooling = table("Cooling", log_nH, redshift, np.log10(T), clamp=True)
+
+    """
+
+    def __init__(self, filename, fields=None, batch_size=2**20):
+        if fields is None:
+            fields = ["Heating", "Cooling", "MMW"]
+        self.batch_size = batch_size
+
+        input = h5py.File(filename,'r')
+        self.parameter_names = []
+        axes = []
+        for dim in range(len(input[fields[0]].shape)-1):
+            dataset = input["Parameter%d" % (dim+1)]
+            self.parameter_names.append(dataset.attrs["Name"])
+            axes.append(dataset[()])
+        self.temperature = input["Temperature"][()]
+        axes.append(np.log10(self.temperature))
+
+        self.tables = {}
+        for field in fields:
+            self.tables[field] = \
+              np.ascontiguousarray(input[field][()], dtype=np.float64).ravel()
+        input.close()
+
+        self.grid = GridInterpolator(axes)
+        self.axes = self.grid.axes
+
+    def interpolate(self, coordinates, fields=None, clamp=False):
+        """
+        Interpolate several tables at a set of points.
+
+        Parameters
+        ----------
+        coordinates : list of arrays
+            Values of each loop parameter and log10 of the
+            temperature.  Arrays are broadcast against each other.
+        fields : optional, list
+            Tables to interpolate.  If None, use all tables read.
+            Default: None.
+        clamp : optional, bool
+            If True, points outside of the grid take the value at the
+            nearest edge.  Otherwise, they raise an error.
+            Default: False.
+
+        Returns
+        -------
+        A dictionary of interpolated values for each field, with the
+        broadcast shape of the coordinates.
+        """
+
+        if fields is None:
+            fields = list(self.tables.keys())
+        results = self.grid.interpolate([self.tables[field] for field in fields],
+                                        coordinates, clamp=clamp,
+                                        batch_size=self.batch_size)
+        return dict(zip(fields, results))
+
+    def __call__(self, field, *coordinates, **kwargs):
+        "Interpolate one table, see interpolate."
+        return self.interpolate(coordinates, fields=[field], **kwargs)[field]
@@ -1,16 +1,30 @@
 import h5py
 import numpy as np
-import re
-import copy
 
-from cloudy_grids.utilities import get_grid_indices
+from cloudy_grids.utilities import \
+     read_run_file, \
+     load_map, \
+     load_map_grid, \
+     read_manifest, \
+     get_incremental_runs, \
+     write_manifest, \
+     get_dataset_options, \
+     get_slabs, \
+     par_names, \
+     get_energy_axis, \
+     get_parameter_names
+from cloudy_grids.profiling import \
+     get_profile
+from cloudy_grids.interpolation import \
+     GridInterpolator
 
 floatType = '>f8'
 intType = '>i8'
 
-par_names = {'Parameter1': 'log_nH'}
-
-def convert_emissivity_tables(runFile, outputFile):
+def convert_emissivity_tables(runFile, outputFile, jobs=1, buffer_size=None,
+                              incremental=False, native_endian=False,
+                              chunks=None, compression=None, shuffle=False,
+                              cumulative=False, profile=None):
     """
     Convert ascii emissivity tables to hdf5.
 
@@ -20,6 +34,42 @@ def convert_emissivity_tables(runFile, outputFile):
         Path to the input file ending in .run.
     output_file : string
         HDF5 output file name.
+    jobs : optional, int
+        Number of processes used to read the map files.
+        Default: 1.
+    buffer_size : optional, float
+        If set, stream the maps to the output file through a buffer
+        of at most this many MB instead of holding the whole grid
+        in memory.
+        Default: None.
+    incremental : optional, bool
+        If True, keep a manifest of ingested maps in the output file
+        and, if the file already has one, only read maps that are
+        new or have changed since.  The run file may be incomplete.
+        Default: False.
+    native_endian : optional, bool
+        If True, store the tables in the byte order of this machine
+        instead of big-endian.
+        Default: False.
+    chunks : optional, bool or tuple
+        Chunk shape of the tables.  If True, use a shape that keeps
+        each temperature row contiguous.
+        Default: None.
+    compression : optional, string or int
+        Compression filter for the tables, either 'gzip', 'lzf', or
+        a gzip level.
+        Default: None.
+    shuffle : optional, bool
+        If True, apply the shuffle filter before compression.
+        Default: False.
+    cumulative : optional, bool
+        If True, also store the cumulative integral over energy used
+        for band queries, see add_cumulative_emissivity.
+        Default: False.
+    profile : optional, ConversionProfile
+        If given, record the time and memory of each stage of the
+        conversion.  See ConversionProfile.
+        Default: None.
 
     Examples
     --------
@@ -30,116 +80,226 @@ def convert_emissivity_tables(runFile, outputFile):
     """
 
     print ("Converting from %s to %s." % (runFile, outputFile))
+    profile = get_profile(profile)
 
-    if runFile[-4:] == '.run':
-        prefix = runFile[0:-4]
-    else:
-        print ("Run file needs to end in .run.")
-        exit(1)
-
-    f = open(runFile,'r')
-    lines = f.readlines()
-    f.close()
-
-    # Values of loop parameters.
-    parameterValues = []
-    parameterNames = []
-
-    getParameterValues = False
-    getRunValues = False
-
-    re_parValue = re.compile('^\# Loop commands and values:')
-    re_runValue = re.compile('^\#run')
-
-    totalRuns = 0
-
-    for q,line in enumerate(lines):
-        line = line.strip()
-        if getParameterValues:
-            if line == '#':
-                getParameterValues = False
-            else:
-                (par,values) = line.split(': ')
-                if values.count(';') == 2 and \
-                  values.startswith('(') and values.endswith(')'):
-                    fs, fe, fi = [float(v) for v in values[1:-1].split(';')]
-                    floatValues = np.arange(fs, fe+fi/2, fi)
-                else:
-                    floatValues = [float(val) for val in values.split()]
-                parameterValues.append(floatValues)
-                parameterNames.append(par[2:])
-        elif getRunValues:
-            totalRuns = len(lines) - q
-            break
-        else:
-            if (re_parValue.match(line) is not None):
-                getParameterValues = True
-            elif (re_runValue.match(line) is not None):
-                getRunValues = True
-
-    # Check file line number against product of parameter numbers.
+    with profile.stage("read_run_file"):
+        prefix, parameterNames, parameterValues, listedRuns = \
+          read_run_file(runFile, complete=not incremental)
     gridDimension = [len(q) for q in parameterValues]
-    if totalRuns != np.prod(gridDimension):
-        raise RuntimeError(
-            "Error: total runs (%d) in run file not equal to product of parameters(%d)." % 
-            (totalRuns, np.prod(gridDimension)))
-
-    # Read in data files.
-    gridData = []
-    for q in range(totalRuns):
-        mapFile = "%s_run%d.dat" % (prefix, (q+1))
-        indices = get_grid_indices(gridDimension,q)
-        loadMap(mapFile,gridDimension,indices,gridData)
-
-    ienergy = parameterNames.index("energy")
-    energy = parameterValues.pop(ienergy)
-
-    temperature = gridData.pop(0)
-    emissivity = gridData.pop(0)
-
-    # Write out hdf5 file.
-    output = h5py.File(outputFile,'w')
-    
-    # Write data.
+    gridRuns = int(np.prod(gridDimension))
+
+    mapFiles = [["%s_run%d.dat" % (prefix, (q+1))] for q in range(gridRuns)]
     dataset = "Emissivity"
-    output.create_dataset(dataset, data=emissivity,dtype=floatType)
-    output[dataset].attrs['log_T'] = \
-      np.log10(temperature, dtype=floatType)
-    output[dataset].attrs['log_E'] = \
-      np.log10(energy, dtype=floatType)
-
-    # Write loop parameter values.
-    for q,values in enumerate(parameterValues):
-        name = "Parameter%d" % (q+1)
-        if name in par_names:
-            name = par_names[name]
-        output[dataset].attrs[name] = np.array(values, dtype=floatType)
+
+    # Find the maps to read and create the output datasets.
+    with profile.stage("setup"):
+        runs = None
+        manifest = None
+        if incremental:
+            manifest = read_manifest(outputFile)
+            runs, sizes, mtimes = get_incremental_runs(mapFiles, listedRuns, manifest)
+
+        # Add new and changed maps to an existing file.
+        if manifest is not None:
+            output = h5py.File(outputFile,'r+')
+            mapShapes = manifest["map_shape"]
+            mapShape = list(output[dataset].shape[len(gridDimension):])
+
+        else:
+            if runs is not None and not runs.any():
+                raise RuntimeError("No map files found for %s." % runFile)
+            firstRun = 0 if runs is None else int(np.argmax(runs))
+            firstMap = load_map(mapFiles[firstRun][0])[0]
+            temperature = firstMap[:, 0]
+            mapShape = list(np.squeeze(firstMap[:, 1:]).shape)
+            mapShapes = [firstMap.shape]
+
+            ienergy = parameterNames.index("energy")
+            energy = parameterValues.pop(ienergy)
+
+            shape = gridDimension+mapShape
+            options = get_dataset_options(shape, floatType,
+                                          native_endian=native_endian,
+                                          chunks=chunks, compression=compression,
+                                          shuffle=shuffle)
+            dtype = options["dtype"]
+
+            # Write out hdf5 file.
+            output = h5py.File(outputFile,'w')
+
+            # Create dataset with its final shape.
+            output.create_dataset(dataset, shape=shape, **options)
+            output[dataset].attrs['log_T'] = \
+              np.log10(temperature).astype(dtype)
+            output[dataset].attrs['log_E'] = \
+              np.log10(energy).astype(dtype)
+            output[dataset].attrs['energy_axis'] = np.array(ienergy, dtype=intType)
+
+            # Write loop parameter values.
+            for q,values in enumerate(parameterValues):
+                name = "Parameter%d" % (q+1)
+                if name in par_names:
+                    name = par_names[name]
+                output[dataset].attrs[name] = np.array(values, dtype=dtype)
+
+    # Read in data files and write each block of maps.
+    def write_block(slab, blocks):
+        emissivity = blocks[0][..., 1:]
+        output[dataset][slab] = \
+          emissivity.reshape(list(emissivity.shape[:-2]) + mapShape)
+
+    failed = load_map_grid(mapFiles, gridDimension, write_block,
+                           jobs=jobs, buffer_size=buffer_size,
+                           strict=not incremental, runs=runs,
+                           map_shapes=mapShapes, profile=profile)
+    with profile.stage("write"):
+        if incremental:
+            write_manifest(output, runs, failed, sizes, mtimes, mapShapes,
+                           manifest=manifest)
+
+        output.close()
+
+    if cumulative:
+        with profile.stage("cumulative"):
+            add_cumulative_emissivity(outputFile)
+
+def add_cumulative_emissivity(filename):
+    """
+    Store the cumulative integral of the emissivity over energy.
+
+    The Cumulative_Emissivity dataset has the axes of Emissivity, with
+    the energy axis moved last, and holds at each energy the
+    trapezoidal integral of the emissivity over linear energy from
+    the lowest energy up to that one.  The emissivity of any band is
+    then the difference of two values, see EmissivityTable.  It has
+    the units of the emissivity times those of the energy.  The
+    dataset is written one slab at a time with the data type and
+    filters of Emissivity.
+
+    Parameters
+    ----------
+    filename : string
+        HDF5 file written by convert_emissivity_tables.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import add_cumulative_emissivity
+    >>> add_cumulative_emissivity("emissivity.h5")
+
+    """
+
+    print ("Integrating emissivity over energy in %s." % filename)
+
+    output = h5py.File(filename,'r+')
+    source = output["Emissivity"]
+    ienergy = get_energy_axis(source)
+    energy = 10**source.attrs['log_E'].astype(np.float64)
+    dE = np.diff(energy)
+
+    shape = list(source.shape)
+    shape.append(shape.pop(ienergy))
+    name = "Cumulative_Emissivity"
+    if name in output and output[name].shape != tuple(shape):
+        del output[name]
+    if name not in output:
+        output.create_dataset(name, shape=shape, dtype=source.dtype,
+                              chunks=True if source.chunks else None,
+                              compression=source.compression,
+                              compression_opts=source.compression_opts,
+                              shuffle=source.shuffle)
+    cumulative = output[name]
+    for attr in source.attrs:
+        cumulative.attrs[attr] = source.attrs[attr]
+    cumulative.attrs['energy_axis'] = np.array(len(shape)-1, dtype=intType)
+
+    # Integrate slabs along an axis other than energy.
+    axis = 0 if ienergy > 0 else 1
+    outAxis = axis if axis < ienergy else axis-1
+    slabShape = [source.shape[axis]] + [size for i, size in enumerate(source.shape)
+                                        if i != axis]
+    for slab in get_slabs(slabShape, source.dtype.itemsize):
+        data = source[(slice(None),)*axis + (slab,)].astype(np.float64)
+        data = np.moveaxis(data, ienergy, -1)
+        integral = np.zeros(data.shape)
+        np.cumsum(0.5 * (data[..., 1:] + data[..., :-1]) * dE, axis=-1,
+                  out=integral[..., 1:])
+        cumulative[(slice(None),)*outAxis + (slab,)] = integral
 
     output.close()
 
-def loadMap(mapFile,gridDimension,indices,gridData):
-    "Read individual cooling map ascii file and fill data arrays."
+class EmissivityTable(object):
+    """
+    Compute band emissivities from the cumulative integrals stored by
+    add_cumulative_emissivity.
+
+    The emissivity of a band [e_min, e_max] is the difference of the
+    cumulative integral interpolated at the two energies, so the
+    spectral axis is never integrated at query time.  Points are given
+    by the values of each loop parameter other than energy, as in
+    parameter_names, followed by log10 of the temperature.
+
+    Parameters
+    ----------
+    filename : string
+        HDF5 file with a Cumulative_Emissivity dataset.
+    batch_size : optional, int
+        Number of points interpolated at once, which bounds the
+        memory used for temporary arrays.
+        Default: 2**20.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import EmissivityTable
+    >>> table = EmissivityTable("emissivity.h5")
+    >>> table.parameter_names
+    ['log_nH']
+    >>> soft = table.band(log_nH, log_T, 0.5, 2.0)
+    >>> bands = table.band(log_nH, log_T, [[0.5], [2.0]], [[2.0], [10.0]])
+
+    """
+
+    def __init__(self, filename, batch_size=2**20):
+        self.batch_size = batch_size
 
-    f = open(mapFile,'r')
-    lines = f.readlines()
-    f.close()
+        input = h5py.File(filename,'r')
+        if "Cumulative_Emissivity" not in input:
+            input.close()
+            raise RuntimeError("%s has no Cumulative_Emissivity, "
+                               "run add_cumulative_emissivity first." % filename)
+        dataset = input["Cumulative_Emissivity"]
+        self.parameter_names = get_parameter_names(dataset)
+        axes = [dataset.attrs[name] for name in self.parameter_names]
+        axes.append(dataset.attrs['log_T'])
+        self.energy = 10**dataset.attrs['log_E'].astype(np.float64)
+        axes.append(self.energy)
+        self.table = np.ascontiguousarray(dataset[()], dtype=np.float64).ravel()
+        input.close()
 
-    t = []
-    emissivity = []
+        self.grid = GridInterpolator(axes)
+        self.axes = self.grid.axes
 
-    for line in lines:
-        line.strip()
-        if not line.startswith("#"):
-            onLine = line.split()
-            t.append(float(onLine.pop(0)))
-            emissivity.append([float(val) for val in onLine])
+    def band(self, *coordinates, clamp=False):
+        """
+        Return the emissivity integrated between two energies.
 
-    emissivity = np.squeeze(emissivity)
-    
-    if len(gridData) == 0:
-        myDims = copy.deepcopy(gridDimension)
-        myDims.extend(emissivity.shape)
-        gridData.append(np.array(t))
-        gridData.append(np.zeros(shape=myDims))
+        Parameters
+        ----------
+        coordinates : arrays
+            Values of each loop parameter other than energy, log10 of
+            the temperature, and the lower and upper energies of the
+            band.  Arrays are broadcast against each other.
+        clamp : optional, bool
+            If True, points and energies outside of the grid take the
+            value at the nearest edge.  Otherwise, they raise an error.
+            Default: False.
+        """
 
-    gridData[-1][tuple(indices)][:] = emissivity
+        lower = list(coordinates[:-1])
+        upper = list(coordinates[:-2]) + [coordinates[-1]]
+        high = self.grid.interpolate([self.table], upper, clamp=clamp,
+                                     batch_size=self.batch_size)[0]
+        low = self.grid.interpolate([self.table], lower, clamp=clamp,
+                                    batch_size=self.batch_size)[0]
+        return high - low
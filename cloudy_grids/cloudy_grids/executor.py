@@ -0,0 +1,766 @@
+"""
+Run the Cloudy models of a CIAOLoop grid on the local machine.
+"""
+
+from collections import \
+    OrderedDict, \
+    deque
+import asyncio
+import glob
+import json
+import numpy as np
+import os
+import re
+import shlex
+import time
+
+from cloudy_grids.map_modes import \
+    MapGrid
+from cloudy_grids.profiling import \
+    format_time
+from cloudy_grids.run_cache import \
+    RunCache
+from cloudy_grids.scheduler import \
+    fit_cost_model, \
+    get_cost_order
+
+# Settings of a parameter file that are numbers.
+int_settings = ["cloudyRunMode", "runStartIndex", "saveCloudyOutputFiles",
+                "saveMinimumOutputFiles", "exitOnCrash", "test"]
+
+def _get_loop_values(values):
+    """
+    Return the values of a loop command as strings, expanding the
+    (start;end;step) form the way CIAOLoop does.
+    """
+
+    match = re.match(r'^\((-?\d*\.?\d*);(-?\d*\.?\d*);(-?\d*\.?\d*)\)', values)
+    if match is None:
+        return values.replace(",", " ").split()
+
+    start, end, step = [float(value) for value in match.groups()]
+    if step == 0 or (end - start) / step < 0:
+        raise RuntimeError("Infinite loop created by %s." % values)
+    loopValues = []
+    value = start
+    while (value <= end if start < end else value >= end):
+        loopValues.append("%.15g" % value)
+        value += step
+    return loopValues
+
+def _get_setting(line):
+    "Split a 'name = value' or 'name value' line of a parameter file."
+    if re.match(r'^\w+\s*=', line):
+        name, value = line.split("=", 1)
+    else:
+        name, value = (line.split(None, 1) + [""])[:2]
+    return name.strip(), value.strip()
+
+def read_parameter_file(parameter_file):
+    """
+    Read the settings, commands, and loops of a CIAOLoop parameter
+    file.
+
+    Returns a dict with the general settings, e.g., cloudyExe and
+    outputFilePrefix, plus "commands", the list of commands given to
+    every run, and "loops", a list with, for each loop, a list of
+    (command, values) pairs.  Loops over sets of commands have one
+    pair per command.  Commands read from files are given as
+    ("file", filename) in "commands" and as the command "file" in
+    "loops".  The lines of lineMapLine settings are listed in
+    "lineMapLines", and other mode specific settings are kept as
+    strings.
+    """
+
+    if not os.path.exists(parameter_file):
+        raise RuntimeError("Could not find parameter file: %s." % parameter_file)
+
+    settings = {"cloudyExe": "./cloudy.exe", "outputFilePrefix": None,
+                "outputDir": "./", "cloudyRunMode": 0, "runStartIndex": 1,
+                "exitOnCrash": 0, "test": 0, "commands": [], "loops": []}
+
+    with open(parameter_file, 'r') as f:
+        lines = [re.sub(r'#.*', '', line).strip() for line in f]
+
+    lines = iter(enumerate(lines))
+    for lineNumber, line in lines:
+        if not line:
+            continue
+
+        if re.match(r'^command($|[\s=])', line, re.I):
+            settings["commands"].append(_get_setting(line)[1])
+
+        elif re.match(r'^file\s+loop', line, re.I):
+            files = []
+            for pattern in line.split(None, 2)[2].replace(",", " ").split():
+                files.extend(sorted(glob.glob(pattern)))
+            if not files:
+                raise RuntimeError("No files given on line %d of %s." %
+                                   (lineNumber+1, parameter_file))
+            settings["loops"].append([("file", files)])
+
+        elif re.match(r'^file($|[\s=])', line, re.I):
+            for filename in sorted(glob.glob(_get_setting(line)[1])):
+                settings["commands"].append(("file", filename))
+
+        elif re.match(r'^loop($|[\s\[\{])', line):
+            # A set of commands looped over together.
+            if "{" in line:
+                loop = []
+                for lineNumber, line in lines:
+                    if "}" in line:
+                        break
+                    match = re.search(r'\[(.+)\](.*)', line)
+                    if match is not None:
+                        loop.append((match.group(1), _get_loop_values(match.group(2).strip())))
+                    elif line:
+                        raise RuntimeError("Improper commands inside loop set on line %d of %s." %
+                                           (lineNumber+1, parameter_file))
+                if len(set([len(values) for command, values in loop])) > 1:
+                    raise RuntimeError("Unequal number of values in loop set in %s." %
+                                       parameter_file)
+            else:
+                match = re.search(r'\[(.+)\](.*)', line)
+                if match is None or not match.group(2).strip():
+                    raise RuntimeError("No values given on line %d of %s." %
+                                       (lineNumber+1, parameter_file))
+                loop = [(match.group(1), _get_loop_values(match.group(2).strip()))]
+            settings["loops"].append(loop)
+
+        else:
+            name, value = _get_setting(line)
+            if name == "lineMapLine":
+                settings.setdefault("lineMapLines", []).append(value)
+                continue
+            if name in int_settings:
+                value = int(value)
+            elif name == "outputDir":
+                value = os.path.join(os.path.expanduser(value), "")
+            settings[name] = value
+
+    if settings["outputFilePrefix"] is None:
+        raise RuntimeError("No outputFilePrefix given in %s." % parameter_file)
+    return settings
+
+def read_run_header(run_file):
+    """
+    Read the settings, commands, and loops from the header of a
+    CIAOLoop run file, in the form returned by read_parameter_file.
+    The output directory is that of the run file.
+    """
+
+    settings = {"cloudyExe": "./cloudy.exe", "runStartIndex": 1,
+                "exitOnCrash": 0, "test": 0, "commands": [], "loops": []}
+    section = None
+    loop = None
+    with open(run_file, 'r') as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("#run"):
+                break
+            match = re.match(r'^\# (cloudyRunMode|outputFilePrefix|outputDir) = (.*)$', line)
+            if match is not None:
+                name, value = match.groups()
+                settings[name] = int(value) if name in int_settings else value
+            elif line.startswith("# Commands to be executed everytime:"):
+                section = "commands"
+            elif line.startswith("# Loop commands and values:"):
+                section = "loops"
+            elif line.strip() == "#":
+                section = None
+            elif section == "commands":
+                if line.startswith("# Commands from file: "):
+                    settings["commands"].append(("file", line.split(": ", 1)[1]))
+                else:
+                    settings["commands"].append(line[2:])
+            elif section == "loops":
+                if line.startswith("# set {"):
+                    loop = []
+                elif line.startswith("# }"):
+                    settings["loops"].append(loop)
+                    loop = None
+                elif line.startswith("# Commands from files:"):
+                    settings["loops"].append([("file", line.split(":", 1)[1].split())])
+                else:
+                    command, values = line.lstrip("#").strip().split(": ", 1)
+                    pair = (command, _get_loop_values(values))
+                    if loop is None:
+                        settings["loops"].append([pair])
+                    else:
+                        loop.append(pair)
+
+    settings["outputDir"] = os.path.join(os.path.dirname(run_file), "")
+    settings["outputFilePrefix"] = os.path.basename(run_file)[:-4]
+    return settings
+
+def get_grid_shape(settings):
+    "Return the number of values of each loop."
+    return [len(loop[0][1]) for loop in settings["loops"]]
+
+def get_grid_runs(settings):
+    """
+    Yield the run number and the index of each loop value of every
+    run of the grid, in the order run by CIAOLoop, with the last loop
+    varying fastest.
+    """
+
+    for q, index in enumerate(np.ndindex(*get_grid_shape(settings))):
+        yield q + settings["runStartIndex"], index
+
+def get_run_columns(settings):
+    "Return the name of each loop as listed in the run file."
+    columns = []
+    for loop in settings["loops"]:
+        columns.append(",".join([command for command, values in loop]))
+    return columns
+
+def get_run_line(settings, index):
+    "Return the values of one run as listed in the run file."
+    values = []
+    for loop, i in zip(settings["loops"], index):
+        values.append(",".join([str(values[i]) for command, values in loop]))
+    return "\t".join(values)
+
+def _read_command_file(filename):
+    "Return the lines of a file of Cloudy commands."
+    with open(filename, 'r') as f:
+        return [line.rstrip("\n") for line in f]
+
+def get_cloudy_input(settings, index, key_name):
+    """
+    Return the Cloudy commands of one run, as done by CIAOLoop.  A $
+    in a command is replaced with key_name, the path and prefix of
+    the output files of the run, and loop commands of the form
+    %<name> set the value of %<name> in the other commands.
+    """
+
+    commands = []
+    for command in settings["commands"]:
+        if isinstance(command, tuple):
+            commands.extend(_read_command_file(command[1]))
+        else:
+            commands.append(command)
+
+    variables = {}
+    for loop, i in zip(settings["loops"], index):
+        for command, values in loop:
+            value = str(values[i])
+            if command == "file":
+                commands.extend(_read_command_file(value))
+                continue
+            match = re.match(r'^%<(.+)>$', command)
+            if match is not None:
+                variables[match.group(1)] = value
+            elif "*" in command:
+                commands.append(command.replace("*", value, 1))
+            else:
+                commands.append("%s %s" % (command, value))
+
+    lines = []
+    for command in commands:
+        command = command.replace("$", key_name, 1)
+        for name, value in variables.items():
+            command = command.replace("%%<%s>" % name, value)
+        lines.append(command + "\n")
+    return "".join(lines)
+
+def write_run_file_header(run_file, settings):
+    "Write the header of a run file as CIAOLoop does."
+
+    lines = ["# Run started %s.\n" % time.ctime(),
+             "#\n",
+             "# cloudyRunMode = %d\n" % settings["cloudyRunMode"],
+             "# outputFilePrefix = %s\n" % settings["outputFilePrefix"],
+             "# outputDir = %s\n" % settings["outputDir"],
+             "#\n",
+             "# Commands to be executed everytime:\n"]
+    for command in settings["commands"]:
+        if isinstance(command, tuple):
+            lines.append("# Commands from file: %s\n" % command[1])
+        else:
+            lines.append("# %s\n" % command)
+    lines.append("#\n")
+    lines.append("# Loop commands and values:\n")
+
+    for loop in settings["loops"]:
+        if loop[0][0] == "file":
+            lines.append("# Commands from files: %s\n" % " ".join(loop[0][1]))
+        elif len(loop) == 1:
+            command, values = loop[0]
+            lines.append("# %s: %s\n" % (command, " ".join([str(value) for value in values])))
+        else:
+            lines.append("# set {\n")
+            for command, values in loop:
+                lines.append("#\t%s: %s\n" % (command, " ".join([str(value) for value in values])))
+            lines.append("# }\n")
+    lines.append("#\n")
+    lines.append("#run\t%s\n" % "\t".join(get_run_columns(settings)))
+
+    with open(run_file, 'w') as f:
+        f.write("".join(lines))
+
+def check_cloudy_output(output_file):
+    """
+    Check the output of a Cloudy run for a crash, as CIAOLoop does.
+    Returns True if Cloudy did not exit OK, and the list of warning
+    and caution lines.
+    """
+
+    try:
+        with open(output_file, 'r', errors="replace") as f:
+            lines = f.readlines()
+    except OSError:
+        return True, []
+    warnings = [line.strip() for line in lines
+                if line.lstrip().startswith(("W-", "C-"))]
+    crashed = not lines or "Cloudy exited OK" not in lines[-1] or \
+      "return value is 1" in lines[-1]
+    return crashed, warnings
+
+class ExecutorReport(object):
+    """
+    Start and end times of each Cloudy run of run_cloudy_grid, used
+    to measure how busy the run slots were.
+
+    Utilization is the time spent running Cloudy divided by the
+    number of slots times the wall time.  The dispatch latency is the
+    time a slot waited between the end of one run and the start of
+    the next while runs were still pending.  Runs copied from a
+    RunCache are listed in cached and count as busy for as long as
+    the copy took.
+    """
+
+    def __init__(self, jobs, run_file=None):
+        self.jobs = jobs
+        self.run_file = run_file
+        self.runs = OrderedDict()
+        self.crashed = []
+        self.cached = []
+        self.cache = None
+        self.dispatch_latency = 0.
+        self._start = time.perf_counter()
+        self._end = None
+
+    def add_run(self, run, slot, start, end, crashed, cached=False):
+        "Record one finished run, with times from time.perf_counter."
+        self.runs[run] = (slot, start - self._start, end - self._start)
+        if crashed:
+            self.crashed.append(run)
+        if cached:
+            self.cached.append(run)
+
+    def finish(self):
+        "Stop the wall clock."
+        self._end = time.perf_counter()
+
+    @property
+    def wall_time(self):
+        end = time.perf_counter() if self._end is None else self._end
+        return end - self._start
+
+    @property
+    def busy_time(self):
+        return sum([end - start for slot, start, end in self.runs.values()])
+
+    @property
+    def utilization(self):
+        if self.wall_time <= 0:
+            return 0.
+        return self.busy_time / (self.jobs * self.wall_time)
+
+    def to_dict(self):
+        "Return the report as a dict."
+        return OrderedDict(
+            [("run_file", self.run_file),
+             ("jobs", self.jobs),
+             ("runs", len(self.runs)),
+             ("crashed", self.crashed),
+             ("cached", self.cached),
+             ("cache", None if self.cache is None else self.cache.to_dict()),
+             ("wall_time", self.wall_time),
+             ("busy_time", self.busy_time),
+             ("idle_time", self.jobs * self.wall_time - self.busy_time),
+             ("utilization", self.utilization),
+             ("dispatch_latency", self.dispatch_latency),
+             ("run_times", [OrderedDict([("run", run), ("slot", slot),
+                                         ("start", start), ("end", end)])
+                            for run, (slot, start, end) in self.runs.items()])])
+
+    def write(self, filename):
+        "Write the report to a JSON file."
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self):
+        "Return a line with the totals of the report."
+        return ("Ran %d models in %s with %d slots: %.1f%% utilization, "
+                "%.3f s idle, %.3f s total dispatch latency, %d crashed, "
+                "%d from cache." %
+                (len(self.runs), format_time(self.wall_time), self.jobs,
+                 100 * self.utilization,
+                 self.jobs * self.wall_time - self.busy_time,
+                 self.dispatch_latency, len(self.crashed), len(self.cached)))
+
+async def _run_cloudy(cloudy_exe, input_file, output_file):
+    "Run one Cloudy model as a subprocess and wait for it to finish."
+    with open(input_file, 'rb') as stdin, open(output_file, 'wb') as stdout:
+        process = await asyncio.create_subprocess_exec(
+            *shlex.split(cloudy_exe), stdin=stdin, stdout=stdout)
+        try:
+            return await process.wait()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+async def _run_models(runs, get_input, cloudy_exe, jobs, report, order=None,
+                      cache=None, exit_on_crash=False, on_finish=None,
+                      read_output=None):
+    "Run Cloudy for each run with at most jobs at once."
+
+    queue = asyncio.Queue()
+    for run in runs if order is None else order:
+        queue.put_nowait(run)
+    totalRuns = len(runs)
+    startRuns = len(report.runs)
+
+    async def worker(slot):
+        lastEnd = None
+        while True:
+            try:
+                run = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            tStart = time.perf_counter()
+            if lastEnd is not None:
+                report.dispatch_latency += tStart - lastEnd
+
+            keyName, cloudyInput = get_input(run)
+            inputFile = keyName + ".cloudyIn"
+            outputFile = keyName + ".cloudyOut"
+            with open(inputFile, 'w') as f:
+                f.write(cloudyInput)
+            cached = False
+            output = None
+            if cache is not None:
+                key = cache.get_key(cloudyInput, keyName)
+                if read_output is None:
+                    cached = cache.restore(key, keyName)
+                else:
+                    output = cache.restore_output(key, keyName)
+                    cached = output is not None
+            if not cached:
+                await _run_cloudy(cloudy_exe, inputFile, outputFile)
+                crashed, warnings = check_cloudy_output(outputFile)
+                if read_output is not None and not crashed:
+                    output, files = read_output(run)
+                if cache is not None and not crashed:
+                    if read_output is None:
+                        cache.store(key, keyName, cloudyInput)
+                    else:
+                        cache.store_output(key, output, files)
+            elif read_output is None:
+                crashed, warnings = check_cloudy_output(outputFile)
+            else:
+                # Only runs that did not crash are stored.
+                crashed = False
+
+            lastEnd = time.perf_counter()
+            report.add_run(run, slot, tStart, lastEnd, crashed, cached=cached)
+            print ("%s - %s %s in %.2f s (%d/%d)%s." %
+                   (time.ctime(), os.path.basename(keyName),
+                    "copied from cache" if cached else "finished",
+                    lastEnd - tStart, len(report.runs) - startRuns, totalRuns,
+                    ", CRASHED" if crashed else ""))
+            if on_finish is not None:
+                on_finish(run, crashed, output)
+            if crashed and exit_on_crash:
+                raise RuntimeError("Cloudy has crashed!  Check %s for details." %
+                                   outputFile)
+
+    workers = [asyncio.ensure_future(worker(slot)) for slot in range(jobs)]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        for task in workers:
+            task.cancel()
+        # Let the cancelled workers kill and reap their Cloudy runs
+        # before the loop is closed.
+        await asyncio.gather(*workers, return_exceptions=True)
+
+def run_cloudy_models(runs, get_input, cloudy_exe, jobs, report=None,
+                      order=None, cache=None, exit_on_crash=False,
+                      on_finish=None, read_output=None):
+    """
+    Run Cloudy for a list of models with at most jobs at once,
+    starting the next as soon as one finishes.
+
+    Parameters
+    ----------
+    runs : list
+        Run numbers, or other hashable ids, of the models.
+    get_input : callable
+        Called with a run number, returns the path and prefix of the
+        files of the run and its Cloudy input.  The input is written
+        to <prefix>.cloudyIn and the output to <prefix>.cloudyOut.
+    cloudy_exe : string
+        Cloudy command.
+    jobs : int
+        Maximum number of Cloudy runs at once.
+    report : optional, ExecutorReport
+        Report to add the runs to.
+        Default: None, a new report.
+    order : optional, list of ints
+        Run numbers in the order they should be started.
+        Default: None, the order of runs.
+    cache : optional, RunCache
+        Cache to copy runs from and store them in.
+        Default: None.
+    exit_on_crash : optional, bool
+        If True, stop with an error when Cloudy crashes.
+        Default: False.
+    on_finish : optional, callable
+        Called with the run number, whether it crashed, and the output
+        given by read_output, or None, after each run finishes.
+        Default: None.
+    read_output : optional, callable
+        Called with the run number after Cloudy finishes without
+        crashing, returns the data read from the output of the run,
+        which must be serializable to JSON, and the files to keep
+        with it in the cache as (filename, suffix) pairs.  If given,
+        the cache holds this data instead of the output of Cloudy,
+        and a run found in the cache is not read again.
+        Default: None.
+
+    Returns
+    -------
+    report : ExecutorReport
+
+    """
+
+    if report is None:
+        report = ExecutorReport(jobs)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(
+            _run_models(runs, get_input, cloudy_exe, jobs, report,
+                        order=order, cache=cache, exit_on_crash=exit_on_crash,
+                        on_finish=on_finish, read_output=read_output))
+    finally:
+        loop.close()
+    return report
+
+def run_cloudy_grid(input_file, jobs=None, cloudy_exe=None, restart=False,
+                    order=None, timings=None, cache_dir=None, cache_size=None,
+                    report_file=None):
+    """
+    Run Cloudy for every point of a CIAOLoop grid on this machine.
+
+    In bare mode (cloudyRunMode = 0), each run writes the Cloudy input
+    of CIAOLoop to <prefix>_run<N>.cloudyIn and runs Cloudy as a
+    subprocess with the output in <prefix>_run<N>.cloudyOut.  In the
+    map modes (cloudyRunMode = 1 to 4), each temperature of each run
+    is a Cloudy run of its own, with the input of CIAOLoop's map mode
+    and its files in <prefix>_run<N>_T<i>.*, and the map files of a
+    run are written once all of its temperatures have finished (see
+    cloudy_grids.map_modes.MapGrid).  At most jobs Cloudy runs go at
+    once and the next starts as soon as one finishes.  Finished runs
+    are added to the run file in run order, so it can be read by the
+    converters at any time.
+
+    Parameters
+    ----------
+    input_file : string
+        A CIAOLoop parameter file, or a run file ending in .run.  Map
+        grids are restarted from the parameter file, as their run
+        files do not list the temperatures.
+    jobs : optional, int
+        Maximum number of Cloudy runs at once.
+        Default: None, the number of cpus.
+    cloudy_exe : optional, string
+        Cloudy command, overriding cloudyExe of the parameter file.
+        Default: None.
+    restart : optional, bool
+        If True, only do the runs not yet listed in the run file.  A
+        run file given as input_file is always restarted.
+        Default: False.
+    order : optional, list of ints or "cost"
+        Run numbers in the order they should be started.  Runs are
+        still listed in the run file by run number.  If "cost", start
+        the runs expected to take longest first, using a cost model
+        fit to the run times of timings (see
+        cloudy_grids.scheduler.fit_cost_model).  For map grids, the
+        temperatures of each run are started together.
+        Default: None, run number order.
+    timings : optional, string or list of strings
+        Run files or reports of grids with earlier run times, used
+        with order="cost".  These may be of this grid, as they are
+        read before its run file is started again.
+        Default: None, the runs already in the run file, for restarts.
+    cache_dir : optional, string
+        If given, keep the output of each run in this directory, keyed
+        by its Cloudy input and the Cloudy executable, and copy it
+        from there instead of running Cloudy for any run with the same
+        input, in this grid or another (see
+        cloudy_grids.run_cache.RunCache).  For map grids, each
+        temperature is keyed by its own input and the cache keeps
+        the row of the map files read from its output.
+        Default: None.
+    cache_size : optional, float
+        Total size in MB of the cache.  The least recently used
+        entries are removed beyond this.  If None, there is no limit.
+        Default: None.
+    report_file : optional, string
+        If given, write the start and end time of each run and the
+        utilization of the run slots to this JSON file.
+        Default: None.
+
+    Returns
+    -------
+    report : ExecutorReport
+        The time of each run and the utilization.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids.executor import run_cloudy_grid
+    >>> report = run_cloudy_grid("grid.par", jobs=16)
+    >>> print (report.summary())
+
+    """
+
+    if input_file.endswith(".run"):
+        settings = read_run_header(input_file)
+        run_file = input_file
+        restart = True
+        if settings["cloudyRunMode"] != 0:
+            raise RuntimeError(
+                "The run file does not have the temperature settings of map "
+                "grids, restart them from the parameter file with restart=True.")
+    else:
+        settings = read_parameter_file(input_file)
+        if not os.path.isdir(settings["outputDir"]):
+            os.makedirs(settings["outputDir"])
+        run_file = "%s%s.run" % (settings["outputDir"], settings["outputFilePrefix"])
+    grid = None
+    if settings["cloudyRunMode"] != 0:
+        grid = MapGrid(settings)
+    if cloudy_exe is None:
+        cloudy_exe = settings["cloudyExe"]
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+
+    # Fit the cost model before a new run file replaces the old one.
+    if isinstance(order, str):
+        if order != "cost":
+            raise RuntimeError("Unknown order: %s." % order)
+        model = fit_cost_model(run_file if timings is None else timings)
+
+    runs = OrderedDict(get_grid_runs(settings))
+    if restart and os.path.exists(run_file):
+        with open(run_file, 'r') as f:
+            listed = [int(line.split(None, 1)[0]) for line in f
+                      if line.strip() and not line.startswith('#')]
+        for run in listed:
+            runs.pop(run, None)
+        print ("Restarting %s with %d of %d runs left." %
+               (run_file, len(runs), len(runs) + len(listed)))
+    else:
+        write_run_file_header(run_file, settings)
+
+    report = ExecutorReport(jobs, run_file=run_file)
+    if settings["test"]:
+        with open(run_file, 'a') as f:
+            for run, index in runs.items():
+                f.write("%d\t%s\n" % (run, get_run_line(settings, index)))
+        report.finish()
+        return report
+
+    cache = None
+    if cache_dir is not None:
+        cache = RunCache(cache_dir, cloudy_exe, max_size=cache_size)
+        report.cache = cache
+    if isinstance(order, str):
+        order = get_cost_order(
+            model, get_run_columns(settings),
+            dict([(run, get_run_line(settings, index).split("\t"))
+                  for run, index in runs.items()]))
+    if order is not None:
+        order = [run for run in order if run in runs]
+        started = set(order)
+        order += [run for run in runs if run not in started]
+
+    # Runs finish out of order, but are listed in the run file in order.
+    pending = deque(runs)
+    finished = set()
+
+    def list_runs(run, crashed, output=None):
+        finished.add(run)
+        with open(run_file, 'a') as f:
+            while pending and pending[0] in finished:
+                listed = pending.popleft()
+                f.write("%d\t%s\n" % (listed, get_run_line(settings, runs[listed])))
+
+    if grid is None:
+        models = list(runs)
+        on_finish = list_runs
+        read_output = None
+
+        def get_input(run):
+            keyName = "%s%s_run%d" % (settings["outputDir"],
+                                      settings["outputFilePrefix"], run)
+            return keyName, get_cloudy_input(settings, runs[run], keyName)
+
+    else:
+        # Each temperature of a map is a model, (run, temperature index).
+        nT = grid.temperatures.size
+        models = [(run, t) for run in runs for t in range(nT)]
+        if order is not None:
+            order = [(run, t) for run in order for t in range(nT)]
+        points = {}
+
+        def get_input(model):
+            run, t = model
+            keyName = grid.get_key_name(run, t)
+            # The map is dated when its first temperature starts.
+            points.setdefault(run, {"start": time.time(), "rows": {}})
+            return keyName, grid.get_input(get_cloudy_input(settings, runs[run], keyName),
+                                           grid.temperatures[t], keyName)
+
+        def read_output(model):
+            keyName = grid.get_key_name(*model)
+            return ([grid.read_output(keyName),
+                     check_cloudy_output(keyName + ".cloudyOut")[1]],
+                    grid.get_kept_files(keyName))
+
+        def on_finish(model, crashed, output):
+            run, t = model
+            point = points[run]
+            if crashed:
+                keyName = grid.get_key_name(run, t)
+                output = [None, check_cloudy_output(keyName + ".cloudyOut")[1]]
+            point["rows"][t] = (output[0], crashed, output[1])
+            if len(point["rows"]) < nT:
+                return
+            del points[run]
+            outputs, crashed, warnings = zip(*[point["rows"][t] for t in range(nT)])
+            keyName = grid.get_key_name(run)
+            grid.write_maps(keyName, runs[run], outputs, start_time=point["start"])
+            grid.collect_files(keyName, [grid.get_key_name(run, t) for t in range(nT)],
+                               crashed, warnings)
+            list_runs(run, any(crashed))
+
+    print ("Running %d models with %d slots." % (len(models), jobs))
+    try:
+        run_cloudy_models(models, get_input, cloudy_exe, jobs,
+                          report=report, order=order, cache=cache,
+                          exit_on_crash=settings["exitOnCrash"],
+                          on_finish=on_finish, read_output=read_output)
+    finally:
+        report.finish()
+        if report_file is not None:
+            report.write(report_file)
+    print (report.summary())
+    if cache is not None:
+        print (cache.summary())
+    return report
@@ -0,0 +1,193 @@
+"""
+Export converted tables to a flat binary file that simulation codes
+can map into memory, and load them with np.memmap.
+
+The file starts with the 8 bytes CLDYFLAT, the size in bytes of the
+header as a little-endian unsigned 64 bit integer, and the header, a
+JSON object padded with spaces.  The tables follow, each starting at
+a multiple of the alignment, as C ordered arrays in the byte order of
+the machine that wrote them.  The header holds:
+
+    version : 1
+    mode : "cooling", "emissivity", "ion_balance" or "line"
+    byteorder : "little" or "big"
+    alignment : alignment of the tables in bytes
+    parameters : list of {"name", "values"} for each loop parameter
+    temperature : temperatures of the tables in K
+    tables : list of {"name", "dtype", "shape", "leading_axes",
+             "offset", "nbytes"} for each table, where the axes of a
+             table are its leading axes (the ions of an ion balance
+             table), the loop parameters, and the temperature, and
+             offset is from the start of the file
+
+Because the tables need no byteswap, every process on a node reading
+the file through np.memmap, or mmap in C, shares the same pages of
+the page cache instead of holding its own copy.
+"""
+
+from collections import OrderedDict
+import h5py
+import json
+import numpy as np
+import struct
+import sys
+
+from cloudy_grids.utilities import \
+    get_tables, \
+    get_slabs
+
+magic = b"CLDYFLAT"
+version = 1
+
+def _align(offset, alignment):
+    "Round offset up to a multiple of alignment."
+    return -(-offset // alignment) * alignment
+
+def export_flat_tables(input_file, output_file, fields=None, alignment=4096,
+                       max_size=64):
+    """
+    Write the tables of a converted hdf5 file to a flat binary file in
+    native byte order for loading with load_flat_tables or mmap.
+
+    Parameters
+    ----------
+    input_file : string
+        HDF5 file written by one of the converters, or assembled with
+        assemble_grid.
+    output_file : string
+        Binary output file name.
+    fields : optional, list of strings
+        Tables to export, e.g., ["Cooling", "Heating"].
+        Default: None, all of them.
+    alignment : optional, int
+        Alignment of each table in bytes.  The default of a memory
+        page lets C codes mmap each table on its own.
+        Default: 4096.
+    max_size : optional, float
+        Largest slab copied at once in MB.
+        Default: 64.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import export_flat_tables
+    >>> export_flat_tables("cooling.h5", "cooling.bin")
+
+    """
+
+    print ("Exporting %s to %s." % (input_file, output_file))
+    with h5py.File(input_file, 'r') as input:
+        tables, names, values, temperatures, mode = get_tables(input)
+        if fields is not None:
+            tables = [table for table in tables
+                      if table[0].split("/")[0] in fields]
+            if not tables:
+                raise RuntimeError("None of %s found in %s." %
+                                   (", ".join(fields), input_file))
+
+        header = OrderedDict(
+            [("version", version),
+             ("mode", mode),
+             ("byteorder", sys.byteorder),
+             ("alignment", alignment),
+             ("parameters", [OrderedDict([("name", name),
+                                          ("values", np.asarray(myValues, dtype=float).tolist())])
+                             for name, myValues in zip(names, values)]),
+             ("temperature", np.asarray(temperatures, dtype=float).tolist()),
+             ("tables", [])])
+        for path, nLead, manifestPath in tables:
+            dataset = input[path]
+            dtype = dataset.dtype.newbyteorder('=')
+            header["tables"].append(
+                OrderedDict([("name", path),
+                             ("dtype", dtype.str),
+                             ("shape", list(dataset.shape)),
+                             ("leading_axes", nLead),
+                             ("offset", 0),
+                             ("nbytes", int(np.prod(dataset.shape)) * dtype.itemsize)]))
+
+        # Offsets are part of the header, so place the tables after a
+        # header long enough to hold them.
+        dataStart = alignment
+        while True:
+            offset = dataStart
+            for table in header["tables"]:
+                table["offset"] = offset
+                offset = _align(offset + table["nbytes"], alignment)
+            text = json.dumps(header).encode()
+            if 16 + len(text) <= dataStart:
+                break
+            dataStart = _align(16 + len(text), alignment)
+
+        with open(output_file, 'wb') as output:
+            output.write(magic)
+            output.write(struct.pack("<Q", dataStart - 16))
+            output.write(text.ljust(dataStart - 16))
+            for table in header["tables"]:
+                output.write(b"\0" * (table["offset"] - output.tell()))
+                dataset = input[table["name"]]
+                dtype = np.dtype(table["dtype"])
+                for slab in get_slabs(dataset.shape, dtype.itemsize, max_size=max_size):
+                    output.write(np.ascontiguousarray(dataset[slab], dtype=dtype).data)
+            output.write(b"\0" * (offset - output.tell()))
+
+def read_flat_header(filename):
+    "Return the header of a file written by export_flat_tables."
+    with open(filename, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise RuntimeError("%s is not a flat table file." % filename)
+        size = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(size).decode(), object_pairs_hook=OrderedDict)
+    if header["version"] > version:
+        raise RuntimeError("%s has version %d, newer than %d." %
+                           (filename, header["version"], version))
+    return header
+
+def load_flat_tables(filename, fields=None):
+    """
+    Map the tables of a file written by export_flat_tables into
+    memory without reading or copying them.
+
+    Pages are read from disk when first used and shared with every
+    other process mapping the same file.  Files written on a machine
+    of the other byte order can also be loaded, but their tables are
+    then byteswapped on each use.
+
+    Parameters
+    ----------
+    filename : string
+        File written by export_flat_tables.
+    fields : optional, list of strings
+        Tables to load.
+        Default: None, all of them.
+
+    Returns
+    -------
+    header : OrderedDict
+        The header of the file, see cloudy_grids.flat_tables.
+    tables : OrderedDict
+        Read-only np.memmap arrays of the tables, by name.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import load_flat_tables
+    >>> header, tables = load_flat_tables("cooling.bin")
+    >>> [parameter["name"] for parameter in header["parameters"]]
+    ['hden', 'redshift']
+    >>> cooling = tables["Cooling"]
+
+    """
+
+    header = read_flat_header(filename)
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+    tables = OrderedDict()
+    for table in header["tables"]:
+        if fields is not None and table["name"].split("/")[0] not in fields:
+            continue
+        start = table["offset"]
+        tables[table["name"]] = \
+          data[start:start + table["nbytes"]].view(table["dtype"]).reshape(table["shape"])
+    if fields is not None and not tables:
+        raise RuntimeError("None of %s found in %s." % (", ".join(fields), filename))
+    return header, tables
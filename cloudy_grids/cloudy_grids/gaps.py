@@ -0,0 +1,439 @@
+"""
+Find missing, short, zero and non-finite maps in a CIAOLoop run
+directory or a converted hdf5 table.
+"""
+
+import glob
+import h5py
+import multiprocessing
+import numpy as np
+import re
+
+from cloudy_grids.utilities import \
+    run_modes, \
+    read_run_file, \
+    get_run_parts, \
+    load_map, \
+    get_map_cache, \
+    init_map_cache_worker, \
+    get_slabs, \
+    get_tables
+
+# Map types whose first column is log10 of the temperature.
+log_modes = ["ion_balance", "line"]
+
+class GridGaps(object):
+    """
+    The gaps found in a grid by find_grid_gaps.
+
+    Grid arrays have the shape of the loop parameter grid and are
+    indexed in run order, i.e., the last loop parameter varies
+    fastest.  Temperature arrays count over all runs.
+
+    Attributes
+    ----------
+    parameter_names : list of strings
+        Names of the loop parameters.
+    parameter_values : list of arrays
+        Values of the loop parameters.
+    temperature : array
+        Temperatures of the maps in K.
+    missing : bool array
+        Runs with a map file that is missing or unreadable, or, for
+        hdf5 tables, runs that were never written.
+    unlisted : bool array
+        Runs not yet listed as finished in the run file of a grid
+        that is still running.  These are not checked and are not
+        counted as gaps.
+    short : bool array
+        Runs with a map with fewer temperatures than the others.
+    zeros : int array
+        Number of zero values in each run.
+    nonfinite : int array
+        Number of NaN or infinite values in each run.
+    temperature_missing : int array
+        Number of short maps missing each temperature.
+    temperature_zeros : int array
+        Number of zero values at each temperature.
+    temperature_nonfinite : int array
+        Number of non-finite values at each temperature.
+    """
+
+    def __init__(self, parameter_names, parameter_values, temperature):
+        self.parameter_names = list(parameter_names)
+        self.parameter_values = [np.asarray(values) for values in parameter_values]
+        self.temperature = np.asarray(temperature, dtype=float)
+        shape = tuple([values.size for values in self.parameter_values])
+        self.missing = np.zeros(shape, dtype=bool)
+        self.unlisted = np.zeros(shape, dtype=bool)
+        self.short = np.zeros(shape, dtype=bool)
+        self.zeros = np.zeros(shape, dtype=np.int64)
+        self.nonfinite = np.zeros(shape, dtype=np.int64)
+        self.temperature_missing = np.zeros(self.temperature.size, dtype=np.int64)
+        self.temperature_zeros = np.zeros(self.temperature.size, dtype=np.int64)
+        self.temperature_nonfinite = np.zeros(self.temperature.size, dtype=np.int64)
+
+    @property
+    def gaps(self):
+        "Bool array of the runs with any gap."
+        return self.missing | self.short | (self.zeros > 0) | (self.nonfinite > 0)
+
+    @property
+    def runs(self):
+        "Run numbers, starting at 1 as in the run file, of the runs with gaps."
+        return np.flatnonzero(self.gaps.ravel()) + 1
+
+    def write_fix_file(self, filename):
+        """
+        Write the run numbers of the runs with gaps, one per line, as
+        done by find_map_zeroes.pl.  Nothing is written if there are
+        no gaps.
+        """
+
+        runs = self.runs
+        if runs.size == 0:
+            print ("This run is complete.")
+            return
+        print ("Writing fix list with %d maps." % runs.size)
+        with open(filename, 'w') as f:
+            f.write("".join(["%d\n" % run for run in runs]))
+
+    def summary(self, max_values=8):
+        """
+        Return a summary of the gaps with the number of runs with gaps
+        at each value of each loop parameter, and the number of bad
+        values at each temperature.  Only the max_values values with
+        the most gaps are listed for each axis.
+        """
+
+        gaps = self.gaps
+        lines = ["Found gaps in %d of %d runs: %d missing, %d short, "
+                 "%d with zeros, %d with non-finite values." %
+                 (gaps.sum(), gaps.size, self.missing.sum(), self.short.sum(),
+                  (self.zeros > 0).sum(), (self.nonfinite > 0).sum())]
+        if self.unlisted.any():
+            lines.append("%d runs not yet listed in the run file were not checked." %
+                         self.unlisted.sum())
+        if not gaps.any():
+            return "\n".join(lines)
+
+        lines.append("Runs with gaps at each loop parameter value:")
+        for axis, (name, values) in enumerate(zip(self.parameter_names,
+                                                  self.parameter_values)):
+            other = tuple([i for i in range(gaps.ndim) if i != axis])
+            counts = gaps.sum(axis=other)
+            lines.append("  %s (of %d runs each): %s" %
+                         (name, gaps.size // values.size,
+                          _format_counts(values, [counts], max_values)))
+
+        counts = [self.temperature_missing, self.temperature_zeros,
+                  self.temperature_nonfinite]
+        if np.any(counts):
+            lines.append("Missing, zero and non-finite values at each temperature:")
+            lines.append("  T [K]: %s" %
+                         _format_counts(self.temperature, counts, max_values))
+        return "\n".join(lines)
+
+def _format_counts(values, counts, max_values):
+    "Format the nonzero counts with the largest total as value: count pairs."
+    total = np.sum(counts, axis=0)
+    order = [i for i in np.argsort(-total, kind="stable") if total[i] > 0]
+    items = ["%g: %s" % (values[i], "/".join(["%d" % count[i] for count in counts]))
+             for i in order[:max_values]]
+    if len(order) > max_values:
+        items.append("(%d more)" % (len(order) - max_values))
+    return ", ".join(items)
+
+def get_run_mode(run_file):
+    "Return the type of maps of a run file from its cloudyRunMode."
+    re_mode = re.compile(r'^\# cloudyRunMode = (\d+)')
+    modes = dict([(value, key) for key, value in run_modes.items()])
+    with open(run_file, 'r') as f:
+        for line in f:
+            if line.startswith('#run'):
+                break
+            match = re_mode.match(line)
+            if match is not None:
+                return modes.get(int(match.group(1)))
+    return None
+
+def _check_maps(files, fields=None):
+    """
+    Read the map files of one run.  For each file, return None if it
+    is missing or unreadable, otherwise the first column and the
+    number of zero and non-finite values in each row.
+    """
+
+    results = []
+    for mapFile in files:
+        try:
+            data, columns = load_map(mapFile)
+        except (OSError, RuntimeError, ValueError):
+            results.append(None)
+            continue
+        values = data[:, 1:]
+        if fields is not None:
+            values = values[:, [i for i, column in enumerate(columns[1:])
+                                if column in fields]]
+        results.append((data[:, 0], (values == 0).sum(axis=1),
+                        (~np.isfinite(values)).sum(axis=1)))
+    return results
+
+def _check_maps_worker(task):
+    "Read the map files of one run in a worker process."
+    q, files, fields = task
+    return q, _check_maps(files, fields=fields)
+
+def _find_map_gaps(run_file, elements=None, fields=None, zeros=None,
+                   temperatures=None, jobs=1):
+    "Find the gaps in the map files of a run directory."
+
+    prefix, parameterNames, parameterValues, listedRuns = \
+      read_run_file(run_file, complete=False)
+    gridDimension = [len(q) for q in parameterValues]
+    gridRuns = int(np.prod(gridDimension))
+    # Runs of a grid that is still running are only checked once
+    # they are listed as finished.
+    runs = np.flatnonzero(listedRuns)
+    if runs.size == 0:
+        raise RuntimeError("No runs listed as finished in %s." % run_file)
+    mode = get_run_mode(run_file)
+    if zeros is None:
+        zeros = mode == "cooling"
+
+    if mode == "ion_balance":
+        if elements is None:
+            elements = []
+            for q in runs:
+                mapFiles = glob.glob("%s_run%d_*.dat" % (prefix, (q+1)))
+                if mapFiles:
+                    elements = sorted([mapFile[:-4].rsplit("_", 1)[1]
+                                       for mapFile in mapFiles])
+                    break
+            if not elements:
+                raise RuntimeError("No map files found for %s." % run_file)
+        mapFiles = [["%s_run%d_%s.dat" % (prefix, (q+1), species)
+                     for species in elements]
+                    for q in range(gridRuns)]
+    else:
+        mapFiles = [["%s_run%d.dat" % (prefix, (q+1))] for q in range(gridRuns)]
+    nFiles = len(mapFiles[0])
+
+    print ("Checking %d maps of %s." % (runs.size * nFiles, run_file))
+    if runs.size < gridRuns:
+        print ("Skipping %d runs not yet listed in the run file." %
+               (gridRuns - runs.size))
+    tasks = [(q, mapFiles[q], fields) for q in runs]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs, initializer=init_map_cache_worker,
+                                    initargs=(get_map_cache(),))
+        results = pool.imap_unordered(_check_maps_worker, tasks,
+                                      chunksize=max(1, runs.size // (4 * jobs)))
+    else:
+        pool = None
+        results = (_check_maps_worker(task) for task in tasks)
+
+    # Per run counts, plus per temperature sums of the maps with the
+    # same number of rows.  The first column of a map is only kept
+    # when its length has not been seen yet.
+    missing = np.zeros(gridRuns, dtype=bool)
+    rows = -np.ones((gridRuns, nFiles), dtype=np.int64)
+    zeroCount = np.zeros(gridRuns, dtype=np.int64)
+    nonfiniteCount = np.zeros(gridRuns, dtype=np.int64)
+    rowSums = {}
+    try:
+        for q, result in results:
+            for i, mapResult in enumerate(result):
+                if mapResult is None:
+                    missing[q] = True
+                    continue
+                column, zeroRows, nonfiniteRows = mapResult
+                rows[q, i] = column.size
+                zeroCount[q] += zeroRows.sum()
+                nonfiniteCount[q] += nonfiniteRows.sum()
+                key = (i, column.size)
+                if key not in rowSums:
+                    rowSums[key] = [column, 0, 0]
+                rowSums[key][1] = rowSums[key][1] + zeroRows
+                rowSums[key][2] = rowSums[key][2] + nonfiniteRows
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # The full temperature list is that of the longest maps.
+    if not rowSums:
+        raise RuntimeError("No map files found for %s." % run_file)
+    if temperatures is None:
+        longest = max(rowSums, key=lambda key: key[1])
+        temperatures = rowSums[longest][0]
+        if mode in log_modes:
+            temperatures = 10**temperatures
+    temperatures = np.asarray(temperatures, dtype=float)
+    logT = np.log10(temperatures)
+
+    gaps = GridGaps(parameterNames, parameterValues, temperatures)
+    gaps.missing[...] = missing.reshape(gridDimension)
+    gaps.unlisted[...] = ~listedRuns.reshape(gridDimension)
+    gaps.short[...] = ((rows >= 0) & (rows < temperatures.size)).any(axis=1). \
+      reshape(gridDimension)
+    if zeros:
+        gaps.zeros[...] = np.where(missing, 0, zeroCount).reshape(gridDimension)
+    gaps.nonfinite[...] = np.where(missing, 0, nonfiniteCount).reshape(gridDimension)
+
+    # Match the rows of each map length to the full temperature list.
+    for (i, size), (column, zeroRows, nonfiniteRows) in rowSums.items():
+        if mode not in log_modes:
+            column = np.log10(column)
+        match = np.abs(column[:, None] - logT[None, :]) < 1e-4
+        found = match.any(axis=0)
+        index = match.argmax(axis=1)
+        valid = match.any(axis=1)
+        if size < temperatures.size:
+            count = (rows[:, i] == size).sum()
+            gaps.temperature_missing += np.where(found, 0, count)
+        if zeros:
+            np.add.at(gaps.temperature_zeros, index[valid], np.asarray(zeroRows)[valid])
+        np.add.at(gaps.temperature_nonfinite, index[valid],
+                  np.asarray(nonfiniteRows)[valid])
+    return gaps
+
+def _find_table_gaps(filename, fields=None, zeros=None, max_size=64):
+    "Find the gaps in the tables of a converted hdf5 file."
+
+    print ("Checking tables of %s." % filename)
+    with h5py.File(filename, 'r') as f:
+        tables, names, values, temperatures, mode = get_tables(f)
+        if fields is not None:
+            tables = [table for table in tables
+                      if table[0].split("/")[0] in fields]
+            if not tables:
+                raise RuntimeError("None of %s found in %s." %
+                                   (", ".join(fields), filename))
+        if zeros is None:
+            zeros = mode == "cooling"
+
+        gaps = GridGaps(names, values, temperatures)
+        gridShape = gaps.missing.shape
+        written = np.zeros(gridShape, dtype=bool)
+        for path, nLead, manifestPath in tables:
+            dataset = f[path]
+            lead = (slice(None),) * nLead
+            itemsize = dataset.dtype.itemsize * int(np.prod(dataset.shape[:nLead]))
+            chunks = None if dataset.chunks is None else dataset.chunks[nLead:]
+
+            # Runs of a table that were never written are all zero.
+            empty = np.zeros(gridShape, dtype=bool)
+            zeroCount = np.zeros(gridShape, dtype=np.int64)
+            nonfiniteCount = np.zeros(gridShape, dtype=np.int64)
+            temperatureZeros = np.zeros(temperatures.size, dtype=np.int64)
+            temperatureNonfinite = np.zeros(temperatures.size, dtype=np.int64)
+            sumAxes = tuple(range(nLead)) + (-1,)
+            for slab in get_slabs(dataset.shape[nLead:], itemsize,
+                                  chunks=chunks, max_size=max_size):
+                data = dataset[lead + (slab,)]
+                isZero = data == 0
+                nonfinite = ~np.isfinite(data)
+                myEmpty = isZero.all(axis=sumAxes)
+                empty[slab] = myEmpty
+                isZero &= ~myEmpty.reshape((1,) * nLead + myEmpty.shape + (1,))
+                zeroCount[slab] = isZero.sum(axis=sumAxes)
+                nonfiniteCount[slab] = nonfinite.sum(axis=sumAxes)
+                temperatureZeros += isZero.reshape(-1, temperatures.size).sum(axis=0)
+                temperatureNonfinite += \
+                  nonfinite.reshape(-1, temperatures.size).sum(axis=0)
+
+            # Tables zeroed on purpose, e.g., by zero_dataset.
+            if empty.all():
+                print ("Skipping %s, which is zero everywhere." % path)
+                continue
+            written |= ~empty
+            gaps.nonfinite += nonfiniteCount
+            gaps.temperature_nonfinite += temperatureNonfinite
+            if zeros:
+                gaps.zeros += zeroCount
+                gaps.temperature_zeros += temperatureZeros
+
+            # Runs that failed or were not yet ingested in an
+            # incremental conversion.
+            if manifestPath in f and "ingested" in f[manifestPath]:
+                ingested = f[manifestPath]["ingested"][()].astype(bool)
+                gaps.missing |= ~ingested.reshape(gridShape)
+
+    gaps.missing |= ~written
+    gaps.zeros[gaps.missing] = 0
+    return gaps
+
+def find_grid_gaps(filename, elements=None, fields=None, zeros=None,
+                   temperatures=None, jobs=1, fix_file=None):
+    """
+    Find the runs of a grid with missing, short, zero or non-finite
+    maps.
+
+    This checks either the map files listed in a CIAOLoop run file or
+    the tables of an hdf5 file made by one of the converters, counting
+    the bad values of every run with array operations.  Map files are
+    not modified.
+
+    Parameters
+    ----------
+    filename : string
+        Path to a run file ending in .run, one of the part files of a
+        run made with CIAOLoop -mp, or a converted hdf5 file.
+        Only the runs listed as finished in a run file are checked,
+        so a grid can be checked while it is still running.
+        In hdf5 files, runs that were never written, i.e., are zero
+        in every table or are not marked as ingested in the manifest
+        of an incremental conversion, count as missing.  Tables that
+        are zero everywhere, e.g., after zero_dataset, are skipped.
+    elements : optional, list of strings
+        Elements of the ion balance maps or tables to check.
+        Default: None, all elements found for the first run.
+    fields : optional, list of strings
+        Map columns or hdf5 tables to check, e.g., ["Cooling"].
+        Default: None, all of them.
+    zeros : optional, bool
+        If True, count zero values as gaps.
+        Default: None, True for cooling maps only.  Emissivities can
+        be zero and ion balance and line maps are logarithms.
+    temperatures : optional, array
+        Temperatures in K that every map should have, as given to
+        find_map_zeroes.pl.  Only used for run files.
+        Default: None, those of the longest map.
+    jobs : optional, int
+        Number of processes used to read the map files.
+        Default: 1.
+    fix_file : optional, string
+        If given, write the run numbers of the runs with gaps to this
+        file, one per line, as find_map_zeroes.pl does.
+        Default: None.
+
+    Returns
+    -------
+    gaps : GridGaps
+        The bad runs and a per axis summary of where they are.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import find_grid_gaps
+    >>> gaps = find_grid_gaps("cooling/cooling.run", fix_file="cooling.fix")
+    >>> print (gaps.summary())
+
+    """
+
+    if filename.endswith(".run") or get_run_parts(filename) is not None:
+        gaps = _find_map_gaps(filename, elements=elements, fields=fields,
+                              zeros=zeros, temperatures=temperatures,
+                              jobs=jobs)
+    else:
+        if not h5py.is_hdf5(filename):
+            raise RuntimeError("%s is neither a run file nor an hdf5 file." %
+                               filename)
+        if fields is None:
+            fields = elements
+        gaps = _find_table_gaps(filename, fields=fields, zeros=zeros)
+
+    if fix_file is not None:
+        gaps.write_fix_file(fix_file)
+    return gaps
@@ -0,0 +1,140 @@
+import itertools
+import numpy as np
+
+class GridInterpolator(object):
+    """
+    Multilinear interpolation on a regular grid of sorted axes.
+
+    The spacing of each axis and the strides of the flattened grid
+    are computed once.  Interpolation is split into finding the
+    corners and weights for a batch of points, which only depends
+    on the axes, and combining tables with them, so several tables
+    on the same grid can share one set of corners.
+
+    Parameters
+    ----------
+    axes : list of arrays
+        Sorted values of each axis of the grid.
+    """
+
+    def __init__(self, axes):
+        self.axes = [np.asarray(axis, dtype=np.float64) for axis in axes]
+        self.shape = tuple([axis.size for axis in self.axes])
+        self.strides = [int(np.prod(self.shape[i+1:]))
+                        for i in range(len(self.shape))]
+
+        self.uniform = []
+        self.inverse_spacing = []
+        for axis in self.axes:
+            if axis.size > 1:
+                spacing = np.diff(axis)
+                if (spacing <= 0).any():
+                    raise RuntimeError("Grid axes must be strictly increasing.")
+                self.uniform.append(np.allclose(spacing, spacing[0], rtol=1e-10))
+                self.inverse_spacing.append(1 / spacing)
+            else:
+                self.uniform.append(True)
+                self.inverse_spacing.append(np.ones(1))
+
+    def get_axis_weights(self, i, values, clamp=False):
+        """
+        Find the cell of axis i holding each value and the weight of
+        its upper point.  Out of bounds values raise an error unless
+        clamp is True, in which case they take the edge value.
+        """
+
+        axis = self.axes[i]
+        if clamp:
+            values = np.clip(values, axis[0], axis[-1])
+        elif ((values < axis[0]) | (values > axis[-1])).any():
+            raise RuntimeError(
+                "Points lie outside of axis %d range [%g, %g]." %
+                (i, axis[0], axis[-1]))
+
+        if axis.size == 1:
+            return np.zeros(values.shape, dtype=np.intp), \
+              np.zeros(values.shape)
+
+        if self.uniform[i]:
+            index = ((values - axis[0]) * self.inverse_spacing[i][0]).astype(np.intp)
+        else:
+            index = np.searchsorted(axis, values, side='right') - 1
+        np.clip(index, 0, axis.size - 2, out=index)
+        weight = (values - axis[index]) * self.inverse_spacing[i][index]
+        return index, weight
+
+    def get_corners(self, coordinates, clamp=False):
+        """
+        Return the flat grid indices and weights of the corners of
+        the cells holding a batch of points.
+
+        coordinates is a list with an array of values for each axis,
+        all of the same shape.  Returns lists, over the 2**rank cell
+        corners, of index and weight arrays with that shape.
+        """
+
+        if len(coordinates) != len(self.axes):
+            raise RuntimeError("Expected %d coordinates, got %d." %
+                               (len(self.axes), len(coordinates)))
+
+        lower = []
+        upper = []
+        for i, values in enumerate(coordinates):
+            index, weight = self.get_axis_weights(i, values, clamp=clamp)
+            step = self.strides[i] if self.shape[i] > 1 else 0
+            lower.append((index * self.strides[i], 1 - weight))
+            upper.append((index * self.strides[i] + step, weight))
+
+        indices = []
+        weights = []
+        for corner in itertools.product(*zip(lower, upper)):
+            index = corner[0][0]
+            weight = corner[0][1]
+            for axis_index, axis_weight in corner[1:]:
+                index = index + axis_index
+                weight = weight * axis_weight
+            indices.append(index)
+            weights.append(weight)
+        return indices, weights
+
+    def combine(self, table, indices, weights):
+        """
+        Interpolate a flattened table with corners from get_corners.
+        The table may have leading axes, e.g., one per line, that are
+        interpolated together.
+        """
+
+        result = weights[0] * table[..., indices[0]]
+        for index, weight in zip(indices[1:], weights[1:]):
+            result += weight * table[..., index]
+        return result
+
+    def interpolate(self, tables, coordinates, clamp=False, batch_size=2**20):
+        """
+        Interpolate flattened tables at a set of points.
+
+        The points are processed in batches of batch_size, with the
+        corners of each batch computed once for all tables.  Returns
+        a list with, for each table, an array of the table's leading
+        shape plus the broadcast shape of the coordinates.
+        """
+
+        coordinates, shape = broadcast_coordinates(coordinates)
+        size = coordinates[0].size
+
+        results = [np.empty(table.shape[:-1] + (size,)) for table in tables]
+        for start in range(0, size, batch_size):
+            batch = [values[start:start+batch_size] for values in coordinates]
+            indices, weights = self.get_corners(batch, clamp=clamp)
+            for table, result in zip(tables, results):
+                result[..., start:start+batch_size] = \
+                  self.combine(table, indices, weights)
+
+        return [result.reshape(result.shape[:-1] + shape) for result in results]
+
+def broadcast_coordinates(coordinates):
+    "Return the coordinates as flat float arrays and their common shape."
+    coordinates = np.broadcast_arrays(
+        *[np.asarray(values, dtype=np.float64) for values in coordinates])
+    shape = coordinates[0].shape
+    return [values.ravel() for values in coordinates], shape
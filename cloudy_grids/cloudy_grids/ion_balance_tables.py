@@ -1,124 +1,118 @@
 import h5py
 import numpy as np
-import re
-import copy
 
-from cloudy_grids.utilities import get_grid_indices
+from cloudy_grids.utilities import \
+     read_run_file, \
+     load_map, \
+     load_map_grid, \
+     read_manifest, \
+     get_map_stats, \
+     get_changed_runs, \
+     write_manifest, \
+     get_dataset_options
+from cloudy_grids.profiling import \
+     get_profile
 
 floatType = '>f4'
 intType = '>i4'
 
-def _ion_balance_convert(runFile, outputFile, species):
-    "Convert Cloudy ion fraction ascii data into hdf5."
+def _ion_balance_convert(runFile, outputFile, elements, jobs=1, buffer_size=None,
+                         incremental=False, native_endian=False, chunks=None,
+                         compression=None, shuffle=False, profile=None):
+    "Convert Cloudy ion fraction ascii data for all elements into hdf5 in one pass."
 
-    print ("Converting %s from %s to %s." % (species, runFile, outputFile))
+    print ("Converting %s from %s to %s." % (", ".join(elements), runFile, outputFile))
+    profile = get_profile(profile)
 
-    if runFile[-4:] == '.run':
-        prefix = runFile[0:-4]
-    else:
-        print ("Run file needs to end in .run.")
-        exit(1)
-
-    f = open(runFile,'r')
-    lines = f.readlines()
-    f.close()
-
-    # Values of loop parameters.
-    parameterValues = []
-    parameterNames = []
-
-    getParameterValues = False
-    getRunValues = False
-
-    re_parValue = re.compile('^\# Loop commands and values:')
-    re_runValue = re.compile('^\#run')
-
-    totalRuns = 0
-
-    for q,line in enumerate(lines):
-        line = line.strip()
-        if getParameterValues:
-            if line == '#':
-                getParameterValues = False
-            else:
-                (par,values) = line.split(': ')
-                floatValues = [float(val) for val in values.split()]
-                parameterValues.append(floatValues)
-                parameterNames.append(par[2:])
-        elif getRunValues:
-            totalRuns = len(lines) - q
-            break
-        else:
-            if (re_parValue.match(line) is not None):
-                getParameterValues = True
-            elif (re_runValue.match(line) is not None):
-                getRunValues = True
-
-    # Check file line number against product of parameter numbers.
+    with profile.stage("read_run_file"):
+        prefix, parameterNames, parameterValues, listedRuns = \
+          read_run_file(runFile, complete=not incremental)
     gridDimension = [len(q) for q in parameterValues]
-    if totalRuns != np.prod(gridDimension):
-        print ("Error: total runs (%d) in run file not equal to product of parameters(%d)." % \
-        (totalRuns,reduce((lambda x,y: x*y),gridDimension)))
-        exit(1)
-
-    # Read in data files.
-    gridData = []
-    for q in range(totalRuns):
-        mapFile = "%s_run%d_%s.dat" % (prefix, (q+1), species)
-        indices = get_grid_indices(gridDimension,q)
-        loadMap(mapFile,gridDimension,indices,gridData)
-
-    temperature = gridData.pop(0)
-    ion_data = gridData.pop(0)
-    ion_data = np.rollaxis(ion_data, -1)
-
-    # Write out hdf5 file.
-    output = h5py.File(outputFile,'a')
-
-    # Write data.
-    output.create_dataset(species, data=ion_data,dtype=floatType)
-    output[species].attrs['Temperature'] = np.array(temperature, dtype=floatType)
-
-    # Write loop parameter values.
-    for q,values in enumerate(parameterValues):
-        name = "Parameter%d" % (q+1)
-        output[species].attrs[name] = np.array(values, dtype=floatType)
-
-    output.close()
-
-def loadMap(mapFile,gridDimension,indices,gridData):
-    "Read individual cloudy map ascii file and fill data arrays."
-
-    f = open(mapFile,'r')
-    lines = f.readlines()
-    f.close()
-
-    t = []
-    ion_fraction = []
-
-    for line in lines:
-        line.strip()
-        if line[0] != '#':
-            onLine = line.split()
-            t.append(float(onLine.pop(0)))
-            ion_fraction.append([float(val) for val in onLine])
-
-    ion_fraction = np.array(ion_fraction)
-
-    if len(gridData) == 0:
-        myDims = copy.deepcopy(gridDimension)
-        myDims.extend(ion_fraction.shape)
-        gridData.append(np.array(t))
-        gridData.append(np.zeros(shape=myDims))
-    try:
-        gridData[1][tuple(indices)][:] = ion_fraction
-    except ValueError:
-        print(f"There was a problem with adding fraction table "
-              f"of shape {ion_fraction.shape} to indices f{tuple(indices)} ")
-
-def convert_ion_balance_tables(run_file, output_file, elements):
+    gridRuns = int(np.prod(gridDimension))
+
+    # Each run reads one map file per element.
+    mapFiles = [["%s_run%d_%s.dat" % (prefix, (q+1), species)
+                 for species in elements]
+                for q in range(gridRuns)]
+    manifestNames = ["_manifest/%s" % species for species in elements]
+
+    # Find the maps to read and create the output datasets.
+    with profile.stage("setup"):
+        runs = None
+        manifests = [None] * len(elements)
+        if incremental:
+            manifests = [read_manifest(outputFile, name=name) for name in manifestNames]
+            sizes, mtimes = get_map_stats(mapFiles, listedRuns)
+            runs = np.zeros(gridRuns, dtype=bool)
+            for i, manifest in enumerate(manifests):
+                runs |= get_changed_runs(sizes[:, i:i+1], mtimes[:, i:i+1], manifest)
+            print ("Reading %d of %d maps." % (runs.sum(), runs.size))
+
+        # Write out hdf5 file.
+        output = h5py.File(outputFile,'a')
+
+        mapShapes = []
+        for i, species in enumerate(elements):
+            if manifests[i] is not None:
+                mapShapes.append(tuple(manifests[i]["map_shape"][0]))
+                continue
+
+            if incremental:
+                present = sizes[:, i] >= 0
+                if not present.any():
+                    output.close()
+                    raise RuntimeError("No %s map files found for %s." % (species, runFile))
+                firstRun = int(np.argmax(present))
+            else:
+                firstRun = 0
+            firstMap = load_map(mapFiles[firstRun][i])[0]
+            temperature = firstMap[:, 0]
+            mapShapes.append(firstMap.shape)
+
+            shape = [firstMap.shape[1]-1]+gridDimension+[temperature.size]
+            options = get_dataset_options(shape, floatType,
+                                          native_endian=native_endian,
+                                          chunks=chunks, compression=compression,
+                                          shuffle=shuffle)
+            dtype = options["dtype"]
+
+            # Create dataset with its final shape.
+            output.create_dataset(species, shape=shape, **options)
+            output[species].attrs['Temperature'] = np.array(temperature, dtype=dtype)
+
+            # Write loop parameter values.
+            for q,values in enumerate(parameterValues):
+                name = "Parameter%d" % (q+1)
+                output[species].attrs[name] = np.array(values, dtype=dtype)
+
+    # Read in data files and write each block of maps.
+    def write_block(slab, blocks):
+        for species, block in zip(elements, blocks):
+            ion_data = np.rollaxis(block[..., 1:], -1)
+            output[species][(slice(None),) + slab] = ion_data
+
+    # As before, maps of the wrong shape, e.g., from runs that
+    # stopped early, are reported and left as zeros.
+    failed = load_map_grid(mapFiles, gridDimension, write_block,
+                           jobs=jobs, buffer_size=buffer_size,
+                           strict=not incremental, zero_mismatched=True,
+                           runs=runs, map_shapes=mapShapes, profile=profile)
+    with profile.stage("write"):
+        if incremental:
+            for i, name in enumerate(manifestNames):
+                write_manifest(output, runs, failed, sizes[:, i:i+1], mtimes[:, i:i+1],
+                               [mapShapes[i]], manifest=manifests[i], name=name)
+
+        output.close()
+
+def convert_ion_balance_tables(run_file, output_file, elements,
+                               jobs=1, buffer_size=None, incremental=False,
+                               native_endian=False, chunks=None,
+                               compression=None, shuffle=False, profile=None):
     """
-    Convert ascii ion balance tables to hdf5.
+    Convert ascii ion balance tables to hdf5.  The map files of all
+    elements are read in a single pass over the grid and each element
+    is written to its own dataset.
 
     Parameters
     ----------
@@ -128,6 +122,38 @@ def convert_ion_balance_tables(run_file, output_file, elements):
         HDF5 output file name.
     elements : list
         List of elements to be converted.
+    jobs : optional, int
+        Number of processes used to read the map files.
+        Default: 1.
+    buffer_size : optional, float
+        If set, stream the maps to the output file through a buffer
+        of at most this many MB instead of holding the whole grid
+        in memory.
+        Default: None.
+    incremental : optional, bool
+        If True, keep a manifest of ingested maps in the output file
+        and, if the file already has one, only read maps that are
+        new or have changed since.  The run file may be incomplete.
+        Default: False.
+    native_endian : optional, bool
+        If True, store the tables in the byte order of this machine
+        instead of big-endian.
+        Default: False.
+    chunks : optional, bool or tuple
+        Chunk shape of the tables.  If True, use a shape that keeps
+        each temperature row contiguous.
+        Default: None.
+    compression : optional, string or int
+        Compression filter for the tables, either 'gzip', 'lzf', or
+        a gzip level.
+        Default: None.
+    shuffle : optional, bool
+        If True, apply the shuffle filter before compression.
+        Default: False.
+    profile : optional, ConversionProfile
+        If given, record the time and memory of each stage of the
+        conversion.  See ConversionProfile.
+        Default: None.
 
     Examples
     --------
@@ -138,5 +164,9 @@ def convert_ion_balance_tables(run_file, output_file, elements):
 
     """
 
-    for element in elements:
-        _ion_balance_convert(run_file, output_file, element)
+    _ion_balance_convert(run_file, output_file, elements,
+                         jobs=jobs, buffer_size=buffer_size,
+                         incremental=incremental,
+                         native_endian=native_endian, chunks=chunks,
+                         compression=compression, shuffle=shuffle,
+                         profile=profile)
@@ -1,9 +1,19 @@
+from collections import OrderedDict
 import h5py
 import numpy as np
-import re
-import copy
 
-from cloudy_grids.utilities import get_grid_indices
+from cloudy_grids.utilities import \
+     read_run_file, \
+     load_map, \
+     load_map_grid, \
+     read_manifest, \
+     get_incremental_runs, \
+     write_manifest, \
+     get_dataset_options
+from cloudy_grids.profiling import \
+     get_profile
+from cloudy_grids.interpolation import \
+     GridInterpolator
 
 floatType = '>f8'
 intType = '>i8'
@@ -11,7 +21,9 @@ intType = '>i8'
 field_dict = {"hden": "log_nH",
               "log_T": "log_T"}
 
-def convert_line_tables(runFile,outputFile):
+def convert_line_tables(runFile,outputFile,jobs=1,buffer_size=None,
+                        incremental=False,native_endian=False,chunks=None,
+                        compression=None,shuffle=False,profile=None):
     """
     Convert ascii line emissivity tables to hdf5.
 
@@ -21,6 +33,38 @@ def convert_line_tables(runFile,outputFile):
         Path to the input file ending in .run.
     output_file : string
         HDF5 output file name.
+    jobs : optional, int
+        Number of processes used to read the map files.
+        Default: 1.
+    buffer_size : optional, float
+        If set, stream the maps to the output file through a buffer
+        of at most this many MB instead of holding the whole grid
+        in memory.
+        Default: None.
+    incremental : optional, bool
+        If True, keep a manifest of ingested maps in the output file
+        and, if the file already has one, only read maps that are
+        new or have changed since.  The run file may be incomplete.
+        Default: False.
+    native_endian : optional, bool
+        If True, store the tables in the byte order of this machine
+        instead of big-endian.
+        Default: False.
+    chunks : optional, bool or tuple
+        Chunk shape of the tables.  If True, use a shape that keeps
+        each temperature row contiguous.
+        Default: None.
+    compression : optional, string or int
+        Compression filter for the tables, either 'gzip', 'lzf', or
+        a gzip level.
+        Default: None.
+    shuffle : optional, bool
+        If True, apply the shuffle filter before compression.
+        Default: False.
+    profile : optional, ConversionProfile
+        If given, record the time and memory of each stage of the
+        conversion.  See ConversionProfile.
+        Default: None.
 
     Examples
     --------
@@ -31,106 +75,187 @@ def convert_line_tables(runFile,outputFile):
     """
 
     print ("Converting %s to %s." % (runFile,outputFile))
+    profile = get_profile(profile)
 
-    if runFile[-4:] == '.run':
-        prefix = runFile[0:-4]
-    else:
-        raise RuntimeError("Run file needs to end in .run.")
-
-    f = open(runFile,'r')
-    lines = f.readlines()
-    f.close()
-
-    # Values of loop parameters.
-    parameterValues = []
-    parameterNames = []
-
-    getParameterValues = False
-    getRunValues = False
-
-    re_parValue = re.compile('^\# Loop commands and values:')
-    re_runValue = re.compile('^\#run')
-
-    totalRuns = 0
-
-    for q,line in enumerate(lines):
-        line = line.strip()
-        if getParameterValues:
-            if line == '#':
-                getParameterValues = False
-            else:
-                (par,values) = line.split(': ')
-                floatValues = [float(val) for val in values.split()]
-                parameterValues.append(floatValues)
-                parameterNames.append(par[2:])
-        elif getRunValues:
-            totalRuns = len(lines) - q
-            break
+    with profile.stage("read_run_file"):
+        prefix, parameterNames, parameterValues, listedRuns = \
+          read_run_file(runFile, complete=not incremental)
+    gridDimension = [len(q) for q in parameterValues]
+    gridRuns = int(np.prod(gridDimension))
+
+    mapFiles = [["%s_run%d.dat" % (prefix,(q+1))] for q in range(gridRuns)]
+
+    # Find the maps to read and create the output datasets.
+    with profile.stage("setup"):
+        runs = None
+        manifest = None
+        if incremental:
+            manifest = read_manifest(outputFile)
+            runs, sizes, mtimes = get_incremental_runs(mapFiles, listedRuns, manifest)
+            if not (sizes >= 0).any():
+                raise RuntimeError("No map files found for %s." % runFile)
+            firstRun = int(np.argmax((sizes >= 0).all(axis=1)))
         else:
-            if (re_parValue.match(line) is not None):
-                getParameterValues = True
-            elif (re_runValue.match(line) is not None):
-                getRunValues = True
+            firstRun = 0
 
-    # Check file line number against product of parameter numbers.
-    gridDimension = [len(q) for q in parameterValues]
-    if totalRuns != np.prod(gridDimension):
-        raise RuntimeError(
-            "Error: total runs (%d) in run file not equal to product of parameters(%d)." %
-            (totalRuns, np.prod(gridDimension)))
-
-    # Read in data files.
-    gridData = {}
-    for q in range(totalRuns):
-        mapFile = "%s_run%d.dat" % (prefix,(q+1))
-        indices = get_grid_indices(gridDimension,q)
-        loadMap(mapFile,gridDimension,indices,gridData, parameterValues, parameterNames)
-
-    # Write out hdf5 file.
-    output = h5py.File(outputFile,'w')
-    
-    # Write data.
-    for field in gridData:
-        group = output.create_group(field)
-        dataset = group.create_dataset("emissivity", data=gridData[field], dtype=floatType)
-        dataset.attrs["units"] = "erg * s**(-1) * cm**(3)"
-
-        # Write loop parameter values.
-        for q,values in enumerate(parameterValues):
-            values = np.array(values,dtype=float)
-            name = field_dict[parameterNames[q]]
-            dataset = group.create_dataset(name,data=values,dtype=floatType)
-            dataset.attrs["units"] = ""
-
-    output.close()
-
-def loadMap(mapFile,gridDimension,indices,gridData, parameterValues, parameterNames):
-    "Read individual cooling map ascii file and fill data arrays."
-
-    f = open(mapFile,'r')
-    lines = f.readlines()
-    f.close()
-
-    data = []
-    fields = []
-    
-    for i, line in enumerate(lines):
-        line = line.strip()
-        if not line.startswith('#'):
-            if not fields:
-                fields = lines[i-1].split()[1:]
-            data.append(line.split())
-
-    data = np.rollaxis(np.array(data, dtype=np.float64), 1)
-
-    if not gridData:
-        myDims = copy.deepcopy(gridDimension)
-        myDims.append(data.shape[1])
-
-        for field in fields:
-            gridData[field] = np.zeros(shape=myDims)
-        parameterNames.append("log_T")
-        parameterValues.append(data[0])
-
-    for i, field in enumerate(fields):
-        gridData[field][tuple(indices)][:] = data[i+1]
+        # Line labels come from the column header of the first map.
+        firstMap, columns = load_map(mapFiles[firstRun][0])
+        fields = columns[1:]
+
+        # Add new and changed maps to an existing file.
+        if manifest is not None:
+            output = h5py.File(outputFile,'r+')
+            mapShapes = manifest["map_shape"]
+
+        else:
+            mapShapes = [firstMap.shape]
+            parameterNames.append("log_T")
+            parameterValues.append(firstMap[:, 0])
+
+            shape = gridDimension+[firstMap.shape[0]]
+            options = get_dataset_options(shape,floatType,native_endian=native_endian,
+                                          chunks=chunks,compression=compression,
+                                          shuffle=shuffle)
+
+            # Write out hdf5 file.
+            output = h5py.File(outputFile,'w')
+
+            # Create datasets with their final shape.
+            for field in fields:
+                group = output.create_group(field)
+                dataset = group.create_dataset("emissivity",shape=shape,**options)
+                dataset.attrs["units"] = "erg * s**(-1) * cm**(3)"
+
+                # Write loop parameter values.
+                for q,values in enumerate(parameterValues):
+                    values = np.array(values,dtype=float)
+                    name = field_dict[parameterNames[q]]
+                    dataset = group.create_dataset(name,data=values,dtype=options["dtype"])
+                    dataset.attrs["units"] = ""
+
+    # Read in data files and write each block of maps.
+    def write_block(slab, blocks):
+        for i, field in enumerate(fields):
+            output[field]["emissivity"][slab] = blocks[0][..., i+1]
+
+    failed = load_map_grid(mapFiles, gridDimension, write_block,
+                           jobs=jobs, buffer_size=buffer_size,
+                           strict=not incremental, runs=runs,
+                           map_shapes=mapShapes, profile=profile)
+    with profile.stage("write"):
+        if incremental:
+            write_manifest(output, runs, failed, sizes, mtimes, mapShapes,
+                           manifest=manifest)
+
+        output.close()
+
+class LineTable(object):
+    """
+    Interpolate the line emissivities written by convert_line_tables.
+
+    The emissivities of a set of lines are stacked into a single
+    (line, nH, T) array so that the interpolation indices and weights
+    for a batch of points are computed once and applied to all lines
+    together.  The most recently used stacks are kept in memory.
+    Emissivities are interpolated linearly between grid points.
+
+    Parameters
+    ----------
+    filename : string
+        HDF5 file written by convert_line_tables.
+    cache_size : optional, int
+        Number of stacked line sets kept in memory.
+        Default: 8.
+    batch_size : optional, int
+        Number of points interpolated at once, which bounds the
+        memory used for temporary arrays.
+        Default: 2**20.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import LineTable
+    >>> table = LineTable("line.h5")
+    >>> lines = ["H__1_1215.67A", "O__6_1031.91A"]
+    >>> emissivity = table(lines, log_nH, log_T, clamp=True)
+    >>> emissivity.shape
+    (2,) + log_nH.shape
+
+    """
+
+    def __init__(self, filename, cache_size=8, batch_size=2**20):
+        self.filename = filename
+        self.cache_size = cache_size
+        self.batch_size = batch_size
+        self._stacks = OrderedDict()
+
+        input = h5py.File(filename,'r')
+        self.lines = [name for name in input
+                      if isinstance(input[name],h5py.Group) and
+                      not name.startswith('_')]
+        if not self.lines:
+            input.close()
+            raise RuntimeError("No lines found in %s." % filename)
+        group = input[self.lines[0]]
+        self.axis_names = ["log_nH", "log_T"]
+        axes = [group[name][()] for name in self.axis_names]
+        input.close()
+
+        self.grid = GridInterpolator(axes)
+        self.axes = self.grid.axes
+
+    def get_lines(self, lines):
+        """
+        Return the emissivities of the lines as a (line, nH * T) array,
+        reading them from the file if not already cached.
+        """
+
+        key = tuple(lines)
+        if key in self._stacks:
+            self._stacks.move_to_end(key)
+            return self._stacks[key]
+
+        stack = np.empty((len(lines), int(np.prod(self.grid.shape))))
+        input = h5py.File(self.filename,'r')
+        for i, line in enumerate(lines):
+            if line not in self.lines:
+                input.close()
+                raise RuntimeError("Line %s not found in %s." % (line, self.filename))
+            dataset = input[line]["emissivity"]
+            if dataset.shape != self.grid.shape:
+                input.close()
+                raise RuntimeError("Line %s has shape %s, expected %s." %
+                                   (line, dataset.shape, self.grid.shape))
+            stack[i] = dataset[()].ravel()
+        input.close()
+
+        self._stacks[key] = stack
+        while len(self._stacks) > self.cache_size:
+            self._stacks.popitem(last=False)
+        return stack
+
+    def __call__(self, lines, log_nH, log_T, clamp=False):
+        """
+        Interpolate the emissivities of several lines.
+
+        Parameters
+        ----------
+        lines : list
+            Names of the lines.
+        log_nH, log_T : arrays
+            Points at which to interpolate, broadcast against each
+            other.
+        clamp : optional, bool
+            If True, points outside of the grid take the value at the
+            nearest edge.  Otherwise, they raise an error.
+            Default: False.
+
+        Returns
+        -------
+        An array with one row of emissivities per line and the
+        broadcast shape of log_nH and log_T.
+        """
+
+        stack = self.get_lines(lines)
+        return self.grid.interpolate([stack], [log_nH, log_T], clamp=clamp,
+                                     batch_size=self.batch_size)[0]
@@ -0,0 +1,709 @@
+"""
+Cloudy runs of the map modes of CIAOLoop, which loop over temperature
+within each run of a grid, and the map files made from them.
+"""
+
+import math
+import numpy as np
+import os
+import re
+import time
+
+from cloudy_grids.run_cache import \
+    get_output_files
+from cloudy_grids.utilities import \
+    run_modes
+
+# Atomic weights of H through Zn, as used by CIAOLoop.
+atomic_masses = [1.00794, 4.002602, 6.941, 9.012182, 10.811, 12.0107,
+                 14.0067, 15.9994, 18.9984032, 20.1797, 22.989770, 24.3050,
+                 26.981538, 28.0855, 30.973761, 32.065, 35.453, 39.948,
+                 39.0983, 40.078, 44.955910, 47.867, 50.9415, 51.9961,
+                 54.938049, 55.845, 58.933200, 58.6934, 63.546, 65.409]
+
+# Symbol and name of H through Zn, as used by CIAOLoop.
+elements = [("H", "Hydrogen"), ("He", "Helium"), ("Li", "Lithium"),
+            ("Be", "Beryllium"), ("B", "Boron"), ("C", "Carbon"),
+            ("N", "Nitrogen"), ("O", "Oxygen"), ("F", "Fluorine"),
+            ("Ne", "Neon"), ("Na", "Sodium"), ("Mg", "Magnesium"),
+            ("Al", "Aluminium"), ("Si", "Silicon"), ("P", "Phosphorus"),
+            ("S", "Sulphur"), ("Cl", "Chlorine"), ("Ar", "Argon"),
+            ("K", "Potassium"), ("Ca", "Calcium"), ("Sc", "Scandium"),
+            ("Ti", "Titanium"), ("V", "Vanadium"), ("Cr", "Chromium"),
+            ("Mn", "Manganese"), ("Fe", "Iron"), ("Co", "Cobalt"),
+            ("Ni", "Nickel"), ("Cu", "Copper"), ("Zn", "Zinc")]
+
+# Data columns of a cooling map after the temperature.
+cooling_fields = ["Heating", "Cooling", "MMW"]
+
+# Conversion of emissivity map energy units to Hz.
+energy_conversion = {"MHz": 1e-6,
+                     "eV": 4.1356668e-15,
+                     "keV": 4.1356668e-18,
+                     "Rydbergs": 3.04093147e-16}
+
+# Files saved by each Cloudy run of a map, by cloudyRunMode.
+_map_saves = {run_modes["cooling"]: [("cooling", ".cooling"),
+                                     ("heating", ".heating"),
+                                     ("abundance", ".abundance"),
+                                     ("ionization means", ".ionization"),
+                                     ("physical conditions", ".physical")],
+              run_modes["emissivity"]: [("continuum", ".continuum"),
+                                        ("physical conditions", ".physical"),
+                                        ("continuum bins", ".bin"),
+                                        ("radius", ".radius")],
+              run_modes["ion_balance"]: [("ionization means", ".ionization")],
+              run_modes["line"]: [("lines", ".lines"),
+                                  ("physical conditions", ".physical")]}
+
+# Separators CIAOLoop writes between the temperatures of kept files.
+_file_labels = {".cloudyIn": "Input", ".cloudyOut": "Output",
+                ".cooling": "Cooling punch", ".heating": "Heating punch",
+                ".abundance": "Abundance punch",
+                ".ionization": "Ionization punch",
+                ".physical": "Physical conditions punch",
+                ".continuum": "Continuum punch",
+                ".bin": "Continuum bin punch", ".radius": "Radius punch",
+                ".lines": "Line punch"}
+
+def _get_float_setting(settings, name, default=None):
+    "Return a setting of a parameter file as a float, or default."
+    value = settings.get(name)
+    if value is None:
+        return default
+    return float(value)
+
+def get_cooling_map_temperatures(settings):
+    """
+    Return the temperatures of a cooling map from the coolingMapTmin,
+    coolingMapTmax, coolingMapTpoints, coolingMapdT and
+    coolingMapdLogT settings, as done by CIAOLoop.
+    """
+
+    Tmin = _get_float_setting(settings, "coolingMapTmin")
+    Tmax = _get_float_setting(settings, "coolingMapTmax")
+    dT = _get_float_setting(settings, "coolingMapdT")
+    dLogT = _get_float_setting(settings, "coolingMapdLogT")
+    Tpoints = _get_float_setting(settings, "coolingMapTpoints")
+
+    if dT is not None and dLogT is not None:
+        raise RuntimeError("coolingMapdT and coolingMapdLogT cannot both be set.")
+    nSet = sum([value is not None for value in
+                [Tmin, Tmax, dT if dT is not None else dLogT, Tpoints]])
+    if nSet > 3:
+        raise RuntimeError("Temperature loop overdefined: set only three values.")
+    if nSet < 3:
+        raise RuntimeError("Temperature loop not defined properly for cooling map mode.")
+
+    if dT is not None:
+        if Tmin is None:
+            Tmin = Tmax - dT * (Tpoints - 1)
+        elif Tmax is None:
+            Tmax = Tmin + dT * (Tpoints - 1)
+    elif dLogT is not None:
+        if Tmin is None:
+            Tmin = Tmax / 10**(dLogT * (Tpoints - 1))
+        elif Tmax is None:
+            Tmax = Tmin * 10**(dLogT * (Tpoints - 1))
+    elif Tpoints == 1:
+        dLogT = 1
+    else:
+        dLogT = math.log10(Tmax / Tmin) / (Tpoints - 1)
+
+    temperatures = []
+    temperature = Tmin
+    if dT is not None:
+        end = Tmax + 0.5 * dT
+    else:
+        end = Tmax * 10**(0.5 * dLogT)
+    while temperature < end:
+        temperatures.append(float("%.6e" % temperature))
+        if dT is not None:
+            temperature += dT
+        else:
+            temperature *= 10**dLogT
+    return np.array(temperatures)
+
+def get_emissivity_map_energies(settings):
+    """
+    Return the energies and bin widths of an emissivity map, read
+    from emissivityMapEnergyFile or made from the emissivityMapEmin,
+    emissivityMapEmax, emissivityMapEpoints and
+    emissivityMapLogEnergyBins settings, as done by CIAOLoop.
+    """
+
+    energyFile = settings.get("emissivityMapEnergyFile")
+    if energyFile:
+        with open(os.path.expanduser(energyFile), 'r') as f:
+            energies = [float("%.6e" % float(line)) for line in f if line.strip()]
+    else:
+        Emin = _get_float_setting(settings, "emissivityMapEmin")
+        Emax = _get_float_setting(settings, "emissivityMapEmax")
+        Epoints = _get_float_setting(settings, "emissivityMapEpoints")
+        if Emin is None:
+            raise RuntimeError("Emissivity map energy lower bound not set.")
+        if Emax is None:
+            raise RuntimeError("Emissivity map energy upper bound not set.")
+        if Epoints is None:
+            raise RuntimeError("Emissivity map number of bins not set.")
+        Epoints = int(Epoints)
+        if int(settings.get("emissivityMapLogEnergyBins", 0)):
+            step = math.log10(Emax / Emin) / Epoints
+            energies = [10**(step * (q + 0.5) + math.log10(Emin))
+                        for q in range(Epoints)]
+        else:
+            step = (Emax - Emin) / Epoints
+            energies = [step * (q + 0.5) + Emin for q in range(Epoints)]
+    if len(energies) < 2:
+        raise RuntimeError("Emissivity maps need at least two energies.")
+
+    energies = np.array(energies)
+    bins = np.empty(energies.size)
+    bins[0] = energies[1] - energies[0]
+    bins[-1] = energies[-1] - energies[-2]
+    bins[1:-1] = 0.5 * (energies[2:] - energies[:-2])
+    return energies, bins
+
+def _find_command_value(commands, name, log_default=True):
+    """
+    Return the value of the first command starting with name, e.g.,
+    hden, in linear units, or None.  Values are taken as logs unless
+    the command says linear, or, if log_default is False, says log.
+    """
+
+    for command in commands:
+        if not command.startswith(name + " "):
+            continue
+        value = command[len(name):]
+        if "linear" in value:
+            return float(value.replace("linear", ""))
+        if "log" in value:
+            return 10**float(value.replace("log", ""))
+        value = float(value)
+        return 10**value if log_default else value
+    return None
+
+def set_electron_fraction(commands):
+    """
+    Replace the metal free electron fraction command, which is not a
+    Cloudy command, with the set eden command giving that fraction of
+    the electron density of fully ionized gas with the hden and metals
+    of the commands, as done by CIAOLoop.
+    """
+
+    hden = _find_command_value(commands, "hden")
+    metals = _find_command_value(commands, "metals", log_default=False)
+
+    electronFactor = 9.153959e-3
+    hydrogenMassFraction = 10. / 14.
+    electronMetalFreeMax = (1 + hydrogenMassFraction) / (2 * hydrogenMassFraction)
+    commands = list(commands)
+    for i, command in enumerate(commands):
+        match = re.match(r'^metal free electron fraction (.+)$', command.rstrip("\n"))
+        if match is not None:
+            electronDensity = float(match.group(1)) + \
+              math.log10((electronMetalFreeMax + electronFactor * (metals or 0)) * hden)
+            commands[i] = "set eden %.15g\n" % electronDensity
+            break
+    return commands
+
+def calculate_jeans_length(hden, temperature, max_length=3.086e20):
+    """
+    Return the Jeans length in cm of gas with hydrogen number density
+    hden and temperature, for a primordial hydrogen mass fraction and
+    mu = 1, up to max_length, as done by CIAOLoop.
+    """
+
+    gamma = 5. / 3.
+    kboltz = 1.3806488e-16
+    mh = 1.67373522381e-24
+    G = 6.67384e-08
+    jeansLength = math.pi * (gamma * kboltz / (G * mh))**0.5 * \
+      (temperature / (hden * mh / 0.76))**0.5
+    return min(jeansLength, max_length)
+
+def _read_last_line(filename):
+    "Return the tab separated values of the last line of a file."
+    with open(filename, 'r') as f:
+        lines = f.read().splitlines()
+    return lines[-1].split("\t")
+
+def read_ionization_means(ionization_file):
+    """
+    Return the name and log ion fractions of each element in the last
+    table of a file saved with the punch ionization means command, as
+    read by CIAOLoop.
+    """
+
+    with open(ionization_file, 'r') as f:
+        lines = f.read().splitlines()
+    # The table is printed for every iteration, use the last.
+    header = [q for q, line in enumerate(lines) if "Hydrogen" in line]
+    if not header:
+        raise RuntimeError("Ionization file, %s, does not have proper format." %
+                           ionization_file)
+
+    fractions = []
+    for line in lines[header[-1]:]:
+        if not line:
+            break
+        match = re.match(r'^\s*([a-zA-z]+)', line)
+        if match is not None:
+            fractions.append((match.group(1), []))
+        species = len(fractions)
+        line = line[11:]
+        # CIAOLoop renormalizes the largest fraction through references
+        # to copies of the values, so the values read are the ones used.
+        while line[:7] and len(fractions[-1][1]) <= species:
+            value = line[:7]
+            fractions[-1][1].append(float(value) if value.strip() else 0.)
+            line = line[7:]
+    return fractions
+
+def read_mean_molecular_weight(abundance_file, ionization_file):
+    """
+    Return the mean molecular weight from the files of the punch
+    abundance and ionization means commands, as done by CIAOLoop.
+    """
+
+    abundances = [float(value) for value in _read_last_line(abundance_file)]
+    fractions = read_ionization_means(ionization_file)
+
+    totalMass = 0.
+    totalParticles = 0.
+    for q, (name, speciesFractions) in enumerate(fractions):
+        if abundances[q] > -30:
+            totalMass += 10**(abundances[q] - abundances[0]) * atomic_masses[q]
+            for w, fraction in enumerate(speciesFractions):
+                if fraction > -30:
+                    totalParticles += \
+                      10**(abundances[q] - abundances[0] + fraction) * (w + 1)
+    return totalMass / totalParticles
+
+def _get_scale(key_name, scale_factor):
+    """
+    Return n_H^2 (scale_factor 1) or n_H n_e (scale_factor 2) from the
+    physical conditions file of a run, and n_H.
+    """
+
+    values = _read_last_line(key_name + ".physical")
+    hden, eden = float(values[2]), float(values[3])
+    if scale_factor == 1:
+        return hden * hden, hden
+    elif scale_factor == 2:
+        return hden * eden, hden
+    raise RuntimeError("coolingScaleFactor must be either 1 or 2.")
+
+def read_cooling_output(key_name, scale_factor=1):
+    """
+    Return the heating and cooling divided by n_H^2 (scale_factor 1)
+    or n_H n_e (scale_factor 2) and the mean molecular weight from
+    the files saved by one temperature of a cooling map.
+    """
+
+    values = _read_last_line(key_name + ".cooling")
+    heating, cooling = float(values[2]), float(values[3])
+    scale, hden = _get_scale(key_name, scale_factor)
+    mmw = read_mean_molecular_weight(key_name + ".abundance",
+                                      key_name + ".ionization")
+    return heating / scale, cooling / scale, mmw
+
+def _read_continuum(key_name, energies, energy_bins, units):
+    """
+    Return the continuum saved by one temperature of an emissivity
+    map rebinned to the map energies and converted to an emissivity,
+    as done by CIAOLoop.
+    """
+
+    if units not in energy_conversion:
+        raise RuntimeError("Units: %s unavailable for conversion." % units)
+
+    def read_values(filename, columns, separator):
+        rows = []
+        with open(filename, 'r') as f:
+            for line in f:
+                if line.lstrip().startswith("#") or not line.strip():
+                    continue
+                values = line.split(separator)
+                rows.append([float(values[column]) for column in columns])
+        return np.array(rows)
+
+    continuum = read_values(key_name + ".continuum", [3], "\t")[:, 0]
+    cloudyBins = read_values(key_name + ".bin", [0, 2], None)
+    radius, depth, dr = read_values(key_name + ".radius", [1, 2, 3], "\t")[0]
+
+    frequencies = cloudyBins[:, 0] / energy_conversion["Rydbergs"]
+    widths = cloudyBins[:, 1] / energy_conversion["Rydbergs"]
+    lower = frequencies - 0.5 * widths
+    upper = frequencies + 0.5 * widths
+    # Convert nuF_nu to F_nu.
+    continuum = continuum / frequencies
+
+    mapFrequencies = energies / energy_conversion[units]
+    mapWidths = energy_bins / energy_conversion[units]
+    emissivity = np.zeros(energies.size)
+    for q, (frequency, width) in enumerate(zip(mapFrequencies, mapWidths)):
+        binLower = frequency - 0.5 * width
+        binUpper = frequency + 0.5 * width
+        above = np.nonzero(lower > binLower)[0]
+        if not above.size:
+            raise RuntimeError("Energy %g %s is beyond the continuum of %s." %
+                               (energies[q], units, key_name))
+        first = max(above[0] - 1, 0)
+        last = np.nonzero(upper[above[0]:] >= binUpper)[0]
+        last = above[0] + last[0] if last.size else frequencies.size - 1
+        overlap = np.minimum(binUpper, upper[first:last+1]) - \
+          np.maximum(binLower, lower[first:last+1])
+        emissivity[q] = (continuum[first:last+1] * overlap).sum() / width
+    # L = 4 pi r^2 F and em = L / (4/3 pi ((r + dr)^3 - r^3)).
+    emissivity *= 3 * radius**2 / ((radius - depth + dr)**3 - (radius - depth)**3)
+    return emissivity
+
+def _read_line_emissivities(key_name):
+    "Return the log emissivities of the last line of a line save file."
+    return [float(value) for value in _read_last_line(key_name + ".lines")[1:]]
+
+def get_header_commands(settings, index):
+    """
+    Return the lines listing the loop values of one run in the header
+    of a map file, as done by CIAOLoop.
+    """
+
+    lines = []
+    for loop, i in zip(settings["loops"], index):
+        commands = []
+        for command, values in loop:
+            value = str(values[i])
+            if command == "file":
+                lines.append("# file: %s\n" % value)
+            elif re.match(r'^%<(.+)>$', command) is None:
+                if "*" in command:
+                    commands.append(command.replace("*", value, 1))
+                else:
+                    commands.append("%s %s" % (command, value))
+        if len(loop) > 1:
+            lines.append("# set {\n%s# }\n" %
+                         "".join(["#\t%s\n" % command for command in commands]))
+        else:
+            lines.extend(["# %s\n" % command for command in commands])
+    return lines
+
+class MapGrid(object):
+    """
+    The Cloudy runs of a map grid (cloudyRunMode 1 to 4) and the map
+    files made from them, as done by CIAOLoop's map modes.
+
+    Each run of the grid is one Cloudy run per temperature, with the
+    commands of the run plus a constant temperature (or coronal
+    equilibrium) command and the save commands of the mode.  The
+    files of each temperature are written to
+    <prefix>_run<N>_T<i>.*, where i counts from 1, so the
+    temperatures can be run at the same time.  Once all have
+    finished, write_maps writes the map files of the run from the
+    values returned by read_output for each temperature, and
+    collect_files adds the warnings to <prefix>_run<N>.warnings and,
+    if saveCloudyOutputFiles is set, the input, output and save files
+    to <prefix>_run<N>.*, with a separator line for each temperature,
+    before removing the files of the temperatures.  Files saved by
+    commands using $ are always added.
+
+    Parameters
+    ----------
+    settings : dict
+        Settings of a CIAOLoop parameter file, as returned by
+        read_parameter_file.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids.executor import get_cloudy_input, read_parameter_file
+    >>> from cloudy_grids.map_modes import MapGrid
+    >>> settings = read_parameter_file("cooling.par")
+    >>> grid = MapGrid(settings)
+    >>> keyName = grid.get_key_name(1, 0)
+    >>> print (grid.get_input(get_cloudy_input(settings, (0, 0), keyName),
+    ...                       grid.temperatures[0], keyName))
+
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.mode = settings["cloudyRunMode"]
+        if self.mode not in _map_saves:
+            raise RuntimeError("cloudyRunMode = %d is not a map mode." % self.mode)
+        self.prefix = settings["outputDir"] + settings["outputFilePrefix"]
+        self.temperatures = get_cooling_map_temperatures(settings)
+        self.scale_factor = int(settings.get("coolingScaleFactor", 1))
+        self.save_suffixes = [suffix for name, suffix in _map_saves[self.mode]]
+
+        if self.mode == run_modes["emissivity"]:
+            self.energies, self.energy_bins = get_emissivity_map_energies(settings)
+            self.energy_units = settings.get("emissivityMapEnergyUnits", "Rydbergs")
+        elif self.mode == run_modes["ion_balance"]:
+            symbols = [symbol for symbol, name in elements]
+            self.elements = settings.get("ionFractionElements", "").split()
+            if not self.elements:
+                raise RuntimeError("No elements given for ion fraction tables.")
+            for element in self.elements:
+                if element not in symbols:
+                    raise RuntimeError("%s is not a valid element for ion fraction table." %
+                                       element)
+        elif self.mode == run_modes["line"]:
+            self.lines = settings.get("lineMapLines", [])
+            if not self.lines:
+                raise RuntimeError("No lines given with lineMapLine.")
+
+    def get_key_name(self, run, temperature_index=None):
+        """
+        Return the path and prefix of the files of a run, or of one of
+        its temperatures.
+        """
+
+        keyName = "%s_run%d" % (self.prefix, run)
+        if temperature_index is None:
+            return keyName
+        return "%s_T%d" % (keyName, temperature_index + 1)
+
+    def get_input(self, cloudy_input, temperature, key_name):
+        """
+        Return the Cloudy input for one temperature of one run from the
+        commands of the run, as returned by get_cloudy_input with the
+        same key_name, with the files of the mode saved to key_name
+        plus the suffix of each file.
+        """
+
+        commands = cloudy_input.splitlines(True)
+
+        temperature = "%f" % temperature
+        if self.mode in (run_modes["cooling"], run_modes["ion_balance"]):
+            commands = set_electron_fraction(commands)
+            if int(self.settings.get("coolingMapUseJeansLength", 0)) == 1:
+                hden = _find_command_value(commands, "hden")
+                if hden is None:
+                    raise RuntimeError("coolingMapUseJeansLength needs an hden command.")
+                jeansLength = calculate_jeans_length(
+                    hden, float(temperature),
+                    max_length=_get_float_setting(
+                        self.settings, "coolingMapMaximumJeansLength", 3.086e20))
+                commands.append("radius 1e30 %.15g linear\n" % jeansLength)
+
+        coronal = [i for i, command in enumerate(commands)
+                   if re.search(r'coronal\s+equilibrium', command, re.I)]
+        if coronal:
+            del commands[coronal[0]]
+            commands.append("coronal equilibrium T = %s linear\n" % temperature)
+        else:
+            commands.append("constant temperature %s K linear\n" % temperature)
+
+        for name, suffix in _map_saves[self.mode]:
+            if name == "lines":
+                commands.append('save last lines, emissivity "%s%s"\n' % (key_name, suffix))
+                commands.extend(["%s\n" % line for line in self.lines])
+                commands.append("end of lines\n")
+            else:
+                commands.append('punch last %s file = "%s%s"\n' % (name, key_name, suffix))
+        return "".join(commands)
+
+    def read_output(self, key_name):
+        """
+        Return the values of one temperature of a map from the files
+        saved by a run made with get_input: the heating, cooling and
+        mean molecular weight of cooling maps, the emissivity at each
+        energy of emissivity maps, the log ion fractions of each
+        element of ion fraction maps, and the log emissivity of each
+        line of line maps.  Heating, cooling and emissivities are
+        divided by n_H^2, or n_H n_e if coolingScaleFactor is 2, and
+        line emissivities by n_H^2.
+        """
+
+        if self.mode == run_modes["cooling"]:
+            return list(read_cooling_output(key_name, scale_factor=self.scale_factor))
+
+        elif self.mode == run_modes["emissivity"]:
+            scale, hden = _get_scale(key_name, self.scale_factor)
+            emissivity = _read_continuum(key_name, self.energies,
+                                         self.energy_bins, self.energy_units)
+            return (emissivity / scale).tolist()
+
+        elif self.mode == run_modes["ion_balance"]:
+            # CIAOLoop only keeps the ionization files in this case.
+            if int(self.settings.get("saveMinimumOutputFiles", 0)):
+                return {}
+            names = dict([(name, symbol) for symbol, name in elements])
+            fractions = {}
+            for name, values in read_ionization_means(key_name + ".ionization"):
+                if names.get(name) in self.elements:
+                    fractions[names[name]] = values
+            ionFractions = {}
+            for element in self.elements:
+                nIons = [symbol for symbol, name in elements].index(element) + 2
+                values = fractions.get(element, [])[:nIons]
+                ionFractions[element] = values + [-30.] * (nIons - len(values))
+            return ionFractions
+
+        scale, hden = _get_scale(key_name, 1)
+        return [value - 2 * math.log10(hden)
+                for value in _read_line_emissivities(key_name)]
+
+    def get_map_files(self, key_name):
+        "Return the map files of a run written by write_maps."
+        if self.mode == run_modes["ion_balance"]:
+            if int(self.settings.get("saveMinimumOutputFiles", 0)):
+                return []
+            return ["%s_%s.dat" % (key_name, element) for element in self.elements]
+        return [key_name + ".dat"]
+
+    def write_maps(self, key_name, index, rows, start_time=None, comments=()):
+        """
+        Write the map files of one run from the values of each
+        temperature returned by read_output, with None for the
+        temperatures where Cloudy crashed.  As done by CIAOLoop, these
+        are left out, except for cooling maps, where they are zeros,
+        and line maps, where they have no emissivities.  start_time,
+        from time.time, is written as the date at the top, and
+        comments, a list of lines, after the loop values.
+        """
+
+        def get_header(title):
+            lines = ["# %s\n" % time.ctime(start_time), "#\n", "# %s\n" % title,
+                     "#\n", "# Loop values:\n"]
+            lines.extend(get_header_commands(self.settings, index))
+            lines.append("#\n")
+            lines.extend(["# %s\n" % comment for comment in comments])
+            lines.append("# Data Columns:\n")
+            return lines
+
+        temperatures = self.temperatures
+        if self.mode == run_modes["cooling"]:
+            lines = get_header("Cooling Map File")
+            lines.extend(["# Te [K]\n", "# Heating [erg s^-1 cm^3]\n",
+                          "# Cooling [erg s^-1 cm^3]\n",
+                          "# Mean Molecular Weight [amu]\n", "#\n",
+                          "#Te\t\tHeating\t\tCooling\t\tMMW\n"])
+            for temperature, row in zip(temperatures, rows):
+                lines.append("%.6e\t%.6e\t%.6e\t%.6f\n" %
+                             tuple([temperature] + list(row or [0, 0, 0])))
+            with open(key_name + ".dat", 'w') as f:
+                f.write("".join(lines))
+
+        elif self.mode == run_modes["emissivity"]:
+            lines = get_header("Emissivity Map File")
+            lines.extend(["# Te [K]\n", "# Emissivity [erg s^-1 cm^3 Hz^-1]\n",
+                          "#\n", "#E [%s]      %s\n" %
+                          (self.energy_units,
+                           "  ".join(["%.6e" % energy for energy in self.energies])),
+                          "#Te            em\n"])
+            for temperature, row in zip(temperatures, rows):
+                if row is not None:
+                    lines.append("%.6e%s\n" % (temperature, "".join(
+                        ["  %.6e" % value for value in row])))
+            with open(key_name + ".dat", 'w') as f:
+                f.write("".join(lines))
+
+            # The inverted map is better for plotting spectra.
+            lines = ["#Te         %s\n" % "".join(
+                ["  %.6e" % temperature for temperature in temperatures]),
+                     "#E            L_nu\n"]
+            for q, energy in enumerate(self.energies):
+                lines.append("%.6e%s\n" % (energy, "".join(
+                    ["  %.6e" % (0 if row is None else row[q]) for row in rows])))
+            with open(key_name + ".inv", 'w') as f:
+                f.write("".join(lines))
+
+        elif self.mode == run_modes["ion_balance"]:
+            names = dict(elements)
+            for element, mapFile in zip(self.elements, self.get_map_files(key_name)):
+                nIons = [symbol for symbol, name in elements].index(element) + 2
+                lines = get_header("%s Ion Fraction File" % names[element])
+                lines.extend(["# log(Te [K])\n", "# log(Ion Fractions)\n", "#\n",
+                              "#Te\t%s\n" % "\t".join([str(i) for i in range(1, nIons + 1)])])
+                for temperature, row in zip(temperatures, rows):
+                    if row is not None:
+                        lines.append("%.3f%s\n" % (math.log10(temperature), "".join(
+                            ["\t%.3f" % value for value in row[element]])))
+                with open(mapFile, 'w') as f:
+                    f.write("".join(lines))
+
+        else:
+            lines = get_header("Cooling Map File")
+            lines.extend(["# log10 Te [K]\n",
+                          "# log10 Emissivities / n_H^2 [erg s^-1 cm^3]\n", "#\n",
+                          "#Te   %s\n" % "  ".join([re.sub(r'\s', "_", line)
+                                                    for line in self.lines])])
+            for temperature, row in zip(temperatures, rows):
+                lines.append("%.3f  %s\n" % (math.log10(temperature), "  ".join(
+                    ["%.4f" % value for value in row or []])))
+            with open(key_name + ".dat", 'w') as f:
+                f.write("".join(lines))
+
+    def _keeps_file(self, suffix):
+        "Return True if a file of a temperature is added to the run."
+        if suffix not in _file_labels and suffix not in self.save_suffixes:
+            return True
+        if int(self.settings.get("saveCloudyOutputFiles", 0)):
+            return True
+        return int(self.settings.get("saveMinimumOutputFiles", 0)) and \
+          self.mode == run_modes["ion_balance"] and suffix == ".ionization"
+
+    def get_kept_files(self, key_name):
+        """
+        Return the files of one temperature, other than its input,
+        that collect_files adds to the files of the run, as (filename,
+        suffix) pairs.
+        """
+
+        with open(key_name + ".cloudyIn", 'r') as f:
+            return [(filename, suffix) for filename, suffix in
+                    get_output_files(f.read(), key_name)
+                    if self._keeps_file(suffix)]
+
+    def collect_files(self, key_name, point_key_names, crashed, warnings):
+        """
+        Add the warnings and kept files of the temperatures of one run
+        to the files of the run, as done by CIAOLoop, and remove the
+        files of the temperatures.  point_key_names, crashed and
+        warnings give the path and prefix of the files of each
+        temperature, whether Cloudy crashed, and the warnings returned
+        by check_cloudy_output.
+        """
+
+        # Remove the files of an earlier try of the run.
+        for suffix in [".cloudyIn", ".cloudyOut", ".warnings"] + self.save_suffixes:
+            if os.path.exists(key_name + suffix):
+                os.remove(key_name + suffix)
+
+        started = set()
+        def push_file(filename, suffix, separator):
+            runFile = key_name + suffix
+            with open(filename, 'r', errors="replace") as f:
+                text = f.read()
+            with open(runFile, 'a' if runFile in started else 'w') as f:
+                f.write(separator + text)
+            started.add(runFile)
+
+        for temperature, pointKeyName, pointCrashed, pointWarnings in \
+          zip(self.temperatures, point_key_names, crashed, warnings):
+            separator = "for T = %.3e.\n" % temperature
+            inputFile = pointKeyName + ".cloudyIn"
+            files = [(inputFile, ".cloudyIn")]
+            if os.path.exists(inputFile):
+                with open(inputFile, 'r') as f:
+                    files.extend(get_output_files(f.read(), pointKeyName))
+
+            if pointWarnings:
+                warningFile = key_name + ".warnings"
+                with open(warningFile, 'a' if warningFile in started else 'w') as f:
+                    f.write("## Warnings produced %s" % separator)
+                    f.write("".join(["%s\n" % warning for warning in pointWarnings]))
+                started.add(warningFile)
+
+            for filename, suffix in files:
+                if not os.path.exists(filename):
+                    continue
+                if not pointCrashed and self._keeps_file(suffix):
+                    if suffix not in _file_labels and suffix not in self.save_suffixes:
+                        push_file(filename, suffix, "## User output punch %s" % separator)
+                    else:
+                        push_file(filename, suffix, "## %s %s" %
+                                  (_file_labels[suffix], separator))
+                os.remove(filename)
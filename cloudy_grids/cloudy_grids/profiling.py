@@ -0,0 +1,233 @@
+"""
+Per-stage timing and memory instrumentation for conversions.
+"""
+
+from collections import OrderedDict
+import json
+import os
+import resource
+import sys
+import time
+
+def get_peak_rss():
+    "Return the peak resident memory of this process in bytes."
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+def get_current_rss():
+    """
+    Return the resident memory of this process in bytes, or, where
+    /proc is not available, the peak resident memory.
+    """
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return get_peak_rss()
+    return pages * resource.getpagesize()
+
+def format_time(seconds):
+    "Format a number of seconds as h:mm:ss."
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+class Stage(object):
+    "Totals for one stage of a conversion, timed each time it is entered."
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+        self.time = 0.
+        self.calls = 0
+        self.maps = 0
+        self.bytes_read = 0
+        self.rss_growth = 0
+        self._start = None
+        self._rss_start = None
+
+    def __enter__(self):
+        self.profile._current.append(self)
+        self._rss_start = get_current_rss()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.time += time.perf_counter() - self._start
+        self.calls += 1
+        self.rss_growth = max(self.rss_growth, get_current_rss() - self._rss_start)
+        self.profile._current.pop()
+        return False
+
+    def to_dict(self):
+        "Return the totals of the stage as a dict."
+        return OrderedDict(
+            [("name", self.name),
+             ("time", self.time),
+             ("calls", self.calls),
+             ("maps", self.maps),
+             ("bytes_read", self.bytes_read),
+             ("maps_per_second", self.maps / self.time if self.time > 0 else 0.),
+             ("rss_growth", self.rss_growth)])
+
+class ConversionProfile(object):
+    """
+    Record the wall time, maps and bytes read, and growth of resident
+    memory of each stage of one or more conversions.
+
+    Pass an instance to a converter with profile= to record it, then
+    call write to save a JSON report.  Stages are entered with the
+    stage method, which may be called many times for the same stage,
+    e.g., once per block of maps.  The memory of a stage is the largest
+    increase of the resident memory of the calling process from the
+    start to the end of one call, so memory freed before the stage
+    ends and the worker processes used with jobs > 1 are not counted.
+    The peak resident memory of the whole process is reported with
+    the totals.
+
+    Parameters
+    ----------
+    progress_interval : optional, float
+        If set, print a progress line with the number of maps read,
+        the read rate, and the estimated time remaining at most once
+        per this many seconds.
+        Default: None.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import ConversionProfile, convert_cooling_tables
+    >>> profile = ConversionProfile(progress_interval=10)
+    >>> convert_cooling_tables("cooling/cooling.run", "cooling.h5",
+    ...                        profile=profile)
+    >>> profile.write("cooling_profile.json")
+
+    """
+
+    enabled = True
+
+    def __init__(self, progress_interval=None):
+        self.progress_interval = progress_interval
+        self.stages = OrderedDict()
+        self.total_maps = 0
+        self._current = []
+        self._maps = 0
+        self._start = time.perf_counter()
+        self._progress_start = None
+        self._last_progress = None
+
+    def stage(self, name):
+        "Return the stage with this name, to be used as a context manager."
+        if name not in self.stages:
+            self.stages[name] = Stage(self, name)
+        return self.stages[name]
+
+    def set_total_maps(self, maps):
+        "Set the number of maps to be read, used for the progress estimate."
+        self.total_maps = maps
+        self._maps = 0
+        self._progress_start = self._last_progress = time.perf_counter()
+
+    def add_maps(self, map_files):
+        """
+        Count the maps of a list of runs, each a list of map files,
+        as read in the current stage.
+        """
+
+        maps = 0
+        nbytes = 0
+        for files in map_files:
+            maps += 1
+            for mapFile in files:
+                try:
+                    nbytes += os.path.getsize(mapFile)
+                except OSError:
+                    pass
+        if self._current:
+            self._current[-1].maps += maps
+            self._current[-1].bytes_read += nbytes
+        self._maps += maps
+
+        if self.progress_interval is None or self._progress_start is None:
+            return
+        t_now = time.perf_counter()
+        if t_now - self._last_progress < self.progress_interval and \
+          self._maps < self.total_maps:
+            return
+        self._last_progress = t_now
+        elapsed = t_now - self._progress_start
+        rate = self._maps / elapsed if elapsed > 0 else 0.
+        if rate > 0:
+            eta = format_time((self.total_maps - self._maps) / rate)
+        else:
+            eta = "unknown"
+        print ("Read %d of %d maps (%.1f%%), %.1f maps/s, %s elapsed, ETA %s." %
+               (self._maps, self.total_maps,
+                100. * self._maps / max(self.total_maps, 1), rate,
+                format_time(elapsed), eta))
+
+    def to_dict(self):
+        "Return the report as a dict."
+        stages = [stage.to_dict() for stage in self.stages.values()]
+        maps = sum([stage["maps"] for stage in stages])
+        elapsed = time.perf_counter() - self._start
+        return OrderedDict(
+            [("time", elapsed),
+             ("maps", maps),
+             ("bytes_read", sum([stage["bytes_read"] for stage in stages])),
+             ("peak_rss", get_peak_rss()),
+             ("stages", stages)])
+
+    def write(self, filename):
+        "Write the report to a JSON file."
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self):
+        "Return a table of the time and memory of each stage."
+        lines = ["%-16s %10s %8s %12s %12s %16s" %
+                 ("stage", "time (s)", "maps", "MB read", "maps/s",
+                  "RSS growth (MB)")]
+        for stage in self.stages.values():
+            values = stage.to_dict()
+            lines.append("%-16s %10.3f %8d %12.2f %12.1f %16.1f" %
+                         (stage.name, values["time"], values["maps"],
+                          values["bytes_read"] / 2**20,
+                          values["maps_per_second"],
+                          values["rss_growth"] / 2**20))
+        return "\n".join(lines)
+
+class _NullStage(object):
+    "A stage that records nothing."
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class NullProfile(object):
+    "A profile that records nothing, used when profiling is off."
+
+    enabled = False
+
+    _stage = _NullStage()
+
+    def stage(self, name):
+        return self._stage
+
+    def set_total_maps(self, maps):
+        pass
+
+    def add_maps(self, map_files):
+        pass
+
+null_profile = NullProfile()
+
+def get_profile(profile):
+    "Return profile, or the null profile if it is None."
+    if profile is None:
+        return null_profile
+    return profile
@@ -0,0 +1,278 @@
+"""
+Run cooling map grids adaptively, only running Cloudy where the
+tables are not smooth.
+"""
+
+import itertools
+import numpy as np
+import os
+
+from cloudy_grids.executor import \
+    ExecutorReport, \
+    get_cloudy_input, \
+    get_grid_runs, \
+    get_grid_shape, \
+    get_run_line, \
+    read_parameter_file, \
+    run_cloudy_models, \
+    write_run_file_header
+from cloudy_grids.map_modes import \
+    MapGrid, \
+    cooling_fields
+from cloudy_grids.run_cache import \
+    RunCache
+
+def _get_coarse_indices(size, step):
+    "Return every step-th index of a dimension and the last one."
+    indices = list(range(0, size, step))
+    if indices[-1] != size - 1:
+        indices.append(size - 1)
+    return indices
+
+def _interpolate_cell(values, cell, points):
+    """
+    Interpolate multilinearly between the corners of a cell, a list of
+    (lower, upper) index pairs, at the grid points given by a list of
+    indices for each dimension.
+    """
+
+    result = values[np.ix_(*[[lower, upper] for lower, upper in cell])]
+    for d, ((lower, upper), indices) in enumerate(zip(cell, points)):
+        indices = np.asarray(indices, dtype=float)
+        if upper > lower:
+            t = (indices - lower) / (upper - lower)
+        else:
+            t = np.zeros(indices.size)
+        weights = np.column_stack([1 - t, t])
+        result = np.moveaxis(np.tensordot(weights, result, axes=([1], [d])), 0, d)
+    return result
+
+def refine_cooling_grid(parameter_file, tolerance=0.05, coarse_step=8,
+                        fields=("Heating", "Cooling"), jobs=None,
+                        cloudy_exe=None, cache_dir=None, cache_size=None,
+                        report_file=None):
+    """
+    Run a cooling map grid with Cloudy only where interpolation
+    between coarser points is not accurate enough, then write the run
+    file and map files CIAOLoop would have made for the full grid.
+
+    The grid is that of a cooling map parameter file (cloudyRunMode =
+    1), with the temperatures as the last dimension.  Cloudy is first
+    run on every coarse_step-th point of each dimension.  Each cell of
+    points is then checked by running Cloudy at its center and
+    comparing with the multilinear interpolation of the log of the
+    fields from the corners.  If any differs by more than tolerance
+    in dex, all the points halfway between the corners are run and
+    the cell is split in two along each dimension, and so on, until
+    the cells are one point wide.  Otherwise, the cell is smooth and
+    its points are interpolated from the corners.  Interpolation is
+    linear in the index of each dimension, so in the log of T for
+    temperatures with even log steps.  As the error is only checked
+    at the cell centers, features smaller than the coarse cells can
+    be missed, so coarse_step should resolve the narrowest features
+    expected.
+
+    Each Cloudy run is one temperature of one run of the grid, with
+    the input of CIAOLoop's cooling map mode and its files in
+    <prefix>_run<N>_T<i>.*.  These are removed once read unless
+    saveCloudyOutputFiles is set.
+
+    Parameters
+    ----------
+    parameter_file : string
+        A CIAOLoop cooling map parameter file.
+    tolerance : optional, float
+        Largest difference in dex between a point and its
+        interpolation for a cell to be left unrefined.
+        Default: 0.05.
+    coarse_step : optional, int or list of ints
+        Spacing in grid points of the first points run, for all
+        dimensions or for each loop and then the temperature.
+        Default: 8.
+    fields : optional, list of strings
+        Fields checked for refinement, from Heating, Cooling and MMW.
+        All are interpolated.
+        Default: ("Heating", "Cooling").
+    jobs : optional, int
+        Maximum number of Cloudy runs at once.
+        Default: None, the number of cpus.
+    cloudy_exe : optional, string
+        Cloudy command, overriding cloudyExe of the parameter file.
+        Default: None.
+    cache_dir : optional, string
+        Directory of a cache of Cloudy runs, see run_cloudy_grid.
+        Default: None.
+    cache_size : optional, float
+        Total size in MB of the cache.
+        Default: None.
+    report_file : optional, string
+        If given, write the start and end time of each Cloudy run to
+        this JSON file.
+        Default: None.
+
+    Returns
+    -------
+    run_file : string
+        Path to the run file of the full grid, for the converters.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids.refinement import refine_cooling_grid
+    >>> run_file = refine_cooling_grid("cooling.par", tolerance=0.02, jobs=16)
+    >>> convert_cooling_tables(run_file, "cooling.h5")
+
+    """
+
+    settings = read_parameter_file(parameter_file)
+    if settings["cloudyRunMode"] != 1:
+        raise RuntimeError("Only cooling map grids (cloudyRunMode = 1) can be refined.")
+    for field in fields:
+        if field not in cooling_fields:
+            raise RuntimeError("Fields must be from %s." % ", ".join(cooling_fields))
+    if cloudy_exe is None:
+        cloudy_exe = settings["cloudyExe"]
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if not os.path.isdir(settings["outputDir"]):
+        os.makedirs(settings["outputDir"])
+
+    grid = MapGrid(settings)
+    temperatures = grid.temperatures
+    shape = tuple(get_grid_shape(settings) + [temperatures.size])
+    if np.isscalar(coarse_step):
+        coarse_step = [coarse_step] * len(shape)
+    if len(coarse_step) != len(shape):
+        raise RuntimeError("coarse_step needs a value for each loop and the temperature.")
+
+    prefix = settings["outputDir"] + settings["outputFilePrefix"]
+    keepFiles = int(settings.get("saveCloudyOutputFiles", 0))
+    checkFields = [cooling_fields.index(field) for field in fields]
+
+    values = np.zeros(shape + (len(cooling_fields),))
+    known = np.zeros(shape, dtype=bool)
+    report = ExecutorReport(jobs)
+    cache = None
+    if cache_dir is not None:
+        cache = RunCache(cache_dir, cloudy_exe, max_size=cache_size)
+        report.cache = cache
+
+    def get_key_name(point):
+        index = np.unravel_index(point - 1, shape)
+        run = int(np.ravel_multi_index(index[:-1], shape[:-1])) + settings["runStartIndex"]
+        return index, grid.get_key_name(run, index[-1])
+
+    def get_input(point):
+        index, keyName = get_key_name(point)
+        return keyName, grid.get_input(get_cloudy_input(settings, index[:-1], keyName),
+                                       temperatures[index[-1]], keyName)
+
+    def read_output(point):
+        index, keyName = get_key_name(point)
+        return grid.read_output(keyName), grid.get_kept_files(keyName)
+
+    def read_point(point, crashed, output):
+        index, keyName = get_key_name(point)
+        # Like CIAOLoop, a crashed run gives zeros.
+        if not crashed:
+            values[index] = output
+        known[index] = True
+        if not keepFiles:
+            for suffix in [".cloudyIn", ".cloudyOut"] + grid.save_suffixes:
+                if os.path.exists(keyName + suffix):
+                    os.remove(keyName + suffix)
+
+    def run_points(points):
+        points = sorted(set([int(np.ravel_multi_index(index, shape)) + 1
+                             for index in points if not known[index]]))
+        if points:
+            run_cloudy_models(points, get_input, cloudy_exe, jobs, report=report,
+                              cache=cache, exit_on_crash=settings["exitOnCrash"],
+                              on_finish=read_point, read_output=read_output)
+
+    def get_log(index):
+        return np.log10(np.maximum(values[index], np.finfo(float).tiny))
+
+    coarse = [_get_coarse_indices(size, step) for size, step in zip(shape, coarse_step)]
+    print ("Running %d coarse points of %d." %
+           (np.prod([len(indices) for indices in coarse]), np.prod(shape)))
+    run_points(itertools.product(*coarse))
+
+    cells = list(itertools.product(
+        *[list(zip(indices[:-1], indices[1:])) or [(0, 0)] for indices in coarse]))
+    smooth = []
+    level = 0
+    while cells:
+        level += 1
+        cells = [cell for cell in cells
+                 if max([upper - lower for lower, upper in cell]) > 1]
+        centers = [tuple([(lower + upper) // 2 for lower, upper in cell])
+                   for cell in cells]
+        run_points(centers)
+
+        split = []
+        for cell, center in zip(cells, centers):
+            corners = [tuple(corner) for corner in
+                       itertools.product(*[[lower, upper] for lower, upper in cell])]
+            cornerValues = np.zeros((2,) * len(shape) + (len(cooling_fields),))
+            for corner in corners:
+                position = tuple([int(c != lower) for c, (lower, upper) in zip(corner, cell)])
+                cornerValues[position] = get_log(corner)
+            estimate = _interpolate_cell(
+                cornerValues, [(0, 1)] * len(shape),
+                [[(c - lower) / (upper - lower) if upper > lower else 0]
+                 for c, (lower, upper) in zip(center, cell)])
+            error = np.abs(get_log(center) - estimate.reshape(-1))[checkFields]
+            if error.max() > tolerance:
+                split.append(cell)
+            else:
+                smooth.append(cell)
+
+        run_points(itertools.chain(*[
+            itertools.product(*[sorted(set([lower, (lower + upper) // 2, upper]))
+                                for lower, upper in cell]) for cell in split]))
+        cells = []
+        for cell in split:
+            cells.extend(itertools.product(
+                *[[(lower, upper)] if upper - lower < 2 else
+                  [(lower, (lower + upper) // 2), ((lower + upper) // 2, upper)]
+                  for lower, upper in cell]))
+        print ("Level %d: %d cells refined, %d smooth, %d of %d points run." %
+               (level, len(split), len(smooth), known.sum(), known.size))
+
+    # Interpolate the points of the smooth cells that were not run.
+    logValues = np.log10(np.maximum(values, np.finfo(float).tiny))
+    filled = known.copy()
+    for cell in smooth:
+        box = tuple([slice(lower, upper + 1) for lower, upper in cell])
+        missing = ~filled[box]
+        if not missing.any():
+            continue
+        estimate = _interpolate_cell(
+            logValues, cell, [range(lower, upper + 1) for lower, upper in cell])
+        boxValues = values[box]
+        boxValues[missing] = 10**estimate[missing]
+        filled[box] = True
+    if not filled.all():
+        raise RuntimeError("%d points were neither run nor interpolated." %
+                           (~filled).sum())
+
+    run_file = prefix + ".run"
+    write_run_file_header(run_file, settings)
+    with open(run_file, 'a') as f:
+        for run, index in get_grid_runs(settings):
+            f.write("%d\t%s\n" % (run, get_run_line(settings, index)))
+            grid.write_maps(grid.get_key_name(run), index, values[index].tolist(),
+                            comments=["%d of %d temperatures run with Cloudy, "
+                                      "the rest interpolated." %
+                                      (known[index].sum(), shape[-1])])
+
+    report.finish()
+    if report_file is not None:
+        report.write(report_file)
+    print ("Ran %d of %d points (%.1f%%) with tolerance %g dex." %
+           (known.sum(), known.size, 100. * known.sum() / known.size, tolerance))
+    print (report.summary())
+    if cache is not None:
+        print (cache.summary())
+    return run_file
@@ -0,0 +1,269 @@
+"""
+Cache of Cloudy runs keyed by their input, shared between grids.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+
+# Cloudy ignores lines starting with these.
+_comment_prefixes = ("#", "//", "%")
+
+def normalize_cloudy_input(cloudy_input, key_name):
+    """
+    Return the commands of a Cloudy input in a form that does not
+    depend on the output file names or the formatting.  key_name, the
+    path and prefix of the output files of the run, is replaced with
+    $, comment and blank lines are removed, and, outside of quotes,
+    text is made lower case and runs of white space are made single
+    spaces, as these do not change what Cloudy does.
+    """
+
+    lines = []
+    for line in cloudy_input.replace(key_name, "$").splitlines():
+        line = line.strip()
+        if not line or line.startswith(_comment_prefixes):
+            continue
+        parts = line.split('"')
+        for i in range(0, len(parts), 2):
+            parts[i] = re.sub(r'\s+', ' ', parts[i].lower())
+        lines.append('"'.join(parts))
+    return "\n".join(lines) + "\n"
+
+def get_executable_id(cloudy_exe):
+    """
+    Return a hash of the Cloudy executable, its arguments, and the
+    Cloudy data path, so runs with a different version of Cloudy or
+    its data are not taken from the cache.
+    """
+
+    args = shlex.split(cloudy_exe)
+    exe = shutil.which(args[0]) or args[0]
+    sha = hashlib.sha1()
+    try:
+        with open(exe, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b""):
+                sha.update(block)
+    except OSError:
+        raise RuntimeError("Could not read Cloudy executable: %s." % exe)
+    sha.update("\0".join(args[1:]).encode())
+    sha.update(os.environ.get("CLOUDY_DATA_PATH", "").encode())
+    return sha.hexdigest()
+
+def get_output_files(cloudy_input, key_name):
+    """
+    Return the files written by a run, the .cloudyOut file and the
+    quoted file names of its commands that start with key_name, as
+    (filename, suffix) pairs, where the suffix is the rest of the name.
+    """
+
+    files = OrderedDict([(key_name + ".cloudyOut", ".cloudyOut")])
+    for line in cloudy_input.splitlines():
+        line = line.strip()
+        if line.startswith(_comment_prefixes):
+            continue
+        for name in line.split('"')[1::2]:
+            if name.startswith(key_name) and len(name) > len(key_name):
+                files[name] = name[len(key_name):]
+    return [(filename, suffix) for filename, suffix in files.items()
+            if os.path.isfile(filename)]
+
+class RunCache(object):
+    """
+    Store the output files of Cloudy runs by the hash of their input
+    and the Cloudy executable, so a run with the same commands in any
+    later grid copies the output instead of running Cloudy.
+
+    Each entry is a directory named by the key holding the files
+    written by one run, the .cloudyOut file and the files of save
+    commands whose names start with the path and prefix of the run
+    (key_name), i.e., that use $, stored by the rest of their name.  Files
+    read by the commands, such as tables of spectra, are not part of
+    the key, only their names.  Entries are touched when used, and
+    the least recently used entries are removed once the total size
+    is over max_size.
+
+    For map grids, each temperature of a run is keyed by its own
+    input and its entry holds the data read from the output, i.e.,
+    its row of the map files, in output.json (see store_output),
+    along with only the files the grid keeps.
+
+    Parameters
+    ----------
+    cache_dir : string
+        Directory holding the cache entries.
+    cloudy_exe : string
+        Cloudy command, whose identity is part of the key.
+    max_size : optional, float
+        Total size in MB of the cache.  If None, there is no limit.
+        Default: None.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids.executor import run_cloudy_grid
+    >>> report = run_cloudy_grid("grid.par", cache_dir="cloudy_cache",
+    ...                          cache_size=10240)
+    >>> print (report.cache.summary())
+
+    Map grids, such as noUVB.par, go through the cache one
+    temperature at a time, also when run with refine_cooling_grid.
+
+    >>> report = run_cloudy_grid("noUVB.par", cache_dir="cloudy_cache")
+    >>> from cloudy_grids.refinement import refine_cooling_grid
+    >>> refine_cooling_grid("noUVB.par", cache_dir="cloudy_cache",
+    ...                     cache_size=10240)
+
+    """
+
+    def __init__(self, cache_dir, cloudy_exe, max_size=None):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.executable_id = get_executable_id(cloudy_exe)
+        self.hits = 0
+        self.misses = 0
+        self.stored = 0
+        self.evicted = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Size of each entry, least recently used first.
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if entry.is_dir() and not entry.name.endswith(".tmp"):
+                entries.append((entry.stat().st_mtime_ns, entry.name,
+                                self._get_entry_size(entry.path)))
+        self.entries = OrderedDict([(key, size) for mtime, key, size in sorted(entries)])
+
+    @staticmethod
+    def _get_entry_size(path):
+        return sum([entry.stat().st_size for entry in os.scandir(path)])
+
+    @property
+    def size(self):
+        "Total size of the entries in bytes."
+        return sum(self.entries.values())
+
+    def get_key(self, cloudy_input, key_name):
+        "Return the cache key of a run with this input."
+        sha = hashlib.sha1(self.executable_id.encode())
+        sha.update(normalize_cloudy_input(cloudy_input, key_name).encode())
+        return sha.hexdigest()
+
+    def restore(self, key, key_name):
+        """
+        Copy the output of a cached run to the files of this run.
+        Returns True if the run was in the cache.
+        """
+
+        path = os.path.join(self.cache_dir, key)
+        try:
+            names = os.listdir(path)
+        except OSError:
+            self.misses += 1
+            self.entries.pop(key, None)
+            return False
+        for name in names:
+            shutil.copyfile(os.path.join(path, name), key_name + name)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        return True
+
+    def restore_output(self, key, key_name):
+        """
+        Return the data stored with store_output for a run and copy
+        the files kept with it to the files of this run.  Returns None
+        if the run is not in the cache.
+        """
+
+        path = os.path.join(self.cache_dir, key)
+        try:
+            with open(os.path.join(path, "output.json"), 'r') as f:
+                output = json.load(f)
+            names = os.listdir(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        for name in names:
+            if name != "output.json":
+                shutil.copyfile(os.path.join(path, name), key_name + name)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        if key in self.entries:
+            self.entries.move_to_end(key)
+        return output
+
+    def store(self, key, key_name, cloudy_input):
+        "Add the output files of a finished run to the cache."
+        self._add_entry(key, get_output_files(cloudy_input, key_name))
+
+    def store_output(self, key, output, files=()):
+        """
+        Add the data read from the output of a finished run, which
+        must be serializable to JSON, to the cache, with the files
+        given as (filename, suffix) pairs.
+        """
+        self._add_entry(key, files, output=output)
+
+    def _add_entry(self, key, files, output=None):
+        path = os.path.join(self.cache_dir, key)
+        if os.path.isdir(path):
+            return
+        # Copy to a temporary directory first so other grids using the
+        # cache never see a partial entry.
+        tmpPath = "%s.%d.tmp" % (path, os.getpid())
+        os.makedirs(tmpPath)
+        for filename, suffix in files:
+            shutil.copyfile(filename, os.path.join(tmpPath, suffix))
+        if output is not None:
+            with open(os.path.join(tmpPath, "output.json"), 'w') as f:
+                json.dump(output, f)
+        try:
+            os.rename(tmpPath, path)
+        except OSError:
+            shutil.rmtree(tmpPath, ignore_errors=True)
+            return
+        self.stored += 1
+        self.entries[key] = self._get_entry_size(path)
+        self.trim()
+
+    def trim(self):
+        "Remove the least recently used entries beyond the size limit."
+        if self.max_size is None:
+            return
+        total = self.size
+        while self.entries and total > self.max_size * 2**20:
+            key, size = self.entries.popitem(last=False)
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            total -= size
+            self.evicted += 1
+
+    def to_dict(self):
+        "Return the counters of the cache as a dict."
+        return OrderedDict(
+            [("cache_dir", self.cache_dir),
+             ("hits", self.hits),
+             ("misses", self.misses),
+             ("stored", self.stored),
+             ("evicted", self.evicted),
+             ("entries", len(self.entries)),
+             ("size", self.size)])
+
+    def summary(self):
+        "Return a line with the counters of the cache."
+        return ("Cache %s: %d hits, %d misses, %d stored, %d evicted, "
+                "%d entries, %.1f MB." %
+                (self.cache_dir, self.hits, self.misses, self.stored,
+                 self.evicted, len(self.entries), self.size / 2**20))
@@ -0,0 +1,367 @@
+"""
+Order the runs of a grid by their expected cost using the run times
+of earlier runs.
+"""
+
+from collections import OrderedDict
+import glob
+import heapq
+import json
+import numpy as np
+import os
+import re
+import time
+
+from cloudy_grids.utilities import \
+    get_run_parts, \
+    re_runPart
+
+re_execTime = re.compile(r'ExecTime\(s\)\s+([-+.eE0-9]+)')
+
+def _normalize_value(value):
+    "Return a loop value as a key that does not depend on its formatting."
+    values = []
+    for part in value.split(","):
+        try:
+            values.append("%.6g" % float(part))
+        except ValueError:
+            values.append(part.strip())
+    return ",".join(values)
+
+def read_run_lines(run_file):
+    """
+    Return the loop names and, for each finished run, the values
+    listed in a run file or in all of its part files.
+    """
+
+    partFiles = get_run_parts(run_file)
+    if partFiles is None:
+        runFiles = [run_file]
+    else:
+        runFiles = [partFile for partFile in partFiles if os.path.exists(partFile)]
+
+    columns = None
+    runs = OrderedDict()
+    for runFile in runFiles:
+        with open(runFile, 'r') as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if line.startswith("#run"):
+                    columns = line.split("\t")[1:]
+                elif line.strip() and not line.startswith("#"):
+                    values = line.split("\t")
+                    runs[int(values[0])] = values[1:]
+    if columns is None:
+        raise RuntimeError("No #run line found in %s." % run_file)
+    return columns, runs
+
+def _get_map_time(map_file):
+    """
+    Return the time between the date written at the top of a map file
+    and its last modification, or None.
+    """
+
+    try:
+        with open(map_file, 'r') as f:
+            line = f.readline()
+        start = time.mktime(time.strptime(line[1:].strip()))
+    except (OSError, ValueError):
+        return None
+    return os.path.getmtime(map_file) - start
+
+def read_run_times(run_file, report_file=None):
+    """
+    Return the wall time in seconds of each finished run of a grid.
+
+    If report_file, a JSON report written by run_cloudy_grid, is
+    given, the times are taken from it, leaving out runs copied from
+    a cache.  The time of a run of a map grid is the sum of the times
+    of its temperatures.  Otherwise, for each run listed in the run
+    file, the time is taken from the first of these that exists: the
+    ExecTime printed at the end of the Cloudy output
+    (<prefix>_run<N>.cloudyOut, summed over the outputs of a map
+    pushed into it), the time between the modification of
+    the Cloudy input and output files, or, for map files, the time
+    between the date written at the top of the map and its last
+    modification.  Runs with no time are left out.
+
+    Parameters
+    ----------
+    run_file : string
+        Path to the run file ending in .run, or one of its part files.
+    report_file : optional, string
+        JSON report of run_cloudy_grid with the start and end of each
+        run.
+        Default: None.
+
+    Returns
+    -------
+    run_times : OrderedDict
+        Wall time of each run, by run number.
+
+    """
+
+    if report_file is not None:
+        with open(report_file, 'r') as f:
+            report = json.load(f)
+        # Runs copied from a cache took no time to run.  The models of
+        # map grids are (run, temperature index) pairs.
+        cached = set([json.dumps(run) for run in report.get("cached", [])])
+        runTimes = {}
+        for model in report["run_times"]:
+            if json.dumps(model["run"]) in cached:
+                continue
+            run = model["run"][0] if isinstance(model["run"], list) else model["run"]
+            runTimes[run] = runTimes.get(run, 0) + model["end"] - model["start"]
+        return OrderedDict([(run, runTimes[run]) for run in sorted(runTimes)])
+
+    match = re_runPart.search(run_file)
+    prefix = run_file[:match.start()] if match is not None else run_file[:-4]
+    columns, runs = read_run_lines(run_file)
+
+    runTimes = OrderedDict()
+    for run in sorted(runs):
+        keyName = "%s_run%d" % (prefix, run)
+        runTime = None
+        outputFile = keyName + ".cloudyOut"
+        if os.path.exists(outputFile):
+            with open(outputFile, 'r', errors="replace") as f:
+                for line in f:
+                    match = re_execTime.search(line)
+                    # The outputs of a map are pushed into one file.
+                    if match is not None:
+                        runTime = (runTime or 0) + float(match.group(1))
+            if runTime is None and os.path.exists(keyName + ".cloudyIn"):
+                runTime = os.path.getmtime(outputFile) - \
+                  os.path.getmtime(keyName + ".cloudyIn")
+        if runTime is None:
+            mapTimes = [_get_map_time(mapFile) for mapFile in
+                        glob.glob(keyName + ".dat") + glob.glob(keyName + "_*.dat")]
+            mapTimes = [mapTime for mapTime in mapTimes if mapTime is not None]
+            if mapTimes:
+                runTime = max(mapTimes)
+        if runTime is not None:
+            runTimes[run] = runTime
+    return runTimes
+
+class RunCostModel(object):
+    """
+    Expected run time as a function of the loop values of a run.
+
+    The logarithm of the run time is fit as a constant plus one term
+    for each value of each loop, so the cost of each loop value
+    multiplies the others, e.g., high densities and low temperatures
+    are both slow and together slower still.  Loops are matched by
+    the names listed in the run file, so the model of one grid can be
+    used for another with some of the same loops.  Loop values that
+    were not in the fit add nothing.
+
+    Parameters
+    ----------
+    columns : list of strings
+        Name of each loop, as in the #run line of a run file.
+    values : list of lists of strings
+        Loop values of each run, as listed in the run file.
+    run_times : list of floats
+        Wall time of each run.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids.scheduler import fit_cost_model
+    >>> model = fit_cost_model("old_grid/grid.run")
+    >>> model.predict(["hden", "constant temperature"], [["2", "3"]])
+
+    """
+
+    def __init__(self, columns, values, run_times):
+        run_times = np.asarray(run_times, dtype=float)
+        used = run_times > 0
+        if not used.any():
+            raise RuntimeError("No run times greater than zero to fit.")
+
+        self.terms = OrderedDict()
+        rows = []
+        for runValues, runUsed in zip(values, used):
+            if not runUsed:
+                continue
+            row = []
+            for column, value in zip(columns, runValues):
+                term = (column, _normalize_value(value))
+                if term not in self.terms:
+                    self.terms[term] = len(self.terms)
+                row.append(self.terms[term])
+            rows.append(row)
+
+        design = np.zeros((len(rows), len(self.terms) + 1))
+        design[:, 0] = 1
+        for i, row in enumerate(rows):
+            design[i, np.array(row) + 1] = 1
+        y = np.log(run_times[used])
+        self.coefficients = np.linalg.lstsq(design, y, rcond=None)[0]
+        self.residual = np.std(y - np.dot(design, self.coefficients))
+
+    def predict(self, columns, values):
+        "Return the expected run time of each run from its loop values."
+        logTime = np.full(len(values), self.coefficients[0])
+        for i, runValues in enumerate(values):
+            for column, value in zip(columns, runValues):
+                term = self.terms.get((column, _normalize_value(value)))
+                if term is not None:
+                    logTime[i] += self.coefficients[term + 1]
+        return np.exp(logTime)
+
+def fit_cost_model(timings):
+    """
+    Fit the run time of each run of one or more finished grids as a
+    function of the loop values.
+
+    Parameters
+    ----------
+    timings : string or list of strings
+        Run files, or JSON reports of run_cloudy_grid, of grids with
+        run times.  Times are read with read_run_times.  A report is
+        read together with the run file named in it or, failing that,
+        the run file with the same prefix, e.g., grid.run for
+        grid.json.
+
+    Returns
+    -------
+    model : RunCostModel
+
+    """
+
+    if isinstance(timings, str):
+        timings = [timings]
+
+    values = []
+    runTimes = []
+    myColumns = None
+    for timingFile in timings:
+        if timingFile.endswith(".json"):
+            with open(timingFile, 'r') as f:
+                runFile = json.load(f).get("run_file")
+            if runFile is None:
+                runFile = timingFile[:-5] + ".run"
+            times = read_run_times(runFile, report_file=timingFile)
+        else:
+            runFile = timingFile
+            times = read_run_times(runFile)
+        columns, runs = read_run_lines(runFile)
+        if myColumns is None:
+            myColumns = columns
+        elif columns != myColumns:
+            raise RuntimeError("Loops of %s do not match %s." %
+                               (timingFile, timings[0]))
+        for run, runTime in times.items():
+            if run in runs:
+                values.append(runs[run])
+                runTimes.append(runTime)
+
+    if not runTimes:
+        raise RuntimeError("No run times found in %s." % ", ".join(timings))
+    return RunCostModel(myColumns, values, runTimes)
+
+def get_cost_order(model, columns, runs):
+    """
+    Return the run numbers of runs, a dict of the listed loop values
+    by run number, ordered by expected run time, longest first.  Runs
+    with the same expected time stay in run number order.
+    """
+
+    runNumbers = sorted(runs)
+    costs = model.predict(columns, [runs[run] for run in runNumbers])
+    order = np.argsort(-costs, kind="stable")
+    return [runNumbers[i] for i in order]
+
+def replay_schedule(run_times, jobs, order=None, poll=0):
+    """
+    Return the time to finish runs of known length with jobs slots,
+    starting each run in order on the first slot to become free.
+
+    Parameters
+    ----------
+    run_times : dict
+        Wall time of each run, by run number.
+    jobs : int
+        Number of runs at once.
+    order : optional, list of ints
+        Run numbers in the order they start.
+        Default: None, run number order.
+    poll : optional, float
+        If greater than zero, a free slot is only noticed at the next
+        multiple of this many seconds, as with polling for finished
+        runs.
+        Default: 0.
+
+    Returns
+    -------
+    makespan : float
+        Time for all runs to finish.
+
+    """
+
+    if order is None:
+        order = sorted(run_times)
+    slots = [0.] * jobs
+    for run in order:
+        free = heapq.heappop(slots)
+        if poll > 0:
+            free = poll * np.ceil(free / poll)
+        heapq.heappush(slots, free + run_times[run])
+    return max(slots)
+
+def compare_orders(run_file, jobs, report_file=None, timings=None):
+    """
+    Replay the run times of a finished grid in the nested loop order
+    of CIAOLoop and longest first by the cost model, and return the
+    time each would take.
+
+    Parameters
+    ----------
+    run_file : string
+        Path to the run file of the grid.
+    jobs : int
+        Number of runs at once.
+    report_file : optional, string
+        JSON report of run_cloudy_grid with the run times.
+        Default: None, read the times with read_run_times.
+    timings : optional, string or list of strings
+        Run files or reports of grids used to fit the cost model.
+        Default: None, the grid itself.
+
+    Returns
+    -------
+    makespans : OrderedDict
+        Time to finish with the nested order, the cost model order,
+        and the longest first order of the actual run times, and the
+        lower bound, the larger of the longest run and the total time
+        divided by jobs.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids.scheduler import compare_orders
+    >>> compare_orders("cooling/cooling.run", 16)
+
+    """
+
+    runTimes = read_run_times(run_file, report_file=report_file)
+    if not runTimes:
+        raise RuntimeError("No run times found for %s." % run_file)
+    if timings is None:
+        timings = report_file if report_file is not None else run_file
+    model = fit_cost_model(timings)
+
+    columns, runs = read_run_lines(run_file)
+    runs = dict([(run, runs[run]) for run in runTimes if run in runs])
+    runTimes = OrderedDict([(run, runTimes[run]) for run in runTimes if run in runs])
+    costOrder = get_cost_order(model, columns, runs)
+    bestOrder = sorted(runTimes, key=lambda run: -runTimes[run])
+    totalTime = sum(runTimes.values())
+
+    return OrderedDict(
+        [("nested", replay_schedule(runTimes, jobs)),
+         ("cost model", replay_schedule(runTimes, jobs, costOrder)),
+         ("longest first", replay_schedule(runTimes, jobs, bestOrder)),
+         ("lower bound", max(totalTime / jobs, max(runTimes.values())))])
@@ -0,0 +1,403 @@
+"""
+Read UV background models and write them as Cloudy input spectra.
+"""
+
+import glob
+import multiprocessing
+import numpy as np
+import os
+
+tiny_number = 1e-50
+l_tiny = np.log10(tiny_number)
+
+planck_constant_cgs = 6.62606896e-27  # erg s
+speed_of_light_cgs = 2.99792458e10
+Ryd_to_erg = 13.60569253 * 1.60217646e-12
+
+# Constants used for the Puchwein et al. (2019) spectra.
+planck_constant_mks = 6.62606957e-34  # J s
+speed_of_light_mks = 299792458.0
+Ryd_to_J = 2.1798723611035e-18
+
+e_min = 1.001e-8
+e_max = 7.354e6
+
+spectrum_styles = ("hm", "p19")
+
+def angstrom_to_ryd(wavelength):
+    "Convert wavelength in Angstroms to energy in Rydbergs."
+    return planck_constant_cgs * speed_of_light_cgs / \
+      (wavelength * 1e-8 * Ryd_to_erg)
+
+def _read_uvb_table(input_file):
+    """
+    Read a table with a line of redshifts followed by one row per
+    wavelength.  Returns the redshifts, the wavelengths, and J_nu
+    with shape (redshifts, wavelengths).
+    """
+
+    redshift = None
+    rows = []
+    with open(input_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if redshift is None:
+                redshift = np.array(line.split(), dtype=np.float64)
+                continue
+            rows.append(line)
+
+    if redshift is None:
+        raise RuntimeError("No redshifts found in %s." % input_file)
+
+    values = np.array(" ".join(rows).split(), dtype=np.float64)
+    if values.size % (redshift.size + 1):
+        raise RuntimeError(
+            "%s has %d values, not a multiple of %d columns." %
+            (input_file, values.size, redshift.size + 1))
+    values = values.reshape(-1, redshift.size + 1)
+    return redshift, values[:, 0], np.ascontiguousarray(values[:, 1:].T)
+
+def read_uvb_hm(input_file):
+    """
+    Read a Haardt & Madau UV background table.
+
+    Parameters
+    ----------
+    input_file : string
+        The table, e.g., UVB.out, with a line of redshifts followed
+        by rows of wavelength in Angstroms and J_nu at each redshift.
+
+    Returns
+    -------
+    redshift : array
+        The redshifts of the table.
+    energy : array
+        The energy of each row in Rydbergs, in the order of the table.
+    log_jnu : array
+        log10 of J_nu in erg s^-1 cm^-2 Hz^-1 sr^-1, with shape
+        (redshifts, energies).  Values below 1e-50 are set to -50.
+    """
+
+    print ("Loading Haardt & Madau data from %s." % input_file)
+    redshift, wavelength, jnu = _read_uvb_table(input_file)
+    np.maximum(jnu, tiny_number, out=jnu)
+    return redshift, angstrom_to_ryd(wavelength), np.log10(jnu)
+
+def read_uvb_p19(input_file):
+    """
+    Read a Puchwein et al. (2019) UV background table.
+
+    The table has the same layout as the Haardt & Madau tables.  It
+    contains duplicate wavelengths on either side of the Lyman series
+    lines, which are moved apart by 0.01% so that the energies are
+    unique.
+
+    Parameters
+    ----------
+    input_file : string
+        The table, e.g., puchwein19_bkgthick.out.
+
+    Returns
+    -------
+    redshift : array
+        The redshifts of the table.
+    energy : array
+        The energy of each row in Rydbergs, in the order of the table.
+    log_jnu : array
+        log10 of J_nu with shape (redshifts, energies).
+    """
+
+    print ("Loading Puchwein et al. data from %s." % input_file)
+    redshift, wavelength, jnu = _read_uvb_table(input_file)
+
+    values, counts = np.unique(wavelength, return_counts=True)
+    if (counts > 2).any():
+        raise RuntimeError("More than two duplicate wavelengths in %s." %
+                           input_file)
+    pairs = [np.where(wavelength == value)[0]
+             for value in values[counts > 1]]
+    for lower, upper in pairs:
+        wavelength[lower] -= 0.0001 * wavelength[lower]
+        wavelength[upper] += 0.0001 * wavelength[upper]
+
+    energy = speed_of_light_mks * planck_constant_mks / wavelength * \
+      1e10 / Ryd_to_J
+    return redshift, energy, np.log10(jnu)
+
+def read_uvb_fg(input_directory, file_suffix=".dat"):
+    """
+    Read a Faucher-Giguere UV background model.
+
+    Parameters
+    ----------
+    input_directory : string
+        Directory with one file per redshift, each with a "#z="
+        header line followed by rows of energy in Rydbergs and J_nu
+        in units of 10^-21 erg s^-1 cm^-2 Hz^-1 sr^-1.
+    file_suffix : optional, string
+        The suffix of the files to read.
+        Default: ".dat".
+
+    Returns
+    -------
+    redshift : array
+        The sorted redshifts of the files.
+    energy : array
+        The energies in Rydbergs, taken from the first file.
+    log_jnu : array
+        log10 of J_nu in erg s^-1 cm^-2 Hz^-1 sr^-1, with shape
+        (redshifts, energies).
+    """
+
+    print ("Loading Faucher-Giguere data from %s." % input_directory)
+    redshift = []
+    energy = None
+    jnu = []
+    for my_file in glob.glob(os.path.join(input_directory,
+                                          "*" + file_suffix)):
+        my_redshift = None
+        rows = []
+        with open(my_file, 'r') as f:
+            for line in f:
+                if line.startswith("#z="):
+                    my_redshift = float(line[3:])
+                elif not line.startswith("#"):
+                    rows.append(line)
+
+        if my_redshift is None:
+            raise RuntimeError("Could not get redshift from input file: %s." %
+                               my_file)
+
+        values = np.array(" ".join(rows).split(),
+                          dtype=np.float64).reshape(-1, 2)
+        redshift.append(my_redshift)
+        if energy is None:
+            energy = values[:, 0]
+        jnu.append(values[:, 1])
+
+    if not redshift:
+        raise RuntimeError("No %s files found in %s." %
+                           (file_suffix, input_directory))
+
+    redshift = np.array(redshift)
+    log_jnu = np.log10(jnu)
+    log_jnu -= 21.0 # convert from 10^-21 erg s^-1 cm^-2 Hz^-1 sr^-1
+
+    my_sort = redshift.argsort()
+    return redshift[my_sort], energy, log_jnu[my_sort]
+
+def interpolate_spectra(redshift, log_jnu, output_redshift):
+    """
+    Linearly interpolate spectra in redshift.
+
+    All output redshifts are interpolated at once.  Values outside
+    the range of the table are extrapolated from the first or last
+    two redshifts.
+
+    Parameters
+    ----------
+    redshift : array
+        The sorted redshifts of the table.
+    log_jnu : array
+        The spectra with shape (redshifts, energies).
+    output_redshift : array
+        The redshifts at which to interpolate.
+
+    Returns
+    -------
+    log_jnu : array
+        The spectra with shape (output redshifts, energies).
+    """
+
+    redshift = np.asarray(redshift)
+    output_redshift = np.atleast_1d(output_redshift)
+    indices = np.digitize(output_redshift, redshift)
+    indices = np.clip(indices, a_min=1, a_max=redshift.size-1)
+    slope = (log_jnu[indices, :] - log_jnu[indices-1, :]) / \
+      (redshift[indices] - redshift[indices-1])[:, None]
+    return slope * (output_redshift - redshift[indices])[:, None] + \
+      log_jnu[indices, :]
+
+def get_spectrum_filename(redshift):
+    "Return the name of the spectrum file for a redshift."
+    return "z_%10.4e.out" % redshift
+
+def _format_lines(line_format, *columns):
+    "Format columns of values into lines with a single string operation."
+    values = np.column_stack(columns).ravel()
+    return (line_format * (values.size // len(columns))) % tuple(values)
+
+def format_spectrum_tables(redshift, energy, log_jnu, style="hm",
+                           source=None):
+    """
+    Return the text of Cloudy input spectra.
+
+    Parameters
+    ----------
+    redshift : array
+        The redshift of each spectrum.
+    energy : array
+        The energies in Rydbergs, in increasing order.
+    log_jnu : array
+        The spectra with shape (redshifts, energies).
+    style : optional, string
+        "hm" for the format of the Haardt & Madau and
+        Faucher-Giguere spectra in examples/grackle or "p19" for the
+        Puchwein et al. (2019) spectra.
+        Default: "hm".
+    source : optional, string
+        The source named in the first line.  Defaults to
+        "Haardt & Madau (2011)" for style "hm" and
+        "Puchwein et al 2019" for style "p19".
+
+    Returns
+    -------
+    tables : list of strings
+        The text of the file for each redshift.
+    """
+
+    if style not in spectrum_styles:
+        raise RuntimeError("Spectrum style must be one of %s." %
+                           ", ".join(spectrum_styles))
+
+    log_jnu = np.atleast_2d(log_jnu)
+    redshift = np.atleast_1d(redshift)
+    n_z = redshift.size
+
+    if style == "hm":
+        if source is None:
+            source = "Haardt & Madau (2011)"
+        my_energy = np.concatenate([[0.99 * energy[0]], energy,
+                                    [1.01 * energy[-1], e_max]])
+        my_ljnu = np.concatenate([l_tiny * np.ones((n_z, 1)), log_jnu,
+                                  l_tiny * np.ones((n_z, 2))], axis=1)
+        e_out = np.where(my_energy == np.roll(my_energy, 1),
+                         my_energy * 1.0001, my_energy)
+        line_format = "continue (%.10f %.10f)\n"
+        header = "interpolate (%.10f %.10f)\n" % (e_min, l_tiny)
+
+        # J_nu at 1 Ryd by log-log interpolation.
+        my_e = 1.0
+        e_value = np.log10(my_e)
+        l_energy = np.log10(my_energy)
+        index = np.digitize([e_value], l_energy)[0]
+        slope = (my_ljnu[:, index] - my_ljnu[:, index - 1]) / \
+          (l_energy[index] - l_energy[index - 1])
+        my_j = slope * (e_value - l_energy[index]) + my_ljnu[:, index]
+        my_j += np.log10(4 * np.pi)
+
+    else:
+        if source is None:
+            source = "Puchwein et al 2019"
+        lJ_pad = -50
+        e_out = np.concatenate([[energy[0] * 0.99], energy,
+                                [energy[-1] * 1.01, 7.354e6]])
+        my_ljnu = np.concatenate([lJ_pad * np.ones((n_z, 1)), log_jnu,
+                                  lJ_pad * np.ones((n_z, 2))], axis=1)
+        line_format = "continue (%.10f) (%.10f)\n"
+        header = "interpolate (%.10f) (%.10f)\n" % (1e-8, lJ_pad)
+
+        # J_nu at 1 Ryd by linear interpolation in energy.
+        my_e = 1
+        index = np.clip(np.searchsorted(energy, my_e), 1, energy.size - 1)
+        slope = (log_jnu[:, index] - log_jnu[:, index - 1]) / \
+          (energy[index] - energy[index - 1])
+        x = 10**(slope * (my_e - energy[index - 1]) + log_jnu[:, index - 1])
+        my_j = np.log10(x * 4 * np.pi)
+
+    tables = []
+    for i in range(n_z):
+        tables.append(
+            "# %s\n# z = %f\n# E [Ryd] log (J_nu)\n" % (source, redshift[i]) +
+            header + _format_lines(line_format, e_out, my_ljnu[i]) +
+            "f(nu) = %.10f at %.10f Ryd\n" % (my_j[i], my_e))
+    return tables
+
+def _write_spectrum_files(task):
+    "Format and write the spectrum files for a set of redshifts."
+    filenames, redshift, energy, log_jnu, style, source = task
+    tables = format_spectrum_tables(redshift, energy, log_jnu,
+                                    style=style, source=source)
+    for filename, table in zip(filenames, tables):
+        with open(filename, 'w') as f:
+            f.write(table)
+    return len(filenames)
+
+def write_spectra(redshift, energy, log_jnu, output_dir,
+                  output_redshift=None, style="hm", source=None,
+                  jobs=1):
+    """
+    Write Cloudy input spectra for a set of redshifts.
+
+    Parameters
+    ----------
+    redshift : array
+        The sorted redshifts of the table.
+    energy : array
+        The energies in Rydbergs, as returned by the readers.  They
+        are written in increasing order.
+    log_jnu : array
+        The spectra with shape (redshifts, energies).
+    output_dir : string
+        The directory for the z_<redshift>.out files.  It will be
+        created if it does not exist.
+    output_redshift : optional, array
+        The redshifts at which to interpolate and write spectra.  If
+        None, the spectra are written at the table redshifts without
+        interpolation.
+        Default: None.
+    style : optional, string
+        The file format, "hm" or "p19".  See format_spectrum_tables.
+        Default: "hm".
+    source : optional, string
+        The source named in the first line of each file.
+        Default: None.
+    jobs : optional, int
+        The number of processes used to format and write the files.
+        Default: 1.
+
+    Returns
+    -------
+    filenames : list of strings
+        The files written.
+    """
+
+    energy = np.asarray(energy)
+    log_jnu = np.asarray(log_jnu)
+    if energy[0] > energy[-1]:
+        energy = energy[::-1]
+        log_jnu = log_jnu[:, ::-1]
+
+    if output_redshift is None:
+        output_redshift = np.asarray(redshift)
+        spectra = log_jnu
+    else:
+        output_redshift = np.atleast_1d(output_redshift)
+        spectra = interpolate_spectra(redshift, log_jnu, output_redshift)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    filenames = [os.path.join(output_dir, get_spectrum_filename(z))
+                 for z in output_redshift]
+
+    jobs = max(1, min(jobs, len(filenames)))
+    groups = np.array_split(np.arange(len(filenames)), jobs)
+    tasks = [([filenames[i] for i in group], output_redshift[group],
+              energy, spectra[group], style, source)
+             for group in groups if group.size > 0]
+
+    print ("Writing %d spectra to %s." % (len(filenames), output_dir))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            pool.map(_write_spectrum_files, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for task in tasks:
+            _write_spectrum_files(task)
+
+    return filenames
@@ -0,0 +1,357 @@
+"""
+Write synthetic CIAOLoop output for testing and benchmarking the
+converters without running Cloudy.
+"""
+
+import numpy as np
+import os
+import stat
+import sys
+import time
+
+from cloudy_grids.utilities import \
+    run_modes
+
+atomic_number = {"H": 1, "He": 2, "Li": 3, "Be": 4, "B": 5, "C": 6,
+                 "N": 7, "O": 8, "F": 9, "Ne": 10, "Na": 11, "Mg": 12,
+                 "Al": 13, "Si": 14, "P": 15, "S": 16, "Cl": 17, "Ar": 18,
+                 "K": 19, "Ca": 20, "Sc": 21, "Ti": 22, "V": 23, "Cr": 24,
+                 "Mn": 25, "Fe": 26, "Co": 27, "Ni": 28, "Cu": 29, "Zn": 30}
+
+default_lines = ["H__1_1215.67A", "O__6_1031.91A", "C__4_1548.19A"]
+
+def get_default_parameters(mode, dimensions):
+    """
+    Return loop parameter names and values for a grid of the given
+    dimensions.  The first parameter is hden.  Emissivity grids loop
+    over energy second.
+    """
+
+    if mode == "emissivity":
+        names = ["hden", "energy", "redshift", "metals"]
+    else:
+        names = ["hden", "redshift", "metals"]
+    names += ["parameter%d" % (q+1) for q in range(len(names), len(dimensions))]
+
+    parameters = []
+    for name, size in zip(names, dimensions):
+        if name == "hden":
+            values = np.linspace(-10, 4, size)
+        elif name == "energy":
+            values = np.logspace(-1, 1, size)
+        elif name == "redshift":
+            values = np.linspace(0, 10, size)
+        else:
+            values = np.linspace(-3, 0, size)
+        parameters.append((name, ["%g" % value for value in values]))
+    return parameters
+
+def write_run_file(run_file, parameters, mode="cooling"):
+    """
+    Write a CIAOLoop run file header and one #run line per grid point.
+
+    parameters is a list of (command, values) pairs, with values
+    given as strings, in loop order.
+    """
+
+    prefix = run_file[:-4]
+    dimensions = [len(values) for name, values in parameters]
+
+    lines = ["# Run started %s.\n" % time.ctime(),
+             "#\n",
+             "# cloudyRunMode = %d\n" % run_modes[mode],
+             "# outputFilePrefix = %s\n" % os.path.basename(prefix),
+             "# outputDir = %s\n" % os.path.dirname(os.path.abspath(run_file)),
+             "#\n",
+             "# Commands to be executed everytime:\n",
+             "# stop zone 1\n",
+             "# iterate to convergence\n",
+             "#\n",
+             "# Loop commands and values:\n"]
+    for name, values in parameters:
+        lines.append("# %s: %s\n" % (name, " ".join(values)))
+    lines.append("#\n")
+    lines.append("#run\t%s\n" % "\t".join([name for name, values in parameters]))
+
+    for q, index in enumerate(np.ndindex(*dimensions)):
+        lines.append("%d\t%s\n" % (q+1, "\t".join(
+            [values[i] for (name, values), i in zip(parameters, index)])))
+
+    with open(run_file, 'w') as f:
+        f.write("".join(lines))
+
+def _get_map_header(title, parameters, index, columns):
+    "Return the header of a map file with its loop values."
+    header = "# %s\n#\n# %s\n#\n# Loop values:\n" % (time.ctime(), title)
+    for (name, values), i in zip(parameters, index):
+        header += "# %s %s\n" % (name, values[i])
+    return header + "#\n" + columns
+
+def _format_rows(row_format, values):
+    "Format a 2D array with one string operation."
+    return (row_format * values.shape[0]) % tuple(values.ravel())
+
+def write_synthetic_grid(output_dir, mode="cooling", dimensions=(8, 8),
+                         temperatures=161, parameters=None,
+                         elements=("C", "O"), lines=None,
+                         prefix=None, seed=0):
+    """
+    Write a synthetic CIAOLoop run directory.
+
+    The run file and map files have the same layout as those written
+    by CIAOLoop, with random values in place of Cloudy results.
+
+    Parameters
+    ----------
+    output_dir : string
+        Directory for the run file and map files.  It will be created
+        if it does not exist.
+    mode : optional, string
+        The type of maps: "cooling", "emissivity", "ion_balance", or
+        "line".
+        Default: "cooling".
+    dimensions : optional, tuple of ints
+        Number of values of each loop parameter.  Ignored if
+        parameters is given.  Line grids can only loop over hden.
+        Default: (8, 8).
+    temperatures : optional, int or array
+        Number of temperatures from 10 to 1e9 K, or the temperatures
+        themselves.
+        Default: 161.
+    parameters : optional, list of (string, list) pairs
+        Loop commands and their values, overriding dimensions.
+        Emissivity grids must loop over "energy".
+        Default: None.
+    elements : optional, list of strings
+        Elements with ion balance maps.
+        Default: ("C", "O").
+    lines : optional, list of strings
+        Line labels of line maps.
+        Default: None, three UV lines.
+    prefix : optional, string
+        Prefix of the run file and map files.
+        Default: None, the name of the mode.
+    seed : optional, int
+        Seed of the random values.
+        Default: 0.
+
+    Returns
+    -------
+    run_file : string
+        Path to the run file.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids.synthetic import write_synthetic_grid
+    >>> run_file = write_synthetic_grid("cooling", dimensions=(29, 26))
+    >>> convert_cooling_tables(run_file, "cooling.h5")
+
+    """
+
+    if mode not in run_modes:
+        raise RuntimeError("Mode must be one of %s." % ", ".join(run_modes))
+    if parameters is None:
+        parameters = get_default_parameters(mode, dimensions)
+    parameters = [(name, [str(value) for value in values])
+                  for name, values in parameters]
+    if mode == "emissivity" and \
+      "energy" not in [name for name, values in parameters]:
+        raise RuntimeError("Emissivity grids must loop over energy.")
+    if prefix is None:
+        prefix = mode
+    if lines is None:
+        lines = default_lines
+
+    if np.isscalar(temperatures):
+        temperatures = np.logspace(1, 9, int(temperatures))
+    temperatures = np.asarray(temperatures, dtype=float)
+    nT = temperatures.size
+    log_T = np.log10(temperatures)
+
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    run_file = os.path.join(output_dir, "%s.run" % prefix)
+    write_run_file(run_file, parameters, mode=mode)
+
+    random = np.random.RandomState(seed)
+    dimensions = [len(values) for name, values in parameters]
+    for q, index in enumerate(np.ndindex(*dimensions)):
+        map_file = os.path.join(output_dir, "%s_run%d" % (prefix, q+1))
+
+        if mode == "cooling":
+            header = _get_map_header(
+                "Cooling Map File", parameters, index,
+                "# Data Columns:\n# Te [K]\n# Heating [erg s^-1 cm^3]\n"
+                "# Cooling [erg s^-1 cm^3]\n"
+                "# Mean Molecular Weight [amu]\n#\n"
+                "#Te\t\tHeating\t\tCooling\t\tMMW\n")
+            values = np.column_stack(
+                [temperatures,
+                 10**(-24 - random.random(nT)),
+                 10**(-23 + 0.5 * np.sin(log_T) - random.random(nT)),
+                 0.6 + 0.6 * random.random(nT)])
+            with open(map_file + ".dat", 'w') as f:
+                f.write(header + _format_rows("%.6e\t%.6e\t%.6e\t%.6f\n", values))
+
+        elif mode == "emissivity":
+            energy = [values[i] for (name, values), i in zip(parameters, index)
+                      if name == "energy"][0]
+            header = _get_map_header(
+                "Emissivity Map File", parameters, index,
+                "# Data Columns:\n# Te [K]\n"
+                "# Emissivity [erg s^-1 cm^3 Hz^-1]\n#\n"
+                "#E [keV]      %s\n#Te            em\n" % energy)
+            values = np.column_stack(
+                [temperatures, 10**(-23 - 2 * random.random(nT))])
+            with open(map_file + ".dat", 'w') as f:
+                f.write(header + _format_rows("%.6e  %.6e\n", values))
+
+        elif mode == "ion_balance":
+            for element in elements:
+                n_ions = atomic_number[element] + 1
+                header = _get_map_header(
+                    "%s Ion Fraction File" % element, parameters, index,
+                    "# Data Columns:\n# log(Te [K])\n"
+                    "# log(Ion Fractions)\n#\n#Te\t%s\n" %
+                    "\t".join([str(i+1) for i in range(n_ions)]))
+                values = np.column_stack(
+                    [log_T, -10 * random.random((nT, n_ions))])
+                with open("%s_%s.dat" % (map_file, element), 'w') as f:
+                    f.write(header + _format_rows(
+                        "%.3f" + "\t%.3f" * n_ions + "\n", values))
+
+        elif mode == "line":
+            header = _get_map_header(
+                "Cooling Map File", parameters, index,
+                "# Data Columns:\n# log10 Te [K]\n"
+                "# log10 Emissivities / n_H^2 [erg s^-1 cm^3]\n#\n"
+                "#Te   %s\n" % "  ".join(lines))
+            values = np.column_stack(
+                [log_T, -22 - 3 * random.random((nT, len(lines)))])
+            with open(map_file + ".dat", 'w') as f:
+                f.write(header + _format_rows(
+                    "%.3f  " + "  ".join(["%.4f"] * len(lines)) + "\n", values))
+
+    return run_file
+
+# Script run in place of Cloudy by write_stub_cloudy.
+_stub_cloudy = """#! %(python)s
+import math
+import re
+import sys
+import time
+
+# Numeric value of each command, e.g., hden -2 gives hden = -2.
+commands = sys.stdin.read().splitlines()
+values = {}
+saves = {}
+for command in commands:
+    words = command.split()
+    for word in words[1:]:
+        try:
+            values[words[0]] = float(word)
+            break
+        except ValueError:
+            pass
+    match = re.match(r'^(?:punch|save)\\s+(?:last\\s+)?(.+?)\\s+(?:file\\s*=\\s*)?"(.+)"',
+                     command, re.I)
+    if match is not None:
+        saves[match.group(1).lower()] = match.group(2)
+    if re.match(r'^(constant\\s+temperature|coronal)', command, re.I):
+        values["T"] = values[words[0]]
+        if "linear" not in command.lower():
+            values["T"] = 10**values["T"]
+
+start = time.time()
+time.sleep(max(0, eval(%(run_time)r, {"math": math}, values)))
+
+heating = %(heating)r
+cooling = %(cooling)r
+if heating is not None and cooling is not None:
+    T = values["T"]
+    nH = 10**values.get("hden", 0)
+    heating = eval(heating, {"math": math}, values)
+    cooling = eval(cooling, {"math": math}, values)
+    # H and He ionize with temperature.
+    logT = math.log10(T)
+    ionized = [0.5 * (1 + math.tanh(5 * (logT - T0))) for T0 in (4.2, 4.5, 4.9)]
+    x = lambda f: math.log10(max(f, 1e-30))
+    for name in ["cooling", "heating"]:
+        if name in saves:
+            with open(saves[name], "w") as f:
+                f.write("#depth\\tTemp\\tHtot\\tCtot\\n")
+                f.write("%%.4e\\t%%.4e\\t%%.4e\\t%%.4e\\n" %%
+                        (0.5, T, heating * nH**2, cooling * nH**2))
+    if "physical conditions" in saves:
+        with open(saves["physical conditions"], "w") as f:
+            f.write("#depth\\tTe\\tHden\\teden\\n")
+            f.write("%%.4e\\t%%.4e\\t%%.4e\\t%%.4e\\n" %% (0.5, T, nH, nH * ionized[0]))
+    if "abundance" in saves:
+        with open(saves["abundance"], "w") as f:
+            f.write("#abund H\\tHe\\n0.000\\t-1.071\\n")
+    if "ionization means" in saves:
+        with open(saves["ionization means"], "w") as f:
+            f.write("%%-11s%%7.3f%%7.3f\\n" %% (" Hydrogen", x(1 - ionized[0]), x(ionized[0])))
+            f.write("%%-11s%%7.3f%%7.3f%%7.3f\\n" %% (" Helium", x(1 - ionized[1]),
+                    x(ionized[1] - ionized[2]), x(ionized[2])))
+            f.write("\\n")
+
+for command in commands:
+    print(" * %%s" %% command)
+print(" Cloudy ends: 1 zone, 1 iteration. ExecTime(s) %%.2f" %% (time.time() - start))
+print(" Cloudy exited OK")
+"""
+
+def write_stub_cloudy(filename, run_time="0", heating=None, cooling=None):
+    """
+    Write an executable script that can be used in place of Cloudy
+    to test running grids.
+
+    The script reads a Cloudy input from stdin, sleeps, echoes the
+    commands, and ends with the lines Cloudy prints with the run time
+    and when it exits OK.  If heating and cooling are given, it also
+    writes the files of the punch last cooling, heating, abundance,
+    ionization means and physical conditions commands given by
+    CIAOLoop's cooling map mode, with hydrogen and helium ionizing
+    around 10^4 to 10^5 K.  Only the files of the commands given are
+    written, so it can also stand in for Cloudy in ion fraction
+    maps.
+
+    Parameters
+    ----------
+    filename : string
+        Path of the script.
+    run_time : optional, string
+        Python expression for the time to sleep in seconds.  The
+        first number given to each command is available by the first
+        word of the command, e.g., "0.01 * (hden + 10)", and the
+        temperature of a constant temperature or coronal equilibrium
+        command is T.
+        Default: "0".
+    heating : optional, string
+        Python expression for the heating divided by n_H^2, in the
+        same variables, e.g., "1e-24 * (T / 1e4)**-0.5".
+        Default: None.
+    cooling : optional, string
+        Python expression for the cooling divided by n_H^2.
+        Default: None.
+
+    Returns
+    -------
+    filename : string
+        Path of the script.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids.synthetic import write_stub_cloudy
+    >>> write_stub_cloudy("cloudy.exe", run_time="0.1")
+
+    """
+
+    with open(filename, 'w') as f:
+        f.write(_stub_cloudy % {"python": sys.executable, "run_time": run_time,
+                                "heating": heating, "cooling": cooling})
+    os.chmod(filename, os.stat(filename).st_mode | stat.S_IXUSR)
+    return filename
@@ -1,4 +1,13 @@
+import glob
 import h5py
+import hashlib
+import multiprocessing
+import numpy as np
+import os
+import re
+
+from cloudy_grids.profiling import \
+    get_profile
 
 def get_grid_indices(dims,index):
     "Return indices with shape of dims corresponding to scalar index."
@@ -13,8 +22,800 @@ def get_grid_indices(dims,index):
     indices.reverse()
     return indices
 
+# CIAOLoop cloudyRunMode of each map type.
+run_modes = {"cooling": 1,
+             "emissivity": 2,
+             "ion_balance": 3,
+             "line": 4}
+
+# Names of the loop parameters of emissivity tables.
+par_names = {'Parameter1': 'log_nH'}
+
+# Directory and size limit in MB of the parsed map cache.
+_map_cache = None
+
+def set_map_cache(cache_dir=None, max_size=None):
+    """
+    Cache parsed map files as binary .npy files.
+
+    Once set, load_map stores each map it parses in cache_dir, keyed
+    by the path, size, and modification time of the map file, and
+    reads it back from there as long as the map file is unchanged.
+    Entries are plain .npy files that can be memory mapped.
+
+    Parameters
+    ----------
+    cache_dir : optional, string
+        Directory holding the cache entries.  If None, turn the
+        cache off.
+        Default: None.
+    max_size : optional, float
+        Total size in MB of the cache.  The least recently used
+        entries are removed beyond this by trim_map_cache, which is
+        called after every grid is read.  If None, there is no limit.
+        Default: None.
+
+    Examples
+    --------
+
+    >>> from cloudy_grids import set_map_cache, convert_cooling_tables
+    >>> set_map_cache("map_cache", max_size=1024)
+    >>> convert_cooling_tables("cooling/cooling.run", "cooling.h5")
+
+    """
+
+    global _map_cache
+    if cache_dir is None:
+        _map_cache = None
+    else:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        _map_cache = (cache_dir, max_size)
+
+def get_map_cache():
+    "Return the map cache settings, to be passed to init_map_cache_worker."
+    return _map_cache
+
+def init_map_cache_worker(map_cache):
+    """
+    Use the map cache settings of the parent process, from
+    get_map_cache, in a worker process that reads maps with load_map.
+    """
+
+    global _map_cache
+    _map_cache = map_cache
+
+def trim_map_cache():
+    "Remove the least recently used cache entries beyond the cache size limit."
+
+    if _map_cache is None or _map_cache[1] is None:
+        return
+    cache_dir, max_size = _map_cache
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npy"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum([entry[1] for entry in entries])
+
+    for mtime, size, path in sorted(entries):
+        if total <= max_size * 2**20:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+def _get_cache_file(map_file, stat):
+    "Return the cache entry of a map file with the given stat."
+    key = "%s:%d:%d" % (os.path.abspath(map_file), stat.st_size, stat.st_mtime_ns)
+    return os.path.join(_map_cache[0],
+                        hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+def _read_map_columns(map_file):
+    "Return the column names from the header of a map file."
+    header = ""
+    with open(map_file, 'r') as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            header = line
+    return header.lstrip('#').split()
+
+def load_map(map_file):
+    """
+    Read a CIAOLoop map file.
+
+    Returns a 2D array with one row per temperature and one column
+    per data column, and the list of column names taken from the
+    last header line.  The data block is parsed in a single call
+    rather than token by token.  If a cache has been set with
+    set_map_cache, the parsed data is read from and stored there.
+    """
+
+    if _map_cache is None:
+        return _parse_map(map_file)
+
+    cacheFile = _get_cache_file(map_file, os.stat(map_file))
+    try:
+        data = np.load(cacheFile)
+    except (OSError, ValueError):
+        pass
+    else:
+        try:
+            os.utime(cacheFile)
+        except OSError:
+            pass
+        return data, _read_map_columns(map_file)
+
+    data, columns = _parse_map(map_file)
+
+    # Write to a temporary file first so other processes never see
+    # a partial entry.
+    tmpFile = "%s.%d.tmp" % (cacheFile, os.getpid())
+    try:
+        with open(tmpFile, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmpFile, cacheFile)
+    except OSError:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+
+    return data, columns
+
+def _parse_map(map_file):
+    "Parse the text of a CIAOLoop map file."
+
+    with open(map_file, 'r') as f:
+        text = f.read()
+
+    # The column names are those of the last header line at the top.
+    header = ""
+    start = 0
+    while text.startswith('#', start):
+        end = text.find('\n', start)
+        if end < 0:
+            end = len(text)
+        header = text[start:end]
+        start = end + 1
+    columns = header.lstrip('#').split()
+
+    # Comment lines may also appear among the data.
+    body = text[start:]
+    if '#' in body:
+        body = "\n".join([line for line in body.splitlines()
+                          if not line.startswith('#')])
+
+    firstLine = re.search(r'\S[^\n]*', body)
+    if firstLine is None:
+        return np.empty((0, len(columns))), columns
+    n_columns = len(firstLine.group().split())
+
+    try:
+        values = np.array(body.split(), dtype=np.float64)
+    except ValueError as error:
+        raise RuntimeError("Could not parse map file %s: %s." % (map_file, error))
+    if values.size % n_columns:
+        raise RuntimeError(
+            "Map file %s has %d values, not a multiple of %d columns." %
+            (map_file, values.size, n_columns))
+
+    return values.reshape(-1, n_columns), columns
+
+# Run files written by CIAOLoop -mp <part> <total parts>.
+re_runPart = re.compile(r'\.run\.part(\d+)_(\d+)$')
+
+def get_run_parts(run_file):
+    """
+    Find the part files of a run made with CIAOLoop -mp.
+
+    run_file is either the combined run file name ending in .run or
+    any one of its .run.partK_N files.  Returns a list with the file
+    name of each part, whether or not it exists yet, or None if
+    run_file is not split into parts.
+    """
+
+    match = re_runPart.search(run_file)
+    if match is not None:
+        base = run_file[:match.start()] + ".run"
+        totalParts = int(match.group(2))
+    elif os.path.exists(run_file):
+        return None
+    else:
+        base = run_file
+        totalParts = None
+        for partFile in glob.glob(glob.escape(run_file) + ".part*_*"):
+            match = re_runPart.search(partFile)
+            if match is not None:
+                totalParts = int(match.group(2))
+                break
+        if totalParts is None:
+            return None
+
+    return ["%s.part%d_%d" % (base, q+1, totalParts) for q in range(totalParts)]
+
+def get_part_ranges(totalRuns, totalParts):
+    """
+    Return the first and last run number of each part of a grid run
+    with CIAOLoop -mp, computed as CIAOLoop does.
+    """
+
+    mapsPerPart = -(-totalRuns // totalParts)
+    return [(mapsPerPart * q + 1, min(mapsPerPart * (q+1), totalRuns))
+            for q in range(totalParts)]
+
+def read_run_file(run_file, complete=True):
+    """
+    Read the header of a CIAOLoop run file.
+
+    Returns the prefix of the map files, the loop parameter names,
+    the loop parameter values, and an array of bool that is True for
+    each run listed as finished.  If complete is True, raise an error
+    unless every run of the grid is listed.
+
+    The run files of a grid run in parts with CIAOLoop -mp can be
+    read without combining them by giving either the combined name
+    ending in .run or any one of the part files.  The runs of all
+    parts that exist so far are listed.
+    """
+
+    partFiles = get_run_parts(run_file)
+    if partFiles is not None:
+        run_file = partFiles[0][:re_runPart.search(partFiles[0]).start()] + ".run"
+    if run_file[-4:] == '.run':
+        prefix = run_file[0:-4]
+    else:
+        raise RuntimeError("Run file needs to end in .run.")
+
+    if partFiles is None:
+        runFiles = [run_file]
+    else:
+        runFiles = [partFile for partFile in partFiles if os.path.exists(partFile)]
+        if not runFiles:
+            raise RuntimeError("No part files found for %s." % run_file)
+
+    f = open(runFiles[0],'r')
+    lines = f.readlines()
+    f.close()
+
+    # Values of loop parameters.
+    parameterValues = []
+    parameterNames = []
+
+    getParameterValues = False
+
+    re_parValue = re.compile('^\# Loop commands and values:')
+    re_runValue = re.compile('^\#run')
+
+    for q,line in enumerate(lines):
+        line = line.strip()
+        if getParameterValues:
+            if line == '#':
+                getParameterValues = False
+            else:
+                (par,values) = line.split(': ')
+                if values.count(';') == 2 and \
+                  values.startswith('(') and values.endswith(')'):
+                    fs, fe, fi = [float(v) for v in values[1:-1].split(';')]
+                    floatValues = np.arange(fs, fe+fi/2, fi)
+                else:
+                    floatValues = [float(val) for val in values.split()]
+                parameterValues.append(floatValues)
+                parameterNames.append(par[2:])
+        elif (re_parValue.match(line) is not None):
+            getParameterValues = True
+        elif (re_runValue.match(line) is not None):
+            break
+
+    # Runs are listed by number once they finish.
+    gridDimension = [len(q) for q in parameterValues]
+    gridRuns = int(np.prod(gridDimension))
+    runNumbers = []
+    for runFile in runFiles:
+        with open(runFile, 'r') as f:
+            for line in f:
+                if line.startswith('#') or not line.strip():
+                    continue
+                runNumbers.append(int(line.split(None, 1)[0]))
+    runNumbers = np.array(runNumbers, dtype=int)
+    if runNumbers.size and (runNumbers.min() < 1 or runNumbers.max() > gridRuns):
+        raise RuntimeError(
+            "Error: run numbers in run file are outside of the grid of %d runs." % gridRuns)
+    listedRuns = np.zeros(gridRuns, dtype=bool)
+    listedRuns[runNumbers-1] = True
+
+    if partFiles is not None:
+        for partFile, (first, last) in zip(partFiles, get_part_ranges(gridRuns, len(partFiles))):
+            print ("%s: runs %d to %d, %d finished." %
+                   (partFile, first, last, listedRuns[first-1:last].sum()))
+
+    # Check file line number against product of parameter numbers.
+    if (complete and listedRuns.sum() != gridRuns) or \
+      runNumbers.size > gridRuns:
+        message = "Error: total runs (%d) in run file not equal to product of parameters(%d)." % \
+          (runNumbers.size, gridRuns)
+        if partFiles is not None:
+            message += "  Use incremental to convert the parts finished so far."
+        raise RuntimeError(message)
+
+    return prefix, parameterNames, parameterValues, listedRuns
+
+def get_grid_blocks(gridDimension, max_runs):
+    """
+    Split the runs of a grid into blocks of consecutive runs.
+
+    Each block holds at most max_runs runs (or a single run) and
+    covers a hyperslab of the grid.  Returns a list of the first
+    run, last run + 1, and the slab indexing the block in the grid.
+    """
 
-dataTypes = {"<type 'float'>":'>f8',"<type 'int'>":'>i8',"<type 'long'>":'>i8'}
+    # Find the trailing axes whose runs fit in one block.
+    split = len(gridDimension)
+    inner = 1
+    while split > 0 and inner * gridDimension[split-1] <= max_runs:
+        split -= 1
+        inner *= gridDimension[split]
+
+    # Take as many steps along the next axis as will fit.
+    if split > 0:
+        step = max(1, min(max_runs // inner, gridDimension[split-1]))
+    else:
+        step = 1
+
+    blocks = []
+    totalRuns = int(np.prod(gridDimension))
+    start = 0
+    while start < totalRuns:
+        indices = get_grid_indices(gridDimension, start)
+        slab = [slice(None)] * (len(gridDimension) - split)
+        if split > 0:
+            first = indices[split-1]
+            last = min(first + step, gridDimension[split-1])
+            slab = indices[:split-1] + [slice(first, last)] + slab
+            stop = start + (last - first) * inner
+        else:
+            stop = totalRuns
+        blocks.append((start, stop, tuple(slab)))
+        start = stop
+
+    return blocks
+
+def get_slab_shape(gridDimension, slab):
+    "Return the shape of the part of the grid indexed by slab."
+    shape = []
+    for dim, index in zip(gridDimension, slab):
+        if isinstance(index, slice):
+            shape.append(len(range(*index.indices(dim))))
+    return shape
+
+# Shared map buffers as seen by worker processes.
+_worker_buffers = None
+
+def _init_map_worker(buffers, shapes, map_cache):
+    "Attach a worker process to the shared map buffers and map cache."
+    global _worker_buffers
+    init_map_cache_worker(map_cache)
+    _worker_buffers = [np.frombuffer(buffer, dtype=np.float64).reshape(shape)
+                       for buffer, shape in zip(buffers, shapes)]
+
+def _fill_run(buffers, slot, files):
+    """
+    Read the map files of one run into a slot of the map buffers.
+    Returns the slot, the errors for maps that could not be read, and
+    the errors for maps of the wrong shape, which are left as zeros.
+    """
+
+    errors = []
+    mismatches = []
+    for buffer, mapFile in zip(buffers, files):
+        try:
+            data = load_map(mapFile)[0]
+        except (OSError, RuntimeError, ValueError) as error:
+            errors.append("Could not read map file %s: %s" % (mapFile, error))
+            continue
+        try:
+            buffer[slot] = data
+        except ValueError:
+            buffer[slot] = 0
+            mismatches.append("Map file %s has shape %s, expected %s." %
+                              (mapFile, data.shape, buffer.shape[1:]))
+    return slot, errors, mismatches
+
+def _fill_run_worker(task):
+    "Read the map files of one run into the shared map buffers."
+    slot, files = task
+    return _fill_run(_worker_buffers, slot, files)
+
+def load_map_grid(map_files, gridDimension, write_block,
+                  jobs=1, buffer_size=None, strict=True,
+                  zero_mismatched=False, runs=None, map_shapes=None,
+                  profile=None):
+    """
+    Read the map files of the grid and pass them on block by block.
+
+    Parameters
+    ----------
+    map_files : list
+        For each run, in run order, the list of map files to read.
+    gridDimension : list
+        Number of values of each loop parameter.
+    write_block : callable
+        Called as write_block(slab, blocks) for each block of runs.
+        slab indexes the block within the grid and blocks holds, for
+        each map file of a run, an array with the shape of the slab
+        plus the (temperature, column) shape of the map.
+    jobs : optional, int
+        Number of processes used to read the map files.  Workers
+        write directly into shared memory at the position of each
+        run, so the result is identical to reading serially.
+        Default: 1.
+    buffer_size : optional, float
+        Maximum size in MB of map data held in memory at once.  If
+        None, the whole grid is read before write_block is called.
+        Default: None.
+    strict : optional, bool
+        If True, raise an error for a map that cannot be read or
+        whose shape does not match the first map.  Otherwise, print
+        a message and leave zeros.
+        Default: True.
+    zero_mismatched : optional, bool
+        If True, print a message and leave zeros for a map whose
+        shape does not match the first map even if strict is True.
+        Default: False.
+    runs : optional, array of bool
+        If given, only read the runs for which this is True.  Runs
+        in blocks that are only partly selected are written one at
+        a time with a slab of integer indices.
+        Default: None.
+    map_shapes : optional, list
+        The (temperature, column) shape of each map file of a run.
+        If None, this is taken from the first run to be read.
+        Default: None.
+    profile : optional, ConversionProfile
+        If given, record the time spent reading maps and in
+        write_block as the read_maps and write stages.
+        Default: None.
+
+    Returns
+    -------
+    An array of bool that is True for runs that could not be read.
+    """
+
+    totalRuns = len(map_files)
+    if runs is None:
+        runs = np.ones(totalRuns, dtype=bool)
+    failed = np.zeros(totalRuns, dtype=bool)
+    if not runs.any():
+        return failed
+    profile = get_profile(profile)
+    profile.set_total_maps(int(runs.sum()))
+
+    # The first run sets the shape of all the others.
+    if map_shapes is None:
+        firstRun = int(np.argmax(runs))
+        mapShapes = [load_map(mapFile)[0].shape
+                     for mapFile in map_files[firstRun]]
+    else:
+        mapShapes = [tuple(shape) for shape in map_shapes]
+
+    if buffer_size is None:
+        max_runs = totalRuns
+    else:
+        run_bytes = 8 * sum([int(np.prod(shape)) for shape in mapShapes])
+        max_runs = max(1, int(buffer_size * 2**20) // run_bytes)
+    blocks = get_grid_blocks(gridDimension, max_runs)
+    max_runs = max([stop - start for start, stop, slab in blocks])
+
+    shapes = [(max_runs,) + shape for shape in mapShapes]
+    if jobs > 1:
+        sharedBuffers = [multiprocessing.RawArray('d', int(np.prod(shape)))
+                         for shape in shapes]
+        buffers = [np.frombuffer(buffer, dtype=np.float64).reshape(shape)
+                   for buffer, shape in zip(sharedBuffers, shapes)]
+        pool = multiprocessing.Pool(jobs, initializer=_init_map_worker,
+                                    initargs=(sharedBuffers, shapes, _map_cache))
+    else:
+        buffers = [np.zeros(shape) for shape in shapes]
+        pool = None
+
+    readStage = profile.stage("read_maps")
+    writeStage = profile.stage("write")
+    try:
+        for start, stop, slab in blocks:
+            selected = np.where(runs[start:stop])[0] + start
+            if selected.size == 0:
+                continue
+
+            with readStage:
+                if not strict:
+                    for buffer in buffers:
+                        buffer[:] = 0
+
+                tasks = [(q - start, map_files[q]) for q in selected]
+                if pool is None:
+                    results = (_fill_run(buffers, *task) for task in tasks)
+                else:
+                    chunksize = max(1, len(tasks) // (16 * jobs))
+                    results = pool.imap_unordered(_fill_run_worker, tasks,
+                                                  chunksize=chunksize)
+
+                for slot, errors, mismatches in results:
+                    profile.add_maps(map_files[start + slot:start + slot + 1])
+                    if errors or mismatches:
+                        failed[start + slot] = True
+                    for error in errors:
+                        if strict:
+                            raise RuntimeError(error)
+                        print (error)
+                    for error in mismatches:
+                        if strict and not zero_mismatched:
+                            raise RuntimeError(error)
+                        print (error)
+
+            with writeStage:
+                if selected.size == stop - start:
+                    slabShape = get_slab_shape(gridDimension, slab)
+                    write_block(slab, [buffer[:stop-start].reshape(slabShape + list(shape))
+                                       for buffer, shape in zip(buffers, mapShapes)])
+                else:
+                    for q in selected:
+                        write_block(tuple(get_grid_indices(gridDimension, int(q))),
+                                    [buffer[q-start] for buffer in buffers])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        trim_map_cache()
+
+    return failed
+
+def get_map_stats(map_files, listedRuns):
+    """
+    Get the size and modification time in ns of the map files of
+    each run.  Both are -1 for missing files and for runs not listed
+    in the run file.
+    """
+
+    sizes = -np.ones((len(map_files), len(map_files[0])), dtype=np.int64)
+    mtimes = -np.ones(sizes.shape, dtype=np.int64)
+    for q in np.flatnonzero(listedRuns):
+        for i, mapFile in enumerate(map_files[q]):
+            try:
+                stat = os.stat(mapFile)
+            except OSError:
+                continue
+            sizes[q, i] = stat.st_size
+            mtimes[q, i] = stat.st_mtime_ns
+    return sizes, mtimes
+
+def read_manifest(output_file, name="_manifest"):
+    """
+    Read the ingest manifest from an output file.
+
+    Returns a dictionary of the manifest arrays, or None if the file
+    or the manifest does not exist.
+    """
+
+    if not os.path.exists(output_file):
+        return None
+    with h5py.File(output_file, 'r') as output:
+        if name not in output:
+            return None
+        group = output[name]
+        return dict([(field, group[field][()]) for field in group])
+
+def get_incremental_runs(map_files, listedRuns, manifest):
+    """
+    Find the runs whose map files are new or changed since the
+    manifest was written.
+
+    Returns the array of runs to read and the current map file
+    sizes and modification times.
+    """
+
+    sizes, mtimes = get_map_stats(map_files, listedRuns)
+    runs = get_changed_runs(sizes, mtimes, manifest)
+    print ("Reading %d of %d maps." % (runs.sum(), runs.size))
+    return runs, sizes, mtimes
+
+def get_changed_runs(sizes, mtimes, manifest):
+    """
+    Return an array that is True for runs whose map files all exist
+    and are not recorded as ingested with the same size and
+    modification time in the manifest.
+    """
+
+    runs = (sizes >= 0).all(axis=1)
+    if manifest is not None:
+        if manifest["size"].shape != sizes.shape:
+            raise RuntimeError(
+                "Grid of the run file does not match the ingest manifest.")
+        runs &= (~manifest["ingested"].astype(bool)) | \
+          (sizes != manifest["size"]).any(axis=1) | \
+          (mtimes != manifest["mtime"]).any(axis=1)
+    return runs
+
+def write_manifest(output, runs, failed, sizes, mtimes, map_shapes,
+                   manifest=None, name="_manifest"):
+    """
+    Record which runs have been ingested into an output file along
+    with the size and modification time of their map files.
+    """
+
+    ingested = runs & ~failed
+    if manifest is not None:
+        ingested |= ~runs & manifest["ingested"].astype(bool)
+        sizes = np.where(runs[:, None], sizes, manifest["size"])
+        mtimes = np.where(runs[:, None], mtimes, manifest["mtime"])
+
+    fields = {"ingested": ingested.astype(np.int8),
+              "size": sizes,
+              "mtime": mtimes,
+              "map_shape": np.array(map_shapes, dtype=np.int64)}
+
+    group = output.require_group(name)
+    for field, data in fields.items():
+        if field in group:
+            group[field][...] = data
+        else:
+            group.create_dataset(field, data=data)
+
+
+def get_chunk_shape(shape, itemsize, chunk_bytes=2**16):
+    """
+    Return a chunk shape that keeps whole rows of the last axis
+    (temperature) contiguous, adding neighbouring rows along the
+    preceding axes until the chunk reaches about chunk_bytes.
+    """
+
+    chunks = [1] * len(shape)
+    chunks[-1] = max(1, shape[-1])
+    size = chunks[-1] * itemsize
+    for axis in range(len(shape)-2, -1, -1):
+        chunks[axis] = int(max(1, min(shape[axis], chunk_bytes // size)))
+        size *= chunks[axis]
+        if chunks[axis] < shape[axis]:
+            break
+    return tuple(chunks)
+
+def get_slabs(shape, itemsize, chunks=None, max_size=64):
+    """
+    Return a list of slices along the first axis that split a dataset
+    into slabs of at most max_size MB, or of one row if a row is
+    larger.  For chunked datasets, slabs are aligned with the chunks.
+    """
+
+    row = max(1, int(np.prod(shape[1:])) * itemsize)
+    step = max(1, int(max_size * 2**20) // row)
+    if chunks is not None and step > chunks[0]:
+        step -= step % chunks[0]
+    return [slice(start, min(start + step, shape[0]))
+            for start in range(0, shape[0], step)]
+
+def get_energy_axis(dataset):
+    """
+    Return the axis of the energy loop parameter in an Emissivity
+    dataset.  Files without the energy_axis attribute are matched
+    by the number of energies.
+    """
+
+    if 'energy_axis' in dataset.attrs:
+        return int(dataset.attrs['energy_axis'])
+    nE = dataset.attrs['log_E'].size
+    axes = [i for i, size in enumerate(dataset.shape[:-1]) if size == nE]
+    if len(axes) != 1:
+        raise RuntimeError("Cannot identify the energy axis of %s." % dataset.name)
+    return axes[0]
+
+def get_parameter_names(dataset):
+    "Return the attribute names of the loop parameters other than energy."
+    names = []
+    for q in range(len(dataset.shape)-2):
+        name = "Parameter%d" % (q+1)
+        names.append(par_names.get(name, name))
+    return names
+
+def get_tables(f):
+    """
+    Return the tables of an hdf5 file as a list of (path, number of
+    leading axes, manifest path) tuples, the loop parameter names and
+    values, the temperatures in K, and the type of table.
+    """
+
+    if "Emissivity" in f:
+        dataset = f["Emissivity"]
+        names = get_parameter_names(dataset)
+        values = [dataset.attrs[name] for name in names]
+        ienergy = get_energy_axis(dataset)
+        names.insert(ienergy, "energy")
+        values.insert(ienergy, 10**dataset.attrs["log_E"])
+        return [("Emissivity", 0, "_manifest")], names, values, \
+          10**dataset.attrs["log_T"], "emissivity"
+
+    if "Cooling" in f:
+        rank = len(f["Cooling"].shape)
+        names = []
+        values = []
+        for q in range(rank - 1):
+            dataset = f["Parameter%d" % (q+1)]
+            names.append(dataset.attrs["Name"])
+            values.append(dataset[()])
+        tables = [(name, 0, "_manifest") for name in f
+                  if isinstance(f[name], h5py.Dataset) and
+                  f[name].shape == f["Cooling"].shape]
+        return tables, names, values, f["Temperature"][()], "cooling"
+
+    groups = [name for name in f if isinstance(f[name], h5py.Group) and
+              "emissivity" in f[name]]
+    if groups:
+        group = f[groups[0]]
+        names = [name for name in group
+                 if name not in ("emissivity", "log_T")]
+        values = [group[name][()] for name in names]
+        tables = [("%s/emissivity" % name, 0, "_manifest") for name in groups]
+        return tables, names, values, 10**group["log_T"][()], "line"
+
+    elements = [name for name in f if isinstance(f[name], h5py.Dataset) and
+                "Temperature" in f[name].attrs]
+    if not elements:
+        raise RuntimeError("Cannot identify the tables of %s." % f.filename)
+    dataset = f[elements[0]]
+    names = ["Parameter%d" % (q+1) for q in range(len(dataset.shape) - 2)]
+    values = [dataset.attrs[name] for name in names]
+    tables = [(name, 1, "_manifest/%s" % name) for name in elements]
+    return tables, names, values, 10**dataset.attrs["Temperature"], \
+      "ion_balance"
+
+def get_dataset_options(shape, dtype, native_endian=False, chunks=None,
+                        compression=None, shuffle=False):
+    """
+    Return the create_dataset keyword arguments for a grid dataset.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the dataset.
+    dtype : string
+        Data type of the dataset, e.g., '>f8'.
+    native_endian : optional, bool
+        If True, store the data in the byte order of this machine
+        so that reading it does not require a byteswap.
+        Default: False.
+    chunks : optional, bool or tuple
+        Chunk shape of the dataset.  If True, use a shape that keeps
+        each temperature row contiguous.  If None, the dataset is
+        contiguous unless a filter is requested.
+        Default: None.
+    compression : optional, string or int
+        Compression filter, either 'gzip', 'lzf', or a gzip level.
+        Default: None.
+    shuffle : optional, bool
+        If True, apply the shuffle filter before compression.
+        Default: False.
+    """
+
+    dtype = np.dtype(dtype)
+    if native_endian:
+        dtype = dtype.newbyteorder('=')
+    options = {"dtype": dtype}
+
+    if chunks is None and (compression is not None or shuffle):
+        chunks = True
+    if chunks is True:
+        chunks = get_chunk_shape(shape, dtype.itemsize)
+    if chunks is not None and 0 not in shape:
+        options["chunks"] = tuple(chunks)
+        if compression is not None:
+            options["compression"] = compression
+        if shuffle:
+            options["shuffle"] = True
+
+    return options
+
+
+dataTypes = {float:'>f8',int:'>i8'}
 
 def get_attributes(file,datasets=None):
     "Get all dataset attributes and their datatypes."
@@ -23,7 +824,7 @@ def get_attributes(file,datasets=None):
 
     closeFile = False
 
-    if type(file) == h5py.highlevel.File:
+    if isinstance(file,h5py.File):
         input = file
     else:
         input = h5py.File(file,'r')
@@ -37,15 +838,16 @@ def get_attributes(file,datasets=None):
         attributes[dataset] = {}
         for attribute in input[dataset].attrs.keys():
             attributes[dataset][attribute] = {}
-            if type(input[dataset].attrs[attribute]) == na.ndarray:
-                attributes[dataset][attribute]['dtype'] = input[dataset].attrs[attribute].dtype
+            value = input[dataset].attrs[attribute]
+            if isinstance(value,(np.ndarray,np.generic)):
+                attributes[dataset][attribute]['dtype'] = value.dtype
             else:
-                thisType = type(input[dataset].attrs[attribute])
-                if dataTypes.has_key("%s" % thisType):
-                    attributes[dataset][attribute]['dtype'] = dataTypes["%s" % thisType]
+                thisType = type(value)
+                if thisType in dataTypes:
+                    attributes[dataset][attribute]['dtype'] = dataTypes[thisType]
                 else:
                     attributes[dataset][attribute]['dtype'] = thisType
-            attributes[dataset][attribute]['value'] = input[dataset].attrs[attribute]
+            attributes[dataset][attribute]['value'] = value
 
     if closeFile:
         input.close()
@@ -60,11 +862,9 @@ def write_attributes(output,attributes,datasets=None):
 
     for dataset in datasets:
         for attribute in attributes[dataset].keys():
-            if type(attributes[dataset][attribute]['value']) == na.ndarray:
-                output[dataset].attrs[attribute] = attributes[dataset][attribute]['value']
+            value = attributes[dataset][attribute]['value']
+            if isinstance(value,(np.ndarray,str)):
+                output[dataset].attrs[attribute] = value
             else:
-                if type(attributes[dataset][attribute]['value']) == str:
-                    output[dataset].attrs[attribute] = attributes[dataset][attribute]['value']
-                else:
-                    output[dataset].attrs[attribute] = na.array(attributes[dataset][attribute]['value'],
-                                                                dtype=attributes[dataset][attribute]['dtype'])
+                output[dataset].attrs[attribute] = np.array(value,
+                                                            dtype=attributes[dataset][attribute]['dtype'])
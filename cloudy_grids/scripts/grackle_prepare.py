@@ -4,13 +4,20 @@ Prepare cooling data for Grackle.
 Britton Smith <brittonsmith@gmail.com>
 """
 
-from collections import defaultdict
 import h5py
 import numpy as np
 import sys
 
-class H5InMemory(object):
-    def __init__(self, fh):
+from cloudy_grids.utilities import get_slabs
+
+class H5Lazy(object):
+    """
+    A lazily loaded hdf5 file or group.  The tree and attributes are
+    read on creation, but datasets are only read when their values
+    are accessed and are written out one slab at a time by save.
+    """
+
+    def __init__(self, fh=None):
         if isinstance(fh, str):
             fh = h5py.File(fh, 'r')
 
@@ -18,26 +25,20 @@ class H5InMemory(object):
         if hasattr(fh, "attrs"):
             self.attrs = dict([(attr, fh.attrs[attr]) \
                                for attr in fh.attrs])
-                               
-        if isinstance(fh, h5py.highlevel.Dataset):
-            self.value = fh.value
-        else:
-            self.data = dict([(field, H5InMemory(fh[field])) \
-                               for field in fh.keys()])
-
-        if isinstance(fh, h5py.highlevel.File):
-            fh.close()
+
+        self.data = {}
+        if isinstance(fh, h5py.Group):
+            for field in fh.keys():
+                if isinstance(fh[field], h5py.Dataset):
+                    self.data[field] = H5LazyDataset(fh[field])
+                else:
+                    self.data[field] = H5Lazy(fh[field])
 
     def __getitem__(self, key):
         return self.data[key]
 
     def __repr__(self):
-        if hasattr(self, "data"):
-            return "<H5InMemory Group object (%d items)>" % \
-              len(self.keys())
-        else:
-            return "<H5InMemory Data object %s>" % \
-              str(self.value.shape)
+        return "<H5Lazy Group object (%d items)>" % len(self.keys())
 
     def __str__(self):
         return self.__repr__()
@@ -45,13 +46,16 @@ class H5InMemory(object):
     def __iter__(self):
         for field in self.keys():
             yield field
-    
+
     def keys(self):
-        if hasattr(self, "data"):
-            return self.data.keys()
-        return None
+        return self.data.keys()
+
+    def save(self, fh, chunk_size=16):
+        """
+        Write the tree to an hdf5 file or group, reading and writing
+        datasets in slabs of at most chunk_size MB.
+        """
 
-    def save(self, fh):
         top = False
         if isinstance(fh, str):
             top = True
@@ -59,28 +63,139 @@ class H5InMemory(object):
 
         for attr in self.attrs:
             fh.attrs[attr] = self.attrs[attr]
-            
-        if hasattr(self, "data"):
-            for field in self:
-                if hasattr(self.data[field], "data"):
-                    self.data[field].save(fh.create_group(field))
-                else:
-                    dfh = fh.create_dataset(field, 
-                                            data=self.data[field].value)
-                    self.data[field].save(dfh)
+
+        for field in self:
+            if isinstance(self.data[field], H5Lazy):
+                self.data[field].save(fh.create_group(field),
+                                      chunk_size=chunk_size)
+            else:
+                self.data[field].save(fh, field, chunk_size=chunk_size)
 
         if top:
             fh.close()
 
+class LazyData(object):
+    """
+    Base class for dataset values that are computed on demand.
+    Subclasses set shape and dtype and implement __getitem__ for
+    () and for slices along the first axis.
+    """
+
+    def __init__(self, attrs=None):
+        self.attrs = {}
+        if attrs is not None:
+            self.attrs.update(attrs)
+
+    @property
+    def value(self):
+        return self[()]
+
+    def __repr__(self):
+        return "<%s Data object %s>" % (self.__class__.__name__,
+                                        str(self.shape))
+
+    def __str__(self):
+        return self.__repr__()
+
+    def get_slab_shape(self, slab):
+        "Return the shape of the data selected by slab."
+        if slab == ():
+            return self.shape
+        return (len(range(*slab.indices(self.shape[0]))),) + self.shape[1:]
+
+    def save(self, fh, name, chunk_size=16):
+        "Write the data to a new dataset one slab at a time."
+        dfh = fh.create_dataset(name, shape=self.shape, dtype=self.dtype)
+        for attr in self.attrs:
+            dfh.attrs[attr] = self.attrs[attr]
+
+        if len(self.shape) == 0:
+            dfh[()] = self[()]
+            return
+        for slab in get_slabs(self.shape, self.dtype.itemsize,
+                              max_size=chunk_size):
+            dfh[slab] = self[slab]
+
+class H5LazyDataset(LazyData):
+    "An hdf5 dataset that is read when accessed."
+
+    def __init__(self, dataset):
+        LazyData.__init__(self, dataset.attrs)
+        self.dataset = dataset
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+
+    def __getitem__(self, slab):
+        return self.dataset[slab]
+
+class ScaledData(LazyData):
+    "Data multiplied by a constant."
+
+    def __init__(self, source, factor):
+        LazyData.__init__(self, source.attrs)
+        self.source = source
+        self.factor = factor
+        self.shape = source.shape
+        self.dtype = np.result_type(source.dtype, factor)
+
+    def __getitem__(self, slab):
+        return self.source[slab] * self.factor
+
+class ZeroedData(LazyData):
+    "Zeros in place of data, without reading it."
+
+    def __init__(self, source):
+        LazyData.__init__(self, source.attrs)
+        self.shape = source.shape
+        self.dtype = source.dtype
+
+    def __getitem__(self, slab):
+        return np.zeros(self.get_slab_shape(slab), dtype=self.dtype)
+
+class ConcatenatedData(LazyData):
+    """
+    Data joined along an axis other than the first.  Sources with one
+    less dimension are inserted as a single slice along that axis.
+    Attributes are taken from the first source.
+    """
+
+    def __init__(self, sources, axis):
+        if axis < 1:
+            raise RuntimeError("Concatenation axis must be greater than 0.")
+        LazyData.__init__(self, sources[0].attrs)
+        self.sources = sources
+        self.axis = axis
+
+        ndim = max([len(source.shape) for source in sources])
+        size = 0
+        for source in sources:
+            if len(source.shape) < ndim:
+                size += 1
+            else:
+                size += source.shape[axis]
+        shape = list(sources[0].shape)
+        shape[axis] = size
+        self.shape = tuple(shape)
+        self.dtype = np.result_type(*[source.dtype for source in sources])
+
+    def __getitem__(self, slab):
+        data = []
+        for source in self.sources:
+            values = source[slab]
+            if len(source.shape) < len(self.shape):
+                values = np.expand_dims(values, self.axis)
+            data.append(values)
+        return np.concatenate(data, axis=self.axis)
+
 def rearrange_attrs(data):
     "Move Temperature, Parameter1, Parameter2, etc. datasets to attributes."
     ignore_attrs = ["Dimension", "Rank"]
-    ignore_fields = ["MMW"]
+    ignore_fields = ["MMW", "_manifest"]
     datasets = ["Cooling", "Heating"]
     new_attrs = {}
 
     # Grab data from the datasets that are to be converted to attributes.
-    for field in data.keys():
+    for field in list(data.keys()):
         if field in ignore_fields + datasets: continue
         new_attrs[field] = data[field].value
         for attr in data[field].attrs.keys():
@@ -107,7 +222,7 @@ if __name__ == "__main__":
     output_file = sys.argv[3]
 
     print("Reading %s." % uvb_file)
-    uvb_data = H5InMemory(uvb_file)
+    uvb_data = H5Lazy(uvb_file)
 
     # Rename Parameter2 Name attribute
     print("Changing Parameter2 attribute Name from %s to redshift." % \
@@ -119,40 +234,39 @@ if __name__ == "__main__":
     rearrange_attrs(uvb_data)
 
     print("Reading %s." % no_uvb_file)
-    no_uvb_data = H5InMemory(no_uvb_file)
+    no_uvb_data = H5Lazy(no_uvb_file)
 
     # Zero out heating values for no_uvb data
     print("Zeroing heating values for no_uvb data.")
-    no_uvb_data["Heating"].value[:] = 0.0
+    no_uvb_data.data["Heating"] = ZeroedData(no_uvb_data["Heating"])
 
     # Graft no_uvb data onto uvb_data
     print("Grafting no_uvb data onto uvb_data.")
     for field in ["Cooling", "Heating"]:
         print("Grafting %s." % field)
-        new_data = np.concatenate([np.rollaxis(uvb_data[field].value, 1),
-                                   [no_uvb_data[field].value]])
-        new_data = np.rollaxis(new_data, 1)
-        
-        uvb_data[field].value = new_data
-        uvb_data[field].attrs["Dimension"] = new_data.shape
-        uvb_data[field].attrs["Parameter2"] = \
-          np.concatenate([uvb_data[field].attrs["Parameter2"],
-                          [uvb_data[field].attrs["Parameter2"][-1]]])
+        new_data = ConcatenatedData([uvb_data[field], no_uvb_data[field]], 1)
+
+        new_data.attrs["Dimension"] = new_data.shape
+        new_data.attrs["Parameter2"] = \
+          np.concatenate([new_data.attrs["Parameter2"],
+                          [new_data.attrs["Parameter2"][-1]]])
+        uvb_data.data[field] = new_data
 
     # Scale data to correspond to Z = Zsun.
     scale_factor = 1000.
     print("Scaling data by %f." % scale_factor)
     for field in ["Cooling", "Heating"]:
-        uvb_data[field].value *= scale_factor
+        uvb_data.data[field] = ScaledData(uvb_data[field], scale_factor)
 
     # Move datasets into group "CoolingRates/Metals"
     print("Moving datasets into correct groups.")
-    uvb_data.data["CoolingRates"] = H5InMemory({})
-    uvb_data["CoolingRates"].data["Metals"] = H5InMemory({})
+    uvb_data.data["CoolingRates"] = H5Lazy()
+    uvb_data["CoolingRates"].data["Metals"] = H5Lazy()
     for field in ["Cooling", "Heating"]:
         uvb_data["CoolingRates"]["Metals"].data[field] = uvb_data[field]
         del uvb_data.data[field]
 
-    # Write out new data.
+    # Write out new data.  The grafting and scaling are applied one slab
+    # at a time as the datasets are written.
     print("Saving new dataset as %s." % output_file)
     uvb_data.save(output_file)
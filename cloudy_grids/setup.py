@@ -34,6 +34,11 @@ setup(name="cloudy_grids",
       },
       packages=["cloudy_grids"],
       include_package_data=True,
+      entry_points={
+          'console_scripts': [
+              'cloudy_grids = cloudy_grids.command_line:main',
+          ],
+      },
       classifiers=[
           "Development Status :: 4 - Beta",
           "Environment :: Console",
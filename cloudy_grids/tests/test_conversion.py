@@ -0,0 +1,91 @@
+"""
+Tests of the converters on synthetic CIAOLoop grids.
+"""
+
+import h5py
+import numpy as np
+import pytest
+
+from cloudy_grids import \
+    convert_cooling_tables, \
+    convert_emissivity_tables, \
+    convert_ion_balance_tables, \
+    convert_line_tables
+from cloudy_grids.synthetic import \
+    write_synthetic_grid
+
+elements = ["C", "O"]
+
+def convert(mode, run_file, output_file, **kwargs):
+    "Convert a synthetic grid with the converter of its mode."
+    if mode == "cooling":
+        convert_cooling_tables(run_file, output_file, **kwargs)
+    elif mode == "emissivity":
+        convert_emissivity_tables(run_file, output_file, **kwargs)
+    elif mode == "ion_balance":
+        convert_ion_balance_tables(run_file, output_file, elements, **kwargs)
+    else:
+        convert_line_tables(run_file, output_file, **kwargs)
+
+def read_tables(output_file):
+    "Return the datasets and attributes of a converted file by name."
+    tables = {}
+    def read_item(name, item):
+        if name.startswith("_manifest"):
+            return
+        if isinstance(item, h5py.Dataset):
+            tables[name] = item[()]
+        tables[name + "/attrs"] = dict(item.attrs)
+    with h5py.File(output_file, 'r') as f:
+        f.visititems(read_item)
+    return tables
+
+def assert_same_tables(output_file, expected_file):
+    "Check two converted files hold the same tables."
+    tables = read_tables(output_file)
+    expected = read_tables(expected_file)
+    assert sorted(tables) == sorted(expected)
+    for name in expected:
+        if name.endswith("/attrs"):
+            assert sorted(tables[name]) == sorted(expected[name])
+            for key in expected[name]:
+                np.testing.assert_array_equal(tables[name][key], expected[name][key])
+        else:
+            np.testing.assert_array_equal(tables[name], expected[name])
+
+def write_grid(tmp_path, mode):
+    "Write a small synthetic grid of a mode and return its run file."
+    dimensions = (12,) if mode == "line" else (3, 4)
+    return write_synthetic_grid(str(tmp_path / mode), mode=mode,
+                                dimensions=dimensions, temperatures=20,
+                                elements=elements)
+
+@pytest.mark.parametrize("mode", ["cooling", "emissivity", "ion_balance", "line"])
+def test_parallel_matches_serial(tmp_path, mode):
+    run_file = write_grid(tmp_path, mode)
+    convert(mode, run_file, str(tmp_path / "serial.h5"), jobs=1)
+    convert(mode, run_file, str(tmp_path / "parallel.h5"), jobs=3)
+    assert_same_tables(str(tmp_path / "parallel.h5"), str(tmp_path / "serial.h5"))
+
+@pytest.mark.parametrize("mode", ["cooling", "ion_balance"])
+def test_incremental_resume_matches_full(tmp_path, capsys, mode):
+    run_file = write_grid(tmp_path, mode)
+    convert(mode, run_file, str(tmp_path / "full.h5"))
+
+    # Convert with only the first half of the runs listed, as while
+    # the grid is still running, then again once it has finished.
+    with open(run_file, 'r') as f:
+        lines = f.readlines()
+    header = [line for line in lines if line.startswith("#")]
+    runs = [line for line in lines if not line.startswith("#")]
+    with open(run_file, 'w') as f:
+        f.write("".join(header + runs[:len(runs) // 2]))
+    convert(mode, run_file, str(tmp_path / "resumed.h5"), incremental=True)
+    with open(run_file, 'w') as f:
+        f.write("".join(lines))
+    capsys.readouterr()
+    convert(mode, run_file, str(tmp_path / "resumed.h5"), incremental=True)
+    assert "Reading %d of %d maps." % (len(runs) - len(runs) // 2, len(runs)) in \
+      capsys.readouterr().out
+
+    assert_same_tables(str(tmp_path / "resumed.h5"), str(tmp_path / "full.h5"))
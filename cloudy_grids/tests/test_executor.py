@@ -0,0 +1,106 @@
+"""
+Tests of running grids locally with a stub in place of Cloudy.
+"""
+
+import h5py
+import numpy as np
+import os
+
+from cloudy_grids import \
+    convert_cooling_tables
+from cloudy_grids.executor import \
+    run_cloudy_grid
+from cloudy_grids.refinement import \
+    refine_cooling_grid
+from cloudy_grids.synthetic import \
+    write_stub_cloudy
+
+heating = "1e-24 * (T / 1e4)**-0.5"
+cooling = "1e-22 * (T / 1e6)**0.5"
+temperatures = np.logspace(1, 9, 9)
+
+def write_parameter_file(tmp_path, mode):
+    "Write a parameter file of a small grid run with the stub."
+    # Bare runs have no temperature for the heating and cooling.
+    if mode == 0:
+        cloudy_exe = write_stub_cloudy(str(tmp_path / "cloudy.exe"))
+    else:
+        cloudy_exe = write_stub_cloudy(str(tmp_path / "cloudy.exe"),
+                                       heating=heating, cooling=cooling)
+    lines = ["cloudyExe = %s" % cloudy_exe,
+             "outputFilePrefix = grid",
+             "outputDir = %s" % (tmp_path / "grid"),
+             "cloudyRunMode = %d" % mode,
+             "command stop zone 1",
+             "loop [hden] (-2;2;2)",
+             "loop [metals * log] -1 0"]
+    if mode == 1:
+        lines.extend(["coolingMapTmin = 1e1",
+                      "coolingMapTmax = 1e9",
+                      "coolingMapTpoints = %d" % temperatures.size])
+    parameter_file = str(tmp_path / "grid.par")
+    with open(parameter_file, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return parameter_file
+
+def read_run_numbers(run_file):
+    "Return the run numbers listed in a run file."
+    with open(run_file, 'r') as f:
+        return [int(line.split()[0]) for line in f
+                if line.strip() and not line.startswith("#")]
+
+def read_maps(output_dir):
+    "Return the text of the map files of a grid without their dates."
+    maps = {}
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith(".dat"):
+            with open(os.path.join(output_dir, name), 'r') as f:
+                maps[name] = f.readlines()[1:]
+    return maps
+
+def check_cooling_tables(run_file, output_file):
+    "Convert a cooling map grid and check it against the stub."
+    convert_cooling_tables(run_file, output_file)
+    T = temperatures
+    with h5py.File(output_file, 'r') as f:
+        assert f["Heating"].shape == (3, 2, T.size)
+        np.testing.assert_allclose(f["Temperature"][()], T, rtol=1e-6)
+        np.testing.assert_allclose(f["Heating"][()], np.resize(eval(heating), (3, 2, T.size)),
+                                   rtol=1e-3)
+        np.testing.assert_allclose(f["Cooling"][()], np.resize(eval(cooling), (3, 2, T.size)),
+                                   rtol=1e-3)
+
+def test_bare_grid(tmp_path):
+    parameter_file = write_parameter_file(tmp_path, 0)
+    report = run_cloudy_grid(parameter_file, jobs=3)
+    run_file = str(tmp_path / "grid" / "grid.run")
+    assert read_run_numbers(run_file) == list(range(1, 7))
+    assert not report.crashed
+    for run in range(1, 7):
+        with open(str(tmp_path / "grid" / ("grid_run%d.cloudyOut" % run)), 'r') as f:
+            assert "Cloudy exited OK" in f.read()
+
+def test_cooling_map_grid(tmp_path):
+    parameter_file = write_parameter_file(tmp_path, 1)
+    cache_dir = str(tmp_path / "cache")
+    report = run_cloudy_grid(parameter_file, jobs=3, cache_dir=cache_dir,
+                             report_file=str(tmp_path / "grid.json"))
+    run_file = str(tmp_path / "grid" / "grid.run")
+    assert read_run_numbers(run_file) == list(range(1, 7))
+    assert len(report.runs) == 6 * temperatures.size
+    assert not report.crashed and not report.cached
+    check_cooling_tables(run_file, str(tmp_path / "grid.h5"))
+    maps = read_maps(str(tmp_path / "grid"))
+
+    # Every temperature is now in the cache, and the runs of the
+    # slowest points go first.
+    report = run_cloudy_grid(parameter_file, jobs=3, cache_dir=cache_dir,
+                             order="cost", timings=[str(tmp_path / "grid.json")])
+    assert len(report.cached) == 6 * temperatures.size
+    assert read_maps(str(tmp_path / "grid")) == maps
+
+def test_refine_cooling_grid(tmp_path):
+    parameter_file = write_parameter_file(tmp_path, 1)
+    run_file = refine_cooling_grid(parameter_file, coarse_step=2, jobs=3)
+    assert read_run_numbers(run_file) == list(range(1, 7))
+    check_cooling_tables(run_file, str(tmp_path / "grid.h5"))